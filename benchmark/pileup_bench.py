@@ -0,0 +1,35 @@
+import pysam
+import timeit
+
+iterations = 5
+repeats = 10
+print ("repeats=", repeats, "iterations=", iterations)
+
+fn = '../tests/pysam_data/ex1.bam'
+window = 10
+step = 100
+
+def _pileup_windows( truncate ):
+    f = pysam.Samfile( fn, "rb" )
+    for contig, length in zip( f.references, f.lengths ):
+        for start in range( 0, length, step ):
+            l = len( [ x.n for x in f.pileup( contig, start, start + window,
+                                                truncate = truncate ) ] )
+    f.close()
+
+def test_pileup_windows():
+    '''pileup small windows, all overlapping columns.'''
+    _pileup_windows( False )
+
+def test_pileup_windows_truncated():
+    '''pileup small windows, columns restricted to window.'''
+    _pileup_windows( True )
+
+tests = ( test_pileup_windows,
+          test_pileup_windows_truncated )
+
+for repeat in range( repeats ):
+    print ("# repeat=", repeat)
+    for test in tests:
+        t = timeit.timeit( test, number = iterations )
+        print ("%5.2f\t%s" % (t,str(test)))
@@ -5,7 +5,7 @@ cdef extern from "string.h":
   void *memset(void *b,int c,size_t len)
 
 cdef extern from "stdlib.h":
-  void free(void *)
+  void free(void *) nogil
   void *malloc(size_t)
   void *calloc(size_t,size_t)
   void *realloc(void *,size_t)
@@ -162,7 +162,10 @@ cdef extern from "bam.h":
   bamFile razf_dopen(int data_fd, char *mode)
 
   int64_t bam_seek( bamFile fp, uint64_t voffset, int where)
-  int64_t bam_tell( bamFile fp )
+  int64_t bam_tell( bamFile fp ) nogil
+  int bam_is_be
+  int BAM_CORE_SIZE
+  int bgzf_flush( bamFile fp )
 
   # void bam_init_header_hash(bam_header_t *header)
 
@@ -178,7 +181,7 @@ cdef extern from "bam.h":
   # bam iterator interface
   bam_iter_t bam_iter_query( bam_index_t *idx, int tid, int beg, int end)
 
-  int bam_iter_read(bamFile fp, bam_iter_t iter, bam1_t *b)
+  int bam_iter_read(bamFile fp, bam_iter_t iter, bam1_t *b) nogil
 
   void bam_iter_destroy(bam_iter_t iter)
 
@@ -277,15 +280,17 @@ cdef extern from "sam.h":
 
   int sampileup( samfile_t *fp, int mask, bam_pileup_f func, void *data)
 
-  void samclose(samfile_t *fp)
+  void samclose(samfile_t *fp) nogil
 
-  int samread(samfile_t *fp, bam1_t *b)
+  int samread(samfile_t *fp, bam1_t *b) nogil
 
-  int samwrite(samfile_t *fp, bam1_t *b)
+  int samwrite(samfile_t *fp, bam1_t *b) nogil
 
   # functions not declared in sam.h but available as extern
   int bam_prob_realn(bam1_t *b, char *ref)
-  int bam_cap_mapQ(bam1_t *b, char *ref, int thres)
+  int bam_prob_realn_core(bam1_t *b, char *ref, int flag) nogil
+  int bam_cap_mapQ(bam1_t *b, char *ref, int thres) nogil
+  bam_header_t *bam_header_dup(bam_header_t *h0)
 
 
 #cdef extern from "glf.h":
@@ -367,7 +372,7 @@ cdef extern from "faidx.h":
    int faidx_fetch_nseq(faidx_t *fai)
 
    char *faidx_fetch_seq(faidx_t *fai, char *c_name, 
-                         int p_beg_i, int p_end_i, int *len)
+                         int p_beg_i, int p_end_i, int *len) nogil
 
 
 cdef extern from "pysam_util.h":
@@ -405,6 +410,125 @@ cdef extern from "pysam_util.h":
     uint32_t pysam_get_mapped( bam_index_t *idx, int tid )
     uint32_t pysam_get_unmapped( bam_index_t *idx, int tid )
 
+    # estimate cost of reading a region
+    int pysam_bam_index_estimate( bam_index_t *idx,
+                                  int tid, int beg, int end,
+                                  uint64_t *n_bytes, uint64_t *n_reads )
+
+    # position pileup engine without building columns
+    void pysam_bam_plp_set_start( bam_plp_t iter, int tid, int pos )
+    bam_pileup1_t * pysam_bam_plp_auto( bam_plp_t iter,
+                                        int *_tid,
+                                        int *_pos,
+                                        int *_n_plp,
+                                        int *skip ) nogil
+
+    # downsampling of reads before they enter the pileup engine
+    ctypedef struct pysam_downsample_t
+    pysam_downsample_t * pysam_downsample_init( bam_plp_auto_f func,
+                                                void *data,
+                                                int depth,
+                                                uint32_t seed,
+                                                int mask )
+    int pysam_downsample_read( void *data, bam1_t *b ) nogil
+    void pysam_downsample_set_mask( pysam_downsample_t *ds, int mask )
+    void pysam_downsample_reset( pysam_downsample_t *ds )
+    void pysam_downsample_destroy( pysam_downsample_t *ds )
+
+    # index of read names
+    ctypedef struct pysam_qname_entry_t:
+        uint64_t hash
+        uint64_t offset
+
+    ctypedef struct pysam_qname_index_t:
+        pysam_qname_entry_t * entries
+        size_t n
+
+    uint64_t pysam_qname_hash( char * s )
+    pysam_qname_index_t * pysam_qname_index_init()
+    void pysam_qname_index_add( pysam_qname_index_t * idx, uint64_t hash, uint64_t offset )
+    void pysam_qname_index_sort( pysam_qname_index_t * idx )
+    int pysam_qname_index_save( pysam_qname_index_t * idx, char * fn )
+    pysam_qname_index_t * pysam_qname_index_load( char * fn )
+    size_t pysam_qname_index_find( pysam_qname_index_t * idx, uint64_t hash, size_t * first )
+    void pysam_qname_index_destroy( pysam_qname_index_t * idx )
+    pysam_qname_index_t * pysam_qname_index_build( char * fn,
+                                                   bam_index_t * bam_idx,
+                                                   uint64_t start,
+                                                   int n_threads ) nogil
+
+    int pysam_bam_index_build( char * fn, char * fnidx, int n_threads ) nogil
+
+    # sorting
+    int PYSAM_SORT_COORDINATE
+    int PYSAM_SORT_QUERYNAME
+    int PYSAM_SORT_TAG
+    int pysam_bam_sort( char * fn, char * fnout, char * prefix,
+                        int by, char * tag, size_t max_mem, int n_threads,
+                        int level, int64_t * n_reads ) nogil
+
+    # duplicate marking
+    ctypedef struct pysam_markdup_stats_t:
+        int64_t n_reads
+        int64_t n_unmapped
+        int64_t n_secondary
+        int64_t n_unpaired
+        int64_t n_unpaired_dup
+        int64_t n_paired
+        int64_t n_paired_dup
+    int pysam_bam_markdup( char * fn, char * fnout, int32_t window, int remove,
+                           int n_threads, int level, pysam_markdup_stats_t * stats ) nogil
+
+    # copying regions and replacing headers
+    int pysam_bam_extract( char * fn, bam_index_t * idx, bam_header_t * header,
+                           char * fnout, int level, int * tids, int * begs,
+                           int * ends, int n, int64_t * n_copied ) nogil
+
+    int pysam_bam_replace_header( char * fn, char * fnout, bam_header_t * h,
+                                  int level, char * fnidx, char * fnidxout,
+                                  int64_t * n_copied ) nogil
+
+    # serialized records in memory
+    ctypedef struct pysam_buffer_t:
+        uint8_t * s
+        size_t l
+        size_t m
+    int pysam_buffer_add( pysam_buffer_t * buf, void * data, size_t len )
+    void pysam_buffer_free( pysam_buffer_t * buf )
+    int pysam_buffer_add_bam( pysam_buffer_t * buf, bam1_t * b )
+    void pysam_bam_serialize( bam1_t * b, uint8_t * dst )
+    int pysam_bam_deserialize( bam1_t * b, uint8_t * src, size_t len )
+    int pysam_buffer_add_header( pysam_buffer_t * buf, bam_header_t * h )
+    int pysam_buffer_compress_many( pysam_buffer_t ** src, pysam_buffer_t ** dst,
+                                    int n, int level, int n_threads ) nogil
+
+    # index building while writing
+    ctypedef struct pysam_index_writer_t
+    pysam_index_writer_t * pysam_index_writer_init( int n_targets, uint64_t offset )
+    int pysam_index_writer_push( pysam_index_writer_t * w, bam1_t * b, uint64_t offset ) nogil
+    int pysam_index_writer_save( pysam_index_writer_t * w, uint64_t offset, char * fnidx )
+    void pysam_index_writer_destroy( pysam_index_writer_t * w )
+
+    # lazily loaded index
+    bam_index_t * pysam_bam_index_load_lazy( char * fnidx )
+    int pysam_bam_index_load_tid( bam_index_t * idx, int tid )
+    int pysam_bam_index_load_counts( bam_index_t * idx, int tid )
+    void pysam_bam_index_destroy_lazy( bam_index_t * idx )
+
+    # file format detection and opening with a known header
+    int pysam_sniff_bam( char * fn )
+    samfile_t * pysam_samopen_with_header( char * fn,
+                                           bam_header_t * header,
+                                           int64_t offset )
+    samfile_t * pysam_samdopen( int fd, char * mode, bam_header_t * header ) nogil
+
+    # compute BAQ for a batch of reads using multiple threads
+    int pysam_bam_prob_realn_batch( bam1_t ** reads,
+                                    int n,
+                                    char * ref,
+                                    int flag,
+                                    int n_threads )
+
 #    uint32_t pysam_glf_depth( glf1_t * g )
 
 #    void pysam_dump_glf( glf1_t * g, bam_maqcns_t * c )
@@ -438,6 +562,42 @@ ctypedef struct __iterdata:
     int tid
     char * seq
     int seq_len
+    # flag passed to bam_prob_realn_core
+    int baq_flag
+    # reads are taken from the downsampler if set
+    pysam_downsample_t * downsampler
+
+####################################################################
+# C level callbacks
+#
+# Compiled extensions can process reads and pileup columns without
+# creating python objects by passing a callback to the foreach()
+# method of an iterator returned by Samfile.fetch() with a region
+# (IteratorRowRegion) or Samfile.pileup() with a region
+# (IteratorColumnRegion). Callbacks are called without the GIL.
+# They return 0 to continue and any other value to stop the
+# iteration. The data pointed to by *b* and *plp* is only valid
+# during the call.
+#
+# Example::
+#
+#    from pysam.csamtools cimport *
+#
+#    cdef int count_column( int tid, int pos, int n,
+#                           const_bam_pileup1_t_ptr plp,
+#                           void * data ) nogil:
+#        (<long*>data)[0] += n
+#        return 0
+#
+#    cdef long depth = 0
+#    cdef IteratorColumnRegion it = samfile.pileup( "chr1", 100, 200 )
+#    it.foreach( &count_column, &depth )
+ctypedef int (*fetch_cfunc)( bam1_t * b, void * data ) nogil
+ctypedef int (*pileup_cfunc)( int tid,
+                              int pos,
+                              int n,
+                              const_bam_pileup1_t_ptr plp,
+                              void * data ) nogil
 
 ####################################################################
 #
@@ -470,6 +630,25 @@ cdef class AlignedRead:
     # an existing tag of the same name will be replaced.
     cpdef setTag( self, tag, value, value_type = ?, replace = ? )
 
+cdef class _HeaderCacheEntry:
+    cdef bam_header_t * header
+    # virtual file offset after the header
+    cdef int64_t offset
+    cdef object references
+    cdef object lengths
+    cdef object tids
+    cdef object parsed
+
+cdef class Region:
+    cdef readonly object reference
+    cdef readonly int start
+    cdef readonly int end
+    # tid of reference in the file identified by _key
+    cdef object _key
+    cdef int _tid
+
+    cdef int _set( self, reference, long long rstart, long long rend ) except -1
+
 cdef class Samfile:
     cdef object _filename
     # pointer to samfile
@@ -482,6 +661,12 @@ cdef class Samfile:
     cdef int isstream
     # true if file is not on the local filesystem
     cdef int isremote
+    # true if index is loaded lazily
+    cdef int lazy_index
+    # index built while writing
+    cdef pysam_index_writer_t * index_writer
+    # thread serving a python file object
+    cdef object _pump
     # current read within iteration
     cdef bam1_t * b
     # file opening mode
@@ -490,6 +675,16 @@ cdef class Samfile:
     # beginning of read section
     cdef int64_t start_offset 
 
+    # cached header information, built on first access
+    cdef object _references
+    # identifies the open file in the tid cache of Region objects
+    cdef object _regionKey
+    cdef object _lengths
+    cdef object _tids
+    cdef object _header
+    # entry in the process level header cache
+    cdef _HeaderCacheEntry _headerEntry
+
     cdef bam_header_t * _buildHeader( self, new_header )
     cdef bam1_t * getCurrent( self )
     cdef int cnext(self)
@@ -498,6 +693,9 @@ cdef class Samfile:
     cpdef int write( self, AlignedRead read )
 
     cdef char * _getrname( self, int tid )
+    cdef int _prepareIndex( self, int tid ) except -1
+    cdef int _prepareCounts( self ) except -1
+    cdef samfile_t * _openFileObject( self, fileobj, bytes mode, bam_header_t * header )
 
 cdef class PileupProxy:
     cdef bam_pileup1_t ** plp
@@ -529,11 +727,14 @@ cdef class IteratorRowRegion(IteratorRow):
     cdef bam1_t * getCurrent( self )
 
     cdef int cnext(self)
+    cdef long foreach( self, fetch_cfunc func, void * data ) except -1
 
 cdef class IteratorRowAll(IteratorRow):
     cdef bam1_t * b
     cdef samfile_t * fp
     cdef int owns_samfile
+    # release the GIL while reading from a python file object
+    cdef int release_gil
     cdef bam1_t * getCurrent( self )
     cdef int cnext(self)
 
@@ -569,6 +770,14 @@ cdef class IteratorColumn:
     cdef Fastafile fastafile
     cdef stepper
     cdef int max_depth
+    cdef int compute_baq
+    cdef int redo_baq
+    cdef int extended_baq
+    cdef int downsample
+    cdef int downsample_seed
+    cdef pysam_downsample_t * downsampler
+    # true if the engine needs to be advanced to its start position
+    cdef int fastforward
 
     cdef int cnext(self)
     cdef char * getSequence( self )
@@ -585,6 +794,14 @@ cdef class IteratorColumnRegion(IteratorColumn):
     cdef int start
     cdef int end
     cdef int truncate
+    cdef int advance( self ) except -1
+    cdef long foreach( self, pileup_cfunc func, void * data ) except -1
+
+cdef class IteratorMultiColumn:
+    cdef object iterators
+    cdef int n
+    # per iterator: 1 = needs to advance, 0 = at column, -1 = finished
+    cdef int * status
 
 cdef class IteratorColumnAllRefs(IteratorColumn):
     pass
@@ -592,8 +809,38 @@ cdef class IteratorColumnAllRefs(IteratorColumn):
 cdef class IndexedReads:
     cdef Samfile samfile
     cdef samfile_t * fp
-    cdef index
+    # sorted (hash, file position) pairs, in memory or memory mapped
+    cdef pysam_qname_index_t * index
+    cdef int on_disk
+    cdef bytes index_filename
     # true if samfile belongs to this object
     cdef int owns_samfile
 
 
+
+cdef class _SplitOutput:
+    # uncompressed records not yet written
+    cdef pysam_buffer_t buffer
+    cdef object filename
+    # true once the file has been created
+    cdef int started
+
+cdef class SplitWriter:
+    cdef object references
+    # serialized header written at the start of each file
+    cdef bytes header
+    cdef object key
+    cdef int key_type
+    cdef object path_pattern
+    # key to _SplitOutput
+    cdef dict outputs
+    # file name to _SplitOutput, one per file
+    cdef dict files
+    # least recently used open file handles, None once closed
+    cdef object handles
+    cdef int max_open
+    cdef int threads
+    cdef int level
+    cdef size_t buffer_size
+    cdef size_t buffered
+    cdef object _getOutput( self, AlignedRead read )
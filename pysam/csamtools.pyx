@@ -12,6 +12,10 @@ import collections
 import re
 import platform
 import warnings
+import heapq
+import shutil
+import threading
+import errno
 from cpython cimport PyErr_SetString, PyBytes_Check, PyUnicode_Check, PyBytes_FromStringAndSize
 from cpython.version cimport PY_MAJOR_VERSION
 
@@ -118,6 +122,8 @@ DEF BAM_FSECONDARY   =256
 DEF BAM_FQCFAIL      =512
 ## @abstract optical or PCR duplicate */
 DEF BAM_FDUP        =1024
+## @abstract supplementary alignment */
+DEF BAM_FSUPPLEMENTARY =2048
 
 #####################################################################
 # CIGAR operations
@@ -648,10 +654,297 @@ cdef int mate_callback( bam1_t *alignment, void *f):
                  strcmp( bam1_qname( alignment ), d.name ) == 0:
              d.mate = bam_dup1( alignment )
 
+cdef AlignedRead _popMate( dict reads, qname, uint32_t flag ):
+    '''remove and return the first read in the list *reads[qname]*
+    that is the mate of a read with *flag*. Returns None if there
+    is none.'''
+    cdef AlignedRead read
+    cdef uint32_t x = BAM_FREAD1 | BAM_FREAD2
+    candidates = reads.get( qname )
+    if candidates is None: return None
+    for i, read in enumerate( candidates ):
+        if read._delegate.core.flag & x != flag & x:
+            del candidates[i]
+            if not candidates: del reads[qname]
+            return read
+    return None
+
+#------------------------------------------------------------------------
+#------------------------------------------------------------------------
+#------------------------------------------------------------------------
+cdef inline Py_ssize_t _parsePosition( char * s, Py_ssize_t x, Py_ssize_t l, long long * value ):
+    '''parse a position starting at *x* up to the next '-', ':' or *l*.
+
+    Commas are ignored. *value* is only set if there are digits.
+    Returns the position after the number or -1 if it is invalid.
+    '''
+    cdef long long v = 0
+    cdef int n = 0
+    while x < l and s[x] != c'-' and s[x] != c':':
+        if c'0' <= s[x] <= c'9':
+            v = v * 10 + (s[x] - c'0')
+            n += 1
+            if n > 12: return -1
+        elif s[x] != c',':
+            return -1
+        x += 1
+    if n > 0: value[0] = v
+    return x
+
+cdef inline int _parseInteger( char * s, Py_ssize_t x, Py_ssize_t l, long long * value ):
+    '''parse the non-negative integer in *s* from *x* up to *l*.
+
+    Returns -1 if it is invalid.
+    '''
+    cdef long long v = 0
+    if x == l or l - x > 12: return -1
+    while x < l:
+        if not c'0' <= s[x] <= c'9': return -1
+        v = v * 10 + (s[x] - c'0')
+        x += 1
+    value[0] = v
+    return 0
+
+cdef _parseRegionChars( char * s, Py_ssize_t l ):
+    '''parse a samtools :term:`region` string ``reference[:start[-end]]``
+    of length *l*. The reference ends at the first ':'.
+
+    returns a tuple of reference, start and end. Start and end
+    are python coordinates, end is *max_pos* if not given.
+    '''
+    cdef Py_ssize_t colon = 0
+    cdef Py_ssize_t x
+    cdef long long rstart = 1
+    cdef long long rend = max_pos
+
+    while colon < l and s[colon] != c':': colon += 1
+    if colon == l: return _forceStr( s[:l] ), 0, rend
+
+    x = _parsePosition( s, colon + 1, l, &rstart )
+    if 0 <= x < l:
+        x = _parsePosition( s, x + 1, l, &rend )
+    if x != l: raise ValueError( "invalid region `%s`" % _forceStr( s[:l] ) )
+
+    return _forceStr( s[:colon] ), rstart - 1, rend
+
+cdef _parseRegionString( region ):
+    '''parse a samtools :term:`region` string, see _parseRegionChars.'''
+    cdef bytes b = _forceBytes( region )
+    return _parseRegionChars( b, len(b) )
+
+cdef class Region:
+    '''*(reference, start = None, end = None)*
+
+    a :term:`region` that can be passed to :meth:`Samfile.fetch`,
+    :meth:`Samfile.pileup`, :meth:`Samfile.count` or
+    :meth:`Tabixfile.fetch` instead of *reference*, *start* and *end*.
+
+    If neither *start* nor *end* are given, *reference* is parsed as a
+    samtools :term:`region` string such as ``chr1:100-200``. Give
+    names containing ``:`` as *reference* with explicit coordinates.
+
+    The region is parsed once and the :term:`tid` is cached for the
+    file it was last used with, so repeated queries avoid both string
+    parsing and name lookups. Use :func:`parse_regions` to create many
+    regions at once.
+    '''
+
+    def __init__( self, reference, start = None, end = None ):
+        cdef long long rstart = 0
+        cdef long long rend = max_pos
+
+        if start is None and end is None:
+            reference, rstart, rend = _parseRegionString( reference )
+        else:
+            reference = _forceStr( reference )
+            if start is not None: rstart = start
+            if end is not None: rend = end
+
+        self._set( reference, rstart, rend )
+
+    cdef int _set( self, reference, long long rstart, long long rend ) except -1:
+        '''check and set coordinates.'''
+        if not reference: raise ValueError( "no reference given for region" )
+        if rstart > rend: raise ValueError( 'invalid coordinates: start (%i) > end (%i)' % (rstart, rend) )
+        if not 0 <= rstart < max_pos: raise ValueError( 'start out of range (%i)' % rstart )
+        if not 0 <= rend <= max_pos: raise ValueError( 'end out of range (%i)' % rend )
+
+        self.reference = reference
+        self.start = rstart
+        self.end = rend
+        self._key = None
+        self._tid = -1
+        return 0
+
+    def _getTid( self, key ):
+        '''return the :term:`tid` cached for *key*, -1 if not cached.
+
+        *key* identifies an open file, see Samfile._parseRegion.
+        '''
+        if key is not None and key is self._key: return self._tid
+        return -1
+
+    def _setTid( self, key, int tid ):
+        '''cache *tid* for *key*.'''
+        self._key = key
+        self._tid = tid
+
+    def __str__( self ):
+        if self.end == max_pos:
+            if self.start == 0: return self.reference
+            return "%s:%i" % (self.reference, self.start + 1)
+        return "%s:%i-%i" % (self.reference, self.start + 1, self.end)
+
+    def __repr__( self ):
+        return "Region(%r, %i, %i)" % (self.reference, self.start, self.end)
+
+def parse_regions( regions ):
+    '''*(regions)*
+
+    parse many :term:`region` definitions at once and return a list
+    of :class:`Region` objects.
+
+    *regions* is an iterable of samtools :term:`region` strings,
+    tab-separated :term:`BED` lines (0-based, only the first three
+    columns are used) or ``(reference, start, end)`` tuples. Empty
+    lines and ``#``, ``track`` and ``browser`` lines are skipped, so
+    an open BED file can be passed directly.
+    '''
+    cdef list result = []
+    cdef Region r
+    cdef bytes b
+    cdef char * s
+    cdef Py_ssize_t l, t1, t2, t3
+    cdef long long rstart, rend
+
+    for region in regions:
+        if isinstance( region, tuple ):
+            result.append( Region( *region ) )
+            continue
+
+        b = _forceBytes( region )
+        s = b
+        l = len(b)
+        while l > 0 and (s[l-1] == c'\n' or s[l-1] == c'\r'): l -= 1
+        if l == 0 or s[0] == c'#': continue
+        if (l > 5 and strncmp( s, "track", 5 ) == 0 and (s[5] == c' ' or s[5] == c'\t')) or \
+                (l > 7 and strncmp( s, "browser", 7 ) == 0 and s[7] == c' '):
+            continue
+
+        r = Region.__new__( Region )
+        t1 = 0
+        while t1 < l and s[t1] != c'\t': t1 += 1
+        if t1 == l:
+            reference, rstart, rend = _parseRegionChars( s, l )
+        else:
+            # BED line
+            t2 = t1 + 1
+            while t2 < l and s[t2] != c'\t': t2 += 1
+            t3 = t2 + 1
+            while t3 < l and s[t3] != c'\t': t3 += 1
+            if t2 >= l or \
+                    _parseInteger( s, t1 + 1, t2, &rstart ) < 0 or \
+                    _parseInteger( s, t2 + 1, t3, &rend ) < 0:
+                raise ValueError( "invalid BED line `%s`" % _forceStr( s[:l] ) )
+            reference = _forceStr( s[:t1] )
+        r._set( reference, rstart, rend )
+        result.append( r )
+
+    return result
+
+#------------------------------------------------------------------------
+#------------------------------------------------------------------------
+#------------------------------------------------------------------------
+cdef class _HeaderCacheEntry:
+    '''header of a :term:`BAM` file shared between :class:`Samfile` objects.'''
+
+    def __cinit__( self ):
+        self.header = NULL
+
+    def __dealloc__( self ):
+        if self.header != NULL: bam_header_destroy( self.header )
+
+# process level cache of BAM headers keyed by path, modification time,
+# size and inode. The least recently used entries are removed first.
+cdef int _HEADER_CACHE_SIZE = 64
+_header_cache = collections.OrderedDict()
+
+def clear_header_cache():
+    '''remove all headers from the process level cache, see the
+    *cache_header* option of :class:`Samfile`.
+    '''
+    _header_cache.clear()
+
+# size of chunks copied between python file objects and pipes
+cdef int _PUMP_CHUNK_SIZE = 1 << 20
+
+class _FilePump( threading.Thread ):
+    '''copy data between the python file object *fileobj* and the
+    file descriptor *fd* of a pipe in a background thread.
+
+    If *reading* is set, data is read from *fileobj* and written to
+    *fd*, otherwise data read from *fd* is written to *fileobj*.
+    Errors are stored in :attr:`error`. *fd* is closed at the end.
+    '''
+
+    def __init__( self, fileobj, fd, reading ):
+        threading.Thread.__init__( self )
+        self.daemon = True
+        self.fileobj = fileobj
+        self.fd = fd
+        self.reading = reading
+        self.error = None
+
+    def run( self ):
+        try:
+            if self.reading: self._fill()
+            else: self._drain()
+        finally:
+            os.close( self.fd )
+
+    def _fill( self ):
+        try:
+            while True:
+                data = self.fileobj.read( _PUMP_CHUNK_SIZE )
+                if not data: break
+                view = memoryview( data )
+                while len( view ):
+                    view = view[ os.write( self.fd, view ): ]
+        except OSError, e:
+            # the reading end has been closed
+            if e.errno != errno.EPIPE: self.error = e
+        except Exception, e:
+            self.error = e
+
+    def _drain( self ):
+        # keep reading after an error so that the writer does not block
+        while True:
+            data = os.read( self.fd, _PUMP_CHUNK_SIZE )
+            if not data: break
+            if self.error is None:
+                try:
+                    self.fileobj.write( data )
+                except Exception, e:
+                    self.error = e
+
+def _setPipeSize( fd ):
+    '''enlarge the buffer of pipe *fd* to reduce the number of
+    context switches (linux only).'''
+    if not sys.platform.startswith( "linux" ): return
+    try:
+        import fcntl
+        fcntl.fcntl( fd, getattr( fcntl, "F_SETPIPE_SZ", 1031 ), _PUMP_CHUNK_SIZE )
+    except (ImportError, IOError, OSError):
+        pass
+
+def _isFileObject( f ):
+    '''return True if *f* is a python file object and not a filename.'''
+    return hasattr( f, "read" ) or hasattr( f, "write" )
 
 cdef class Samfile:
     '''*(filename, mode=None, template = None, referencenames = None, referencelengths = None, text = NULL, header = None,
-         add_sq_text = False, check_header = True, check_sq = True )*
+         add_sq_text = False, check_header = True, check_sq = True, cache_header = False,
+         lazy_index = False, compresslevel = None, index = False )*
 
     A :term:`SAM`/:term:`BAM` formatted file. The file is automatically opened.
 
@@ -659,18 +952,33 @@ cdef class Samfile:
     (:term:`BAM`) I/O you should append ``b`` for compressed or ``u`` for uncompressed :term:`BAM` output.
     Use ``h`` to output header information in text (:term:`TAM`)  mode.
 
+    For :term:`BAM` output, the zlib compression level can be chosen by appending a digit
+    (``wb0`` to ``wb9``) or by setting *compresslevel* together with mode ``wb``. Low levels
+    such as ``wb1`` are much faster and useful for temporary files.
+
+    If *index* is set when writing a :term:`BAM` file, the index is built from the
+    positions of the reads as they are written and saved as ``<filename>.bai`` when the
+    file is closed. The reads need to be written in coordinate order, otherwise
+    :meth:`write` raises a ValueError and no index is saved.
+
     If ``b`` is present, it must immediately follow ``r`` or ``w``.
-    Valid modes are ``r``, ``w``, ``wh``, ``rb``, ``wb`` and ``wbu``. For instance, to open
+    Valid modes are ``r``, ``w``, ``wh``, ``rb``, ``wb``, ``wbu`` and ``wb0`` to ``wb9``. For instance, to open
     a :term:`BAM` formatted file for reading, type::
 
         f = pysam.Samfile('ex1.bam','rb')
 
-    If mode is not specified, we will try to auto-detect in the order 'rb', 'r', thus both the following
+    If mode is not specified, the format of a local file is detected from its first bytes. For streams
+    and remote files we will try to auto-detect in the order 'rb', 'r'. Thus both the following
     should work::
 
         f1 = pysam.Samfile('ex1.bam' )
         f2 = pysam.Samfile('ex1.sam' )
 
+    Instead of a filename, a python file object such as :class:`io.BytesIO` or a socket
+    file can be given to read (mode ``rb``) or write (mode ``wb``) :term:`BAM` formatted
+    data. Data is copied between the file object and an internal pipe in large chunks by a
+    background thread. File objects are streams and do not permit random access.
+
     If an index for a BAM file exists (.bai), it will be opened automatically. Without an index random
     access to reads via :meth:`fetch` and :meth:`pileup` is disabled.
 
@@ -693,6 +1001,17 @@ cdef class Samfile:
 
     By default, if file a file is opened in mode 'r', it is checked for a valid header
     (*check_header* = True) and a definition of chromosome names (*check_sq* = True). 
+
+    If *cache_header* is set, the header of a local :term:`BAM` file is kept in a process level cache
+    keyed by path, modification time and size. Subsequent opens of the same file with *cache_header*
+    copy the cached header instead of reading and parsing it and share the reference names and the
+    parsed :attr:`header`. See :func:`clear_header_cache`.
+
+    If *lazy_index* is set, the :term:`BAM` index is memory mapped and the bins and linear
+    index of a reference are only decoded the first time a region on that reference is
+    accessed. Read counts are decoded when :attr:`mapped`, :attr:`unmapped` or
+    :meth:`index_statistics` are first used. Opening takes the same time for any index
+    size, which makes files with large indices cheap if only a few references are queried.
     
     '''
 
@@ -714,6 +1033,50 @@ cdef class Samfile:
         '''return true if samfile has an existing (and opened) index.'''
         return self.index != NULL
 
+    cdef samfile_t * _openFileObject( self, fileobj, bytes mode, bam_header_t * header ):
+        '''open a pipe that is connected to *fileobj* by a background thread.'''
+        fd_read, fd_write = os.pipe()
+        _setPipeSize( fd_read )
+        reading = mode[:1] == b"r"
+        if reading:
+            self._pump = _FilePump( fileobj, fd_write, True )
+            fd = fd_read
+        else:
+            self._pump = _FilePump( fileobj, fd_read, False )
+            fd = fd_write
+        self._pump.start()
+
+        cdef samfile_t * fp
+        cdef int cfd = fd
+        cdef char * cmode = mode
+        with nogil:
+            fp = pysam_samdopen( cfd, cmode, header )
+        return fp
+
+    def _checkPump( self ):
+        '''raise an error if the thread serving a file object failed.'''
+        if self._pump is not None and self._pump.error is not None:
+            raise IOError( "error in file object: %s" % self._pump.error )
+
+    cdef int _prepareIndex( self, int tid ) except -1:
+        '''make sure the index for *tid* is loaded. If *tid* < 0,
+        load the index for all references.'''
+        cdef int ret
+        if self.lazy_index and self.index != NULL:
+            ret = pysam_bam_index_load_tid( self.index, tid )
+            if ret == -1:
+                raise ValueError( "invalid tid %i" % tid )
+            elif ret != 0:
+                raise IOError( "invalid or truncated index for `%s`" % _charptr_to_str( self._filename ) )
+        return 0
+
+    cdef int _prepareCounts( self ) except -1:
+        '''make sure the read counts of all references are loaded.'''
+        if self.lazy_index and self.index != NULL:
+            if pysam_bam_index_load_counts( self.index, -1 ) != 0:
+                raise IOError( "invalid or truncated index for `%s`" % _charptr_to_str( self._filename ) )
+        return 0
+
     def _open( self,
                filename,
                mode = None,
@@ -726,6 +1089,10 @@ cdef class Samfile:
                add_sq_text = True,
                check_header = True,
                check_sq = True,
+               cache_header = False,
+               lazy_index = False,
+               compresslevel = None,
+               index = False,
               ):
         '''open a sam/bam file.
 
@@ -733,39 +1100,78 @@ cdef class Samfile:
         closed and a new file will be opened.
         '''
 
+        # file objects can not be inspected without consuming data
+        if mode is None and _isFileObject( filename ):
+            mode = "rb"
+
         # read mode autodetection
         if mode is None:
-            try:
-                self._open(filename, 'rb', template=template,
-                           referencenames=referencenames,
-                           referencelengths=referencelengths,
-                           text=text, header=header, port=port,
-                           check_header=check_header,
-                           check_sq=check_sq)
-                return
-            except ValueError, msg:
-                pass
-
-            self._open(filename, 'r', template=template,
+            # check the magic bytes of local files
+            fn = _encodeFilename( filename )
+            is_bam = -1
+            if fn != b"-" and not fn.startswith(b"http:") and not fn.startswith(b"ftp:"):
+                is_bam = pysam_sniff_bam( fn )
+
+            if is_bam == 1:
+                mode = 'rb'
+            elif is_bam == 0:
+                mode = 'r'
+            else:
+                try:
+                    self._open(filename, 'rb', template=template,
+                               referencenames=referencenames,
+                               referencelengths=referencelengths,
+                               text=text, header=header, port=port,
+                               check_header=check_header,
+                               check_sq=check_sq,
+                               cache_header=cache_header,
+                               lazy_index=lazy_index)
+                    return
+                except ValueError, msg:
+                    pass
+                mode = 'r'
+
+            self._open(filename, mode, template=template,
                        referencenames=referencenames,
                        referencelengths=referencelengths,
                        text=text, header=header, port=port,
                        check_header=check_header,
-                       check_sq=check_sq)
+                       check_sq=check_sq,
+                       cache_header=cache_header,
+                       lazy_index=lazy_index)
             return
 
-        assert mode in ( "r","w","rb","wb", "wh", "wbu", "rU" ), "invalid file opening mode `%s`" % mode
+        if compresslevel is not None:
+            assert mode == "wb", "compresslevel requires mode `wb`"
+            assert 0 <= compresslevel <= 9, "invalid compresslevel `%s`" % compresslevel
+            mode = "wb%i" % compresslevel
+
+        assert mode in ( "r","w","rb","wb", "wh", "wbu", "rU" ) or \
+            ( len(mode) == 3 and mode[:2] == "wb" and mode[2] in "0123456789" ), \
+            "invalid file opening mode `%s`" % mode
+
+        self._clearHeaderCache()
 
         # close a previously opened file
         if self.samfile != NULL: self.close()
 
         cdef bam_header_t * header_to_write
         header_to_write = NULL
+        cdef _HeaderCacheEntry entry = None
+        cache_key = None
 
         cdef bytes bmode = mode.encode('ascii')
+        fileobj = None
+        if _isFileObject( filename ):
+            assert mode[1:2] == "b", "file objects require a bam mode, not `%s`" % mode
+            fileobj, filename = filename, "-"
         self._filename = filename = _encodeFilename(filename)
         self.isstream = filename == b"-"
 
+        if index:
+            assert mode[:2] == "wb", "index requires a bam output mode"
+            assert not self.isstream, "can not index a stream"
+
         self.isbam = len(mode) > 1 and mode[1] == 'b'
 
         self.isremote = filename.startswith(b"http:") or filename.startswith(b"ftp:")
@@ -826,21 +1232,44 @@ cdef class Samfile:
 
             # open file. Header gets written to file at the same time for bam files
             # and sam files (in the latter case, the mode needs to be wh)
-            self.samfile = samopen( filename, bmode, header_to_write )
+            if fileobj is not None:
+                self.samfile = self._openFileObject( fileobj, bmode, header_to_write )
+            else:
+                self.samfile = samopen( filename, bmode, header_to_write )
 
             # bam_header_destroy takes care of cleaning up of all the members
             if not template and header_to_write != NULL:
                 bam_header_destroy( header_to_write )
 
+            if index and self.samfile != NULL:
+                self.index_writer = pysam_index_writer_init( self.samfile.header.n_targets,
+                                                             bam_tell( self.samfile.x.bam ) )
+
         elif mode[0] == "r":
             # open file for reading
             if filename != b"-" and not self.isremote and not os.path.exists( filename ):
                 raise IOError( "file `%s` not found" % filename)
 
-            # try to detect errors
-            self.samfile = samopen( filename, bmode, NULL )
+            if cache_header and self.isbam and not self.isstream and not self.isremote:
+                st = os.stat( filename )
+                cache_key = ( os.path.abspath( filename ), st.st_mtime, st.st_size, st.st_ino )
+                entry = _header_cache.pop( cache_key, None )
+                if entry is not None:
+                    _header_cache[cache_key] = entry
+                    self.samfile = pysam_samopen_with_header( filename, entry.header, entry.offset )
+                    if self.samfile == NULL:
+                        raise IOError( "could not open file `%s`" % filename )
+
+            if self.samfile == NULL and fileobj is not None:
+                self.samfile = self._openFileObject( fileobj, bmode, NULL )
+                if self.samfile == NULL:
+                    raise ValueError( "could not read from file object - is it BAM format?" )
+
             if self.samfile == NULL:
-                raise ValueError( "could not open file (mode='%s') - is it SAM/BAM format?" % mode)
+                # try to detect errors
+                self.samfile = samopen( filename, bmode, NULL )
+                if self.samfile == NULL:
+                    raise ValueError( "could not open file (mode='%s') - is it SAM/BAM format?" % mode)
 
             # bam files require a valid header
             if self.isbam:
@@ -856,16 +1285,44 @@ cdef class Samfile:
             if check_sq and self.samfile.header.n_targets == 0:
                 raise ValueError( "file header is empty (mode='%s') - is it SAM/BAM format?" % mode)
 
+            if cache_key is not None:
+                if entry is None:
+                    entry = _HeaderCacheEntry()
+                    entry.header = bam_header_dup( self.samfile.header )
+                    entry.offset = bam_tell( self.samfile.x.bam )
+                    entry.references = self.references
+                    entry.lengths = self.lengths
+                    entry.tids = dict( [ (name, tid) for tid, name in enumerate( entry.references ) ] )
+                    _header_cache[cache_key] = entry
+                    if len( _header_cache ) > _HEADER_CACHE_SIZE:
+                        _header_cache.popitem( last = False )
+                self._headerEntry = entry
+                self._references = entry.references
+                self._lengths = entry.lengths
+                self._tids = entry.tids
+                self._header = entry.parsed
+
         if self.samfile == NULL:
             raise IOError("could not open file `%s`" % filename )
 
         # check for index and open if present
-        if mode[0] == "r" and self.isbam:
+        if mode[0] == "r" and self.isbam and fileobj is None:
 
             if not self.isremote:
-                if not os.path.exists(filename + b".bai") \
-                        and not os.path.exists( filename[:-4] + b".bai"):
+                if os.path.exists( filename + b".bai" ):
+                    fnidx = filename + b".bai"
+                elif os.path.exists( filename[:-4] + b".bai" ):
+                    fnidx = filename[:-4] + b".bai"
+                else:
+                    fnidx = None
+
+                if fnidx is None:
                     self.index = NULL
+                elif lazy_index:
+                    self.index = pysam_bam_index_load_lazy( fnidx )
+                    if self.index == NULL:
+                        raise IOError("error while opening index `%s` " % fnidx )
+                    self.lazy_index = True
                 else:
                     # returns NULL if there is no index or index could not be opened
                     self.index = bam_index_load(filename)
@@ -886,8 +1343,9 @@ cdef class Samfile:
         returns -1 if reference is not known.
         '''
         if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
-        reference = _forceBytes(reference)
-        return pysam_reference2tid( self.samfile.header, reference )
+        if self._tids is None:
+            self._tids = dict( [ (y, x) for x, y in enumerate( self.references ) ] )
+        return self._tids.get( _forceStr(reference), -1 )
 
     def getrname( self, tid ):
         '''
@@ -895,7 +1353,7 @@ cdef class Samfile:
         if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
         if not 0 <= tid < self.samfile.header.n_targets:
             raise ValueError( "tid %i out of range 0<=tid<%i" % (tid, self.samfile.header.n_targets ) )
-        return _charptr_to_str(self.samfile.header.target_name[tid])
+        return self.references[tid]
 
     cdef char * _getrname( self, int tid ): # TODO unused
         '''
@@ -920,13 +1378,25 @@ cdef class Samfile:
 
         Note that regions are 1-based, while start,end are python coordinates.
         '''
-        # This method's main objective is to translate from a reference to a tid.
-        # For now, it calls bam_parse_region, which is clumsy. Might be worth
-        # implementing it all in pysam (makes use of khash).
-
         cdef int rtid
         cdef long long rstart
         cdef long long rend
+        cdef Region r
+
+        if region is None and isinstance( reference, Region ):
+            region, reference = reference, None
+
+        if isinstance( region, Region ):
+            if reference is not None or start is not None or end is not None:
+                raise ValueError( "reference, start and end can not be combined with a Region" )
+            r = region
+            if self._regionKey is None: self._regionKey = object()
+            rtid = r._getTid( self._regionKey )
+            if rtid < 0:
+                rtid = self.gettid( r.reference )
+                if rtid < 0: raise ValueError( "invalid reference `%s`" % r.reference )
+                r._setTid( self._regionKey, rtid )
+            return 1, rtid, r.start, r.end
 
         rtid = -1
         rstart = 0
@@ -945,10 +1415,9 @@ cdef class Samfile:
 
         if region:
             region = _forceStr(region)
-            parts = re.split( "[:-]", region )
-            reference = parts[0]
-            if len(parts) >= 2: rstart = int(parts[1]) - 1
-            if len(parts) >= 3: rend = int(parts[2])
+            # reference names may contain ':'
+            if self.gettid( region ) >= 0: reference = region
+            else: reference, rstart, rend = _parseRegionString( region )
 
         if not reference: return 0, 0, 0, 0
 
@@ -998,8 +1467,8 @@ cdef class Samfile:
                until_eof = False ):
         '''
         fetch aligned reads in a :term:`region` using 0-based indexing. The region is specified by
-        :term:`reference`, *start* and *end*. Alternatively, a samtools :term:`region` string can
-        be supplied.
+        :term:`reference`, *start* and *end*. Alternatively, a samtools :term:`region` string or
+        a :class:`Region` can be supplied.
 
         Without *reference* or *region* all mapped reads will be fetched. The reads will be returned
         ordered by reference sequence, which will not necessarily be the order within the file.
@@ -1034,6 +1503,7 @@ cdef class Samfile:
             if callback:
                 if not has_coord: raise ValueError( "callback functionality requires a region/reference" )
                 if not self._hasIndex(): raise ValueError( "no index available for fetch" )
+                self._prepareIndex( rtid )
                 return bam_fetch(self.samfile.x.bam,
                                  self.index,
                                  rtid,
@@ -1096,6 +1566,7 @@ cdef class Samfile:
         cdef int x = BAM_FREAD1 + BAM_FREAD2
         mate_data.flag = ( flag ^ x) & x
 
+        self._prepareIndex( read._delegate.core.mtid )
         bam_fetch(self.samfile.x.bam,
                   self.index,
                   read._delegate.core.mtid,
@@ -1111,6 +1582,104 @@ cdef class Samfile:
         dest._delegate = mate_data.mate
         return dest
 
+    def fetch_pairs( self,
+                     reference = None,
+                     start = None,
+                     end = None,
+                     region = None,
+                     int max_gap = 1000 ):
+        '''*(reference = None, start = None, end = None, region = None, max_gap = 1000)*
+
+        iterate over read pairs in a :term:`region`. The region is
+        specified as in :meth:`fetch` and is required.
+
+        Yields tuples ``(read1, read2)`` of :class:`AlignedRead` objects
+        for each pair with at least one read in the region. Only primary
+        alignments of paired reads are considered and pairs for which
+        the mate can not be found are skipped. Reads that share their
+        name with another read of the same pair orientation are kept
+        apart and are paired in the order they appear.
+
+        The region is read only once. Reads are kept until their mate has
+        been seen or the file position has passed the mate position.
+        Mates outside the region are fetched at the end, sorted by
+        position. Mate positions closer than *max_gap* are fetched
+        together.
+
+        Reads with a mate outside the region are kept in memory until
+        the whole region has been read, so memory use grows with the
+        number of such reads. Use several smaller regions to limit it.
+        '''
+        cdef int rtid, rstart, rend, has_coord
+        cdef AlignedRead read, mate
+        cdef uint32_t flag
+
+        if not self._isOpen():
+            raise ValueError( "I/O operation on closed file" )
+
+        has_coord, rtid, rstart, rend = self._parseRegion( reference, start, end, region )
+        if not has_coord:
+            raise ValueError( "fetch_pairs requires a region/reference" )
+
+        # reads waiting for a mate within the region, by name
+        buffered = {}
+        # expected mate positions of buffered reads
+        expected = []
+        # reads with mates outside the region, by name
+        deferred = {}
+
+        for read in self.fetch( reference, start, end, region ):
+            flag = read._delegate.core.flag
+            if flag & BAM_FPAIRED == 0 or flag & (BAM_FSECONDARY | BAM_FSUPPLEMENTARY):
+                continue
+
+            # mates that should have been seen by now will be fetched later
+            while expected and expected[0][0] < read._delegate.core.pos:
+                qname = heapq.heappop( expected )[1]
+                if qname in buffered:
+                    deferred.setdefault( qname, [] ).extend( buffered.pop( qname ) )
+
+            qname = read.qname
+            mate = _popMate( buffered, qname, flag )
+            if mate is None: mate = _popMate( deferred, qname, flag )
+            if mate is not None:
+                if flag & BAM_FREAD1: yield read, mate
+                else: yield mate, read
+                continue
+
+            if read._delegate.core.mtid == rtid and \
+                    read._delegate.core.mpos >= read._delegate.core.pos and \
+                    read._delegate.core.mpos < rend:
+                buffered.setdefault( qname, [] ).append( read )
+                heapq.heappush( expected, (read._delegate.core.mpos, qname) )
+            else:
+                deferred.setdefault( qname, [] ).append( read )
+
+        for qname, reads in buffered.items():
+            deferred.setdefault( qname, [] ).extend( reads )
+        if not deferred: return
+
+        # fetch mates outside region, merging nearby positions
+        mpositions = sorted( set( [ (read._delegate.core.mtid, read._delegate.core.mpos)
+                                    for reads in deferred.values() 
+                                    for read in reads
+                                    if read._delegate.core.mtid >= 0 ] ) )
+        ranges = []
+        for mtid, mpos in mpositions:
+            if ranges and ranges[-1][0] == mtid and mpos - ranges[-1][2] < max_gap:
+                ranges[-1][2] = mpos + 1
+            else:
+                ranges.append( [mtid, mpos, mpos + 1] )
+
+        for mtid, mstart, mend in ranges:
+            for mate in IteratorRowRegion( self, mtid, mstart, mend ):
+                flag = mate._delegate.core.flag
+                if flag & (BAM_FSECONDARY | BAM_FSUPPLEMENTARY): continue
+                read = _popMate( deferred, mate.qname, flag )
+                if read is None: continue
+                if flag & BAM_FREAD1: yield mate, read
+                else: yield read, mate
+
     def count( self,
                reference = None,
                start = None,
@@ -1144,6 +1713,7 @@ cdef class Samfile:
             if not region:
                 raise ValueError( "counting functionality requires a region/reference" )
             if not self._hasIndex(): raise ValueError( "no index available for fetch" )
+            self._prepareIndex( rtid )
             bam_fetch(self.samfile.x.bam,
                              self.index,
                              rtid,
@@ -1155,6 +1725,123 @@ cdef class Samfile:
         else:
             raise ValueError ("count for a region is not available for sam files" )
 
+    def estimate( self,
+                  reference = None,
+                  start = None,
+                  end = None,
+                  region = None ):
+        '''*(reference = None, start = None, end = None, region = None)*
+
+        estimate the cost of reading a :term:`region` from the index
+        without reading any data. The region is specified as in :meth:`count`.
+
+        Returns a tuple ``(bytes, reads)`` with the approximate number of
+        compressed bytes that :meth:`fetch` would read and the approximate
+        number of reads in the region, scaled from the number of reads on the
+        :term:`reference`. Both are estimates; reads overlapping the region
+        boundaries and other reads in the same compressed blocks are included.
+        A region without any reads returns ``(0, 0)``.
+        '''
+        cdef int rtid
+        cdef int rstart
+        cdef int rend
+        cdef uint64_t n_bytes = 0
+        cdef uint64_t n_reads = 0
+
+        if not self._isOpen():
+            raise ValueError( "I/O operation on closed file" )
+        if not self.isbam: raise AttributeError( "Samfile.estimate only available in bam files" )
+
+        region, rtid, rstart, rend = self._parseRegion( reference, start, end, region )
+        if not region:
+            raise ValueError( "estimate requires a region/reference" )
+        if not self._hasIndex(): raise ValueError( "no index available for estimate" )
+
+        self._prepareIndex( rtid )
+        pysam_bam_index_estimate( self.index, rtid, rstart, rend, &n_bytes, &n_reads )
+        return n_bytes, n_reads
+
+    def extract( self, regions, output, compresslevel = None ):
+        '''*(regions, output, compresslevel = None)*
+
+        write all reads overlapping *regions* to the :term:`BAM` file
+        *output* with the header of this file.
+
+        *regions* is a :class:`Region`, a :term:`region` string or an
+        iterable accepted by :func:`parse_regions`. Overlapping regions
+        are merged and each read is written once, in the order of the
+        file.
+
+        Compressed blocks that lie within a region are copied without
+        inflating them. Only the blocks at the start and end of a region
+        are inflated, trimmed and compressed again with
+        *compresslevel*.
+
+        returns the number of compressed bytes copied unchanged.
+        '''
+        if not self._isOpen():
+            raise ValueError( "I/O operation on closed file" )
+        if not self.isbam or self.isremote or self._pump is not None:
+            raise ValueError( "extract is only available for local bam files" )
+        if not self._hasIndex(): raise ValueError( "no index available for extract" )
+
+        cdef int level = -1
+        if compresslevel is not None:
+            if not 0 <= compresslevel <= 9:
+                raise ValueError( "invalid compresslevel `%s`" % compresslevel )
+            level = compresslevel
+
+        if isinstance( regions, Region ) or PyBytes_Check( regions ) or PyUnicode_Check( regions ):
+            regions = [regions]
+        spans = []
+        for region in regions:
+            if not isinstance( region, Region ):
+                region = parse_regions( [region] )
+                if not region: continue
+                region = region[0]
+            has_coord, rtid, rstart, rend = self._parseRegion( region = region )
+            spans.append( [rtid, rstart, rend] )
+
+        # merge overlapping regions
+        spans.sort()
+        merged = []
+        for span in spans:
+            if merged and merged[-1][0] == span[0] and span[1] <= merged[-1][2]:
+                merged[-1][2] = max( merged[-1][2], span[2] )
+            else:
+                merged.append( span )
+
+        cdef int n = len( merged )
+        cdef int * tids = <int*>calloc( n + 1, sizeof(int) )
+        cdef int * begs = <int*>calloc( n + 1, sizeof(int) )
+        cdef int * ends = <int*>calloc( n + 1, sizeof(int) )
+        cdef int x, ret
+        cdef int64_t n_copied = 0
+        for x from 0 <= x < n:
+            tids[x], begs[x], ends[x] = merged[x]
+            self._prepareIndex( tids[x] )
+
+        filename = _encodeFilename( self._filename )
+        output = _encodeFilename( output )
+        cdef char * fn = filename
+        cdef char * fnout = output
+        try:
+            with nogil:
+                ret = pysam_bam_extract( fn, self.index, self.samfile.header, fnout, level,
+                                         tids, begs, ends, n, &n_copied )
+        finally:
+            free( tids )
+            free( begs )
+            free( ends )
+
+        if ret == -1:
+            raise IOError( "could not open file `%s`" % _charptr_to_str( filename ) )
+        elif ret == -2:
+            raise IOError( "error while reading `%s` - truncated file?" % _charptr_to_str( filename ) )
+        elif ret != 0:
+            raise IOError( "error while writing `%s`" % _charptr_to_str( output ) )
+        return n_copied
+
     def pileup( self,
                 reference = None,
                 start = None,
@@ -1197,10 +1884,32 @@ cdef class Samfile:
          max_depth
            Maximum read depth permitted. The default limit is *8000*.
 
+         downsample
+           Downsample reads to this depth before they enter the pileup
+           engine. Reads are selected by a hash of the read name.
+           Both reads of a pair are not necessarily kept together.
+           The default is 0 (no downsampling).
+
+         downsample_seed
+           Seed for the read selection when downsampling. The default is 0.
+
+         compute_baq
+           Apply base alignment qualities (BAQ) in the ``samtools`` stepper.
+           The default is True.
+
+         redo_baq
+           Recompute BAQ even if a read has a ``BQ`` tag. By default,
+           base alignment qualities stored by :func:`compute_baq`
+           are used instead of recomputing them.
+
+         extended_baq
+           Compute extended BAQ as ``samtools mpileup -E`` does, which
+           is more sensitive but less specific. The default is False.
+
          truncate
            By default, the samtools pileup engine outputs all reads overlapping a region (see note below).
            If truncate is True and a region is given, only output columns in the exact region
-           specificied.
+           specificied. Columns outside the region are not computed.
 
         .. note::
 
@@ -1222,6 +1931,7 @@ cdef class Samfile:
             if callback:
                 if not has_coord: raise ValueError( "callback functionality requires a region/reference" )
 
+                self._prepareIndex( rtid )
                 buf = bam_plbuf_init( <bam_pileup_f>pileup_callback, <void*>callback )
                 bam_fetch(self.samfile.x.bam,
                           self.index, rtid, rstart, rend,
@@ -1246,10 +1956,54 @@ cdef class Samfile:
     def close( self ):
         '''
         closes the :class:`pysam.Samfile`.'''
+        cdef int ret = 0
+        pump = self._pump
+        if self.index_writer != NULL:
+            # flush all data. Like samtools, the index ends after
+            # the 28 byte EOF marker that is written on closing.
+            bgzf_flush( self.samfile.x.bam )
+            tmpfilename = self._filename + (".%i.tmp" % os.getpid()).encode( "ascii" )
+            ret = pysam_index_writer_save( self.index_writer,
+                                           bam_tell( self.samfile.x.bam ) + (28 << 16),
+                                           tmpfilename )
+            pysam_index_writer_destroy( self.index_writer )
+            self.index_writer = NULL
+            if ret == 0:
+                os.rename( tmpfilename, self._filename + b".bai" )
+            elif os.path.exists( tmpfilename ):
+                os.unlink( tmpfilename )
+
         if self.samfile != NULL:
-            samclose( self.samfile )
-            bam_index_destroy(self.index);
+            if pump is not None:
+                with nogil:
+                    samclose( self.samfile )
+            else:
+                samclose( self.samfile )
+            if self.lazy_index: pysam_bam_index_destroy_lazy( self.index )
+            else: bam_index_destroy( self.index )
+            self.index = NULL
+            self.lazy_index = False
             self.samfile = NULL
+        self._clearHeaderCache()
+
+        if pump is not None:
+            self._pump = None
+            # wait until all data has been written
+            if not pump.reading: pump.join()
+            if pump.error is not None:
+                raise IOError( "error in file object: %s" % pump.error )
+
+        if ret == -3:
+            raise IOError( "could not write index for `%s`" % _charptr_to_str( self._filename ) )
+
+    def _clearHeaderCache( self ):
+        '''discard header information cached from the current file.'''
+        self._references = None
+        self._lengths = None
+        self._tids = None
+        self._header = None
+        self._headerEntry = None
+        self._regionKey = None
 
     def __dealloc__( self ):
         # remember: dealloc cannot call other methods
@@ -1267,7 +2021,82 @@ cdef class Samfile:
         if not self._isOpen():
             return 0
 
-        return samwrite( self.samfile, read._delegate )
+        cdef int ret
+        cdef bam1_t * b = read._delegate
+        if self._pump is None:
+            ret = samwrite( self.samfile, b )
+        else:
+            with nogil:
+                ret = samwrite( self.samfile, b )
+        if self.index_writer != NULL and \
+                pysam_index_writer_push( self.index_writer,
+                                         read._delegate,
+                                         bam_tell( self.samfile.x.bam ) ) != 0:
+            raise ValueError( "can not build index, reads are not sorted by coordinate: %s" % read.qname )
+        return ret
+
+    def write_many( self, reads, int batch_size = 1024 ):
+        '''write all :class:`pysam.AlignedRead` objects in iterable *reads* to disk.
+
+        Reads are collected in batches of *batch_size* and each batch is
+        written with the GIL released, so that other threads can produce
+        reads while the current batch is being compressed. The file must
+        not be written to from another thread at the same time.
+
+        returns the number of bytes written.
+        '''
+        if not self._isOpen():
+            return 0
+        if batch_size <= 0:
+            raise ValueError( "batch_size must be positive" )
+
+        cdef bam1_t ** buffer = <bam1_t**>calloc( batch_size, sizeof(bam1_t*) )
+        if buffer == NULL:
+            raise MemoryError( "could not allocate buffer of %i reads" % batch_size )
+
+        cdef AlignedRead read
+        cdef int n = 0
+        cdef int i, ret
+        cdef long total = 0
+        # references to keep reads in the current batch alive
+        cdef list batch = []
+
+        try:
+            it = iter( reads )
+            while True:
+                n = 0
+                del batch[:]
+                for x in it:
+                    if not isinstance( x, AlignedRead ):
+                        raise TypeError( "expected AlignedRead, got %s" % type(x) )
+                    read = x
+                    buffer[n] = read._delegate
+                    batch.append( read )
+                    n += 1
+                    if n == batch_size: break
+                if n == 0: break
+
+                ret = 0
+                with nogil:
+                    for i from 0 <= i < n:
+                        ret = samwrite( self.samfile, buffer[i] )
+                        if ret < 0: break
+                        total += ret
+                        if self.index_writer != NULL and \
+                                pysam_index_writer_push( self.index_writer,
+                                                         buffer[i],
+                                                         bam_tell( self.samfile.x.bam ) ) != 0:
+                            ret = -2
+                            break
+                if ret == -2:
+                    raise ValueError( "can not build index, reads are not sorted by coordinate: %s" % batch[i].qname )
+                elif ret < 0:
+                    raise IOError( "error while writing to %s" % self.filename )
+                if n < batch_size: break
+        finally:
+            free( buffer )
+
+        return total
 
     def __enter__(self):
         return self
@@ -1296,10 +2125,12 @@ cdef class Samfile:
         """tuple with the names of :term:`reference` sequences."""
         def __get__(self):
             if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
-            t = []
-            for x from 0 <= x < self.samfile.header.n_targets:
-                t.append( _charptr_to_str(self.samfile.header.target_name[x]) )
-            return tuple(t)
+            if self._references is None:
+                t = []
+                for x from 0 <= x < self.samfile.header.n_targets:
+                    t.append( _charptr_to_str(self.samfile.header.target_name[x]) )
+                self._references = tuple(t)
+            return self._references
 
     property lengths:
         """tuple of the lengths of the :term:`reference` sequences. The lengths are in the same order as
@@ -1307,10 +2138,12 @@ cdef class Samfile:
         """
         def __get__(self):
             if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
-            t = []
-            for x from 0 <= x < self.samfile.header.n_targets:
-                t.append( self.samfile.header.target_len[x] )
-            return tuple(t)
+            if self._lengths is None:
+                t = []
+                for x from 0 <= x < self.samfile.header.n_targets:
+                    t.append( self.samfile.header.target_len[x] )
+                self._lengths = tuple(t)
+            return self._lengths
 
     property mapped:
         """total number of mapped reads in file.
@@ -1321,6 +2154,7 @@ cdef class Samfile:
             if self.index == NULL:
                 raise ValueError( "mapping information not recorded in index or index not available")
 
+            self._prepareCounts()
             cdef int tid
             cdef uint32_t total = 0
             for tid from 0 <= tid < self.samfile.header.n_targets:
@@ -1333,6 +2167,7 @@ cdef class Samfile:
         def __get__(self):
             if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
             if not self.isbam: raise AttributeError( "Samfile.unmapped only available in bam files" )
+            self._prepareCounts()
             cdef int tid
             cdef uint32_t total = 0
             for tid from 0 <= tid < self.samfile.header.n_targets:
@@ -1341,6 +2176,58 @@ cdef class Samfile:
             total += pysam_get_unmapped( self.index, -1 )
             return total
 
+    def index_statistics( self ):
+        '''return mapping statistics per :term:`reference` from the index.
+
+        Returns a list of tuples ``(reference, length, mapped, unmapped)``,
+        one per reference in the same order as :attr:`references`. The
+        final tuple ``("*", 0, 0, unmapped)`` contains the number of
+        unmapped reads without coordinates. This is equivalent to
+        ``samtools idxstats``, but no data is read from the file.
+
+        To obtain a numpy array, use ``numpy.array( stats, dtype = [
+        ("reference", "S64"), ("length", "i8"), ("mapped", "i8"),
+        ("unmapped", "i8") ] )``.
+        '''
+        if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
+        if not self.isbam: raise AttributeError( "Samfile.index_statistics only available in bam files" )
+        if self.index == NULL:
+            raise ValueError( "mapping information not recorded in index or index not available")
+
+        self._prepareCounts()
+        cdef int tid
+        result = []
+        for tid from 0 <= tid < self.samfile.header.n_targets:
+            result.append( (_charptr_to_str( self.samfile.header.target_name[tid] ),
+                            self.samfile.header.target_len[tid],
+                            pysam_get_mapped( self.index, tid ),
+                            pysam_get_unmapped( self.index, tid ) ) )
+        result.append( ("*", 0, 0, pysam_get_unmapped( self.index, -1 ) ) )
+        return result
+
+    def build_index( self, int threads = 1 ):
+        '''*(threads = 1)*
+
+        build the index for this :term:`BAM` file and load it.
+
+        See :func:`build_index`. The index is written to
+        ``<filename>.bai`` atomically, replacing an existing index.
+        '''
+        if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
+        if not self.isbam: raise AttributeError( "Samfile.build_index only available in bam files" )
+        if self.isremote or self.isstream:
+            raise ValueError( "can only build an index for a local file" )
+
+        build_index( self._filename, threads = threads )
+
+        cdef bam_index_t * idx = bam_index_load( self._filename )
+        if idx == NULL:
+            raise IOError( "error while opening index `%s` " % _charptr_to_str( self._filename ) )
+        if self.lazy_index: pysam_bam_index_destroy_lazy( self.index )
+        elif self.index != NULL: bam_index_destroy( self.index )
+        self.index = idx
+        self.lazy_index = False
+
     property text:
         '''full contents of the :term:`sam file` header as a string.'''
         def __get__(self):
@@ -1350,64 +2237,84 @@ cdef class Samfile:
     property header:
         '''header information within the :term:`sam file`. The records and fields are returned as
         a two-level dictionary.
+
+        The header is parsed on first access and cached. Each access returns
+        a copy that can be modified without affecting the cache.
         '''
         def __get__(self):
             if not self._isOpen(): raise ValueError( "I/O operation on closed file" )
 
-            result = {}
-            
-            if self.samfile.header.text != NULL:
-                # convert to python string (note: call self.text to create 0-terminated string)
-                t = self.text
-                for line in t.split("\n"):
-                    if not line.strip(): continue
-                    assert line.startswith("@"), "header line without '@': '%s'" % line
-                    fields = line[1:].split("\t")
-                    record = fields[0]
-                    assert record in VALID_HEADER_TYPES, "header line with invalid type '%s': '%s'" % (record, line)
-
-                    # treat comments
-                    if record == "CO":
-                        if record not in result: result[record] = []
-                        result[record].append( "\t".join( fields[1:] ) )
-                        continue
-                    # the following is clumsy as generators do not work?
-                    x = {}
-                    for field in fields[1:]:
-                        if ":" not in field: 
-                            raise ValueError("malformatted header: no ':' in field" )
-                        key, value = field.split(":",1)
-                        # uppercase keys must be valid
-                        # lowercase are permitted for user fields
-                        if key in VALID_HEADER_FIELDS[record]:
-                            x[key] = VALID_HEADER_FIELDS[record][key](value)
-                        elif not key.isupper():
-                            x[key] = value
-                        else:
-                            raise ValueError( "unknown field code '%s' in record '%s'" % (key, record) )
-
-                    if VALID_HEADER_TYPES[record] == dict:
-                        if record in result:
-                            raise ValueError( "multiple '%s' lines are not permitted" % record )
-                        result[record] = x
-                    elif VALID_HEADER_TYPES[record] == list:
-                        if record not in result: result[record] = []
-                        result[record].append( x )
-
-                # if there are no SQ lines in the header, add the reference names
-                # from the information in the bam file.
-                # Background: c-samtools keeps the textual part of the header separate from
-                # the list of reference names and lengths. Thus, if a header contains only 
-                # SQ lines, the SQ information is not part of the textual header and thus
-                # are missing from the output. See issue 84.
-                if "SQ" not in result:
-                    sq = []
-                    for ref, length in zip( self.references, self.lengths ):
-                        sq.append( {'LN': length, 'SN': ref } )
-                    result["SQ"] = sq
+            if self._header is None:
+                self._header = self._parseHeader()
+                if self._headerEntry is not None:
+                    self._headerEntry.parsed = self._header
 
+            result = {}
+            for record, value in self._header.items():
+                if record == "CO":
+                    result[record] = list( value )
+                elif VALID_HEADER_TYPES[record] == dict:
+                    result[record] = dict( value )
+                else:
+                    result[record] = [ dict( x ) for x in value ]
             return result
 
+    def _parseHeader( self ):
+        '''parse the header text into a two-level dictionary.'''
+        result = {}
+        
+        if self.samfile.header.text != NULL:
+            # convert to python string (note: call self.text to create 0-terminated string)
+            t = self.text
+            for line in t.split("\n"):
+                if not line.strip(): continue
+                assert line.startswith("@"), "header line without '@': '%s'" % line
+                fields = line[1:].split("\t")
+                record = fields[0]
+                assert record in VALID_HEADER_TYPES, "header line with invalid type '%s': '%s'" % (record, line)
+
+                # treat comments
+                if record == "CO":
+                    if record not in result: result[record] = []
+                    result[record].append( "\t".join( fields[1:] ) )
+                    continue
+                # the following is clumsy as generators do not work?
+                x = {}
+                for field in fields[1:]:
+                    if ":" not in field: 
+                        raise ValueError("malformatted header: no ':' in field" )
+                    key, value = field.split(":",1)
+                    # uppercase keys must be valid
+                    # lowercase are permitted for user fields
+                    if key in VALID_HEADER_FIELDS[record]:
+                        x[key] = VALID_HEADER_FIELDS[record][key](value)
+                    elif not key.isupper():
+                        x[key] = value
+                    else:
+                        raise ValueError( "unknown field code '%s' in record '%s'" % (key, record) )
+
+                if VALID_HEADER_TYPES[record] == dict:
+                    if record in result:
+                        raise ValueError( "multiple '%s' lines are not permitted" % record )
+                    result[record] = x
+                elif VALID_HEADER_TYPES[record] == list:
+                    if record not in result: result[record] = []
+                    result[record].append( x )
+
+            # if there are no SQ lines in the header, add the reference names
+            # from the information in the bam file.
+            # Background: c-samtools keeps the textual part of the header separate from
+            # the list of reference names and lengths. Thus, if a header contains only 
+            # SQ lines, the SQ information is not part of the textual header and thus
+            # are missing from the output. See issue 84.
+            if "SQ" not in result:
+                sq = []
+                for ref, length in zip( self.references, self.lengths ):
+                    sq.append( {'LN': length, 'SN': ref } )
+                result["SQ"] = sq
+
+        return result
+
     def _buildLine( self, fields, record ):
         '''build a header line from *fields* dictionary for *record*'''
 
@@ -1522,17 +2429,21 @@ cdef class Samfile:
         cversion of iterator. Used by :class:`pysam.Samfile.IteratorColumn`.
         '''
         cdef int ret
-        return samread(self.samfile, self.b)
+        if self._pump is None:
+            return samread(self.samfile, self.b)
+        with nogil:
+            ret = samread(self.samfile, self.b)
+        return ret
 
     def __next__(self):
         """
         python version of next().
         """
-        cdef int ret
-        ret = samread(self.samfile, self.b)
+        cdef int ret = self.cnext()
         if (ret > 0):
             return makeAlignedRead( self.b )
         else:
+            self._checkPump()
             raise StopIteration
 
 ##-------------------------------------------------------------------
@@ -1615,6 +2526,7 @@ cdef class IteratorRowRegion(IteratorRow):
 
         self.retval = 0
 
+        samfile._prepareIndex( tid )
         self.iter = bam_iter_query(self.samfile.index,
                                    tid,
                                    beg,
@@ -1633,6 +2545,29 @@ cdef class IteratorRowRegion(IteratorRow):
                                      self.iter,
                                      self.b)
 
+    cdef long foreach( self, fetch_cfunc func, void * data ) except -1:
+        '''call *func* for each remaining read.
+
+        *func* is called without the GIL and with *data* as its
+        second argument. Iteration stops early if *func* returns a
+        non-zero value.
+
+        returns the number of reads passed to *func*.
+        '''
+        cdef long n = 0
+        with nogil:
+            while 1:
+                self.retval = bam_iter_read( self.fp.x.bam,
+                                             self.iter,
+                                             self.b )
+                if self.retval < 0: break
+                n += 1
+                if func( self.b, data ) != 0: break
+
+        if self.retval < -1:
+            raise IOError( "truncated file" )
+        return n
+
     def __next__(self):
         """python version of next().
         """
@@ -1677,6 +2612,7 @@ cdef class IteratorRowAll(IteratorRow):
         else:
             self.fp = samfile.samfile
             self.owns_samfile = False
+            self.release_gil = samfile._pump is not None
 
         # allocate memory for alignment
         self.b = <bam1_t*>calloc(1, sizeof(bam1_t))
@@ -1689,7 +2625,12 @@ cdef class IteratorRowAll(IteratorRow):
 
     cdef int cnext(self):
         '''cversion of iterator. Used by IteratorColumn'''
-        return samread(self.fp, self.b)
+        cdef int ret
+        if not self.release_gil:
+            return samread(self.fp, self.b)
+        with nogil:
+            ret = samread(self.fp, self.b)
+        return ret
 
     def __next__(self):
         """python version of next().
@@ -1697,7 +2638,7 @@ cdef class IteratorRowAll(IteratorRow):
         pyrex uses this non-standard name instead of next()
         """
         cdef int ret
-        ret = samread(self.fp, self.b)
+        ret = self.cnext()
         if (ret > 0):
             return makeAlignedRead( self.b )
         else:
@@ -1825,61 +2766,84 @@ cdef class IteratorRowSelection(IteratorRow):
 ##-------------------------------------------------------------------
 ##-------------------------------------------------------------------
 ##-------------------------------------------------------------------
-cdef int __advance_all( void * data, bam1_t * b ):
+cdef int __advance_all( void * data, bam1_t * b ) nogil:
     '''advance without any read filtering.
     '''
     cdef __iterdata * d
     d = <__iterdata*>data
     return bam_iter_read( d.samfile.x.bam, d.iter, b )
 
-cdef int __advance_snpcalls( void * data, bam1_t * b ):
+cdef inline int __read_snpcalls( __iterdata * d, bam1_t * b ) nogil:
+    '''read the next alignment that is not skipped by the samtools
+    pileup because of its flags.
+    '''
+    cdef int ret = bam_iter_read( d.samfile.x.bam, d.iter, b )
+    while ret >= 0:
+        if b.core.flag & BAM_FUNMAP: pass
+        elif b.core.flag & 1 and not b.core.flag & 2: pass
+        else: break
+        ret = bam_iter_read( d.samfile.x.bam, d.iter, b )
+    return ret
+
+cdef int __advance_snpcalls_flags( void * data, bam1_t * b ) nogil:
+    '''advance using the flag filters of the samtools pileup only.
+
+    Used as the input of the downsampler, so that reads are sampled
+    before the more expensive read processing.
+    '''
+    return __read_snpcalls( <__iterdata*>data, b )
+
+cdef int __advance_snpcalls( void * data, bam1_t * b ) nogil:
     '''advance using same filter and read processing as in
     the samtools pileup.
     '''
     cdef __iterdata * d
     d = <__iterdata*>data
 
-    cdef int ret = bam_iter_read( d.samfile.x.bam, d.iter, b )
+    cdef int ret
     cdef int skip = 0
     cdef int q
     cdef int is_cns = 1
-    cdef int is_nobaq = 0
+    cdef int is_nobaq = d.baq_flag < 0
     cdef int capQ_thres = 0
 
-    # reload sequence
-    if d.fastafile != NULL and b.core.tid != d.tid:
-        if d.seq != NULL: free(d.seq)
-        d.tid = b.core.tid
-        d.seq = faidx_fetch_seq(d.fastafile,
-                                d.samfile.header.target_name[d.tid],
-                                0, max_pos,
-                                &d.seq_len)
-        if d.seq == NULL:
-            raise ValueError( "reference sequence for '%s' (tid=%i) not found" % \
-                                  (d.samfile.header.target_name[d.tid],
-                                   d.tid))
-
-
-    while ret >= 0:
+    while 1:
+        if d.downsampler != NULL:
+            ret = pysam_downsample_read( d.downsampler, b )
+        else:
+            ret = __read_snpcalls( d, b )
+        if ret < 0: break
+
+        # reload sequence
+        if d.fastafile != NULL and b.core.tid != d.tid:
+            if d.seq != NULL: free(d.seq)
+            d.tid = b.core.tid
+            d.seq = faidx_fetch_seq(d.fastafile,
+                                    d.samfile.header.target_name[d.tid],
+                                    0, max_pos,
+                                    &d.seq_len)
+            if d.seq == NULL:
+                with gil:
+                    raise ValueError( "reference sequence for '%s' (tid=%i) not found" % \
+                                          (d.samfile.header.target_name[d.tid],
+                                           d.tid))
 
         skip = 0
 
-        # realign read - changes base qualities
+        # realign read - changes base qualities. If the read
+        # contains a BQ tag, the stored BAQ values are applied
+        # instead of recomputing them unless redo_baq is set.
         if d.seq != NULL and is_cns and not is_nobaq: 
-            bam_prob_realn( b, d.seq )
+            bam_prob_realn_core( b, d.seq, d.baq_flag )
 
         if d.seq != NULL and capQ_thres > 10:
             q = bam_cap_mapQ(b, d.seq, capQ_thres)
             if q < 0: skip = 1
             elif b.core.qual > q: b.core.qual = q
-        if b.core.flag & BAM_FUNMAP: skip = 1
-        elif b.core.flag & 1 and not b.core.flag & 2: skip = 1
 
         if not skip: break
         # additional filters
 
-        ret = bam_iter_read( d.samfile.x.bam, d.iter, b )
-
     return ret
 
 cdef class IteratorColumn:
@@ -1927,6 +2891,26 @@ cdef class IteratorColumn:
        Skip all reads with bits set in mask.
     max_depth
        maximum read depth. The default is 8000.
+    downsample
+       downsample reads to this depth before they enter the pileup
+       engine. Reads are grouped by start position and from each group
+       reads are selected by a hash of the read name. As the number of
+       reads kept differs between groups, the two reads of a pair are
+       not necessarily kept together. Unlike *max_depth*, which keeps
+       the first reads, this gives an unbiased sample. With
+       the ``samtools`` stepper, BAQ is only computed for the reads that
+       are kept. Note that *max_depth* still applies. The default is 0
+       (no downsampling).
+    downsample_seed
+       seed for the read selection in downsampling. The default is 0.
+    compute_baq
+       apply base alignment qualities (BAQ) in the ``samtools``
+       stepper. The default is True.
+    redo_baq
+       recompute BAQ even if a read contains a ``BQ`` tag
+       (see :func:`compute_baq`). The default is False.
+    extended_baq
+       use extended BAQ. The default is False.
     '''
 
     def __cinit__( self, Samfile samfile, **kwargs ):
@@ -1935,12 +2919,19 @@ cdef class IteratorColumn:
         self.fastafile = kwargs.get( "fastafile", None )
         self.stepper = kwargs.get( "stepper", None )
         self.max_depth = kwargs.get( "max_depth", 8000 )
+        self.downsample = kwargs.get( "downsample", 0 )
+        self.downsample_seed = kwargs.get( "downsample_seed", 0 )
+        self.downsampler = NULL
+        self.compute_baq = kwargs.get( "compute_baq", True )
+        self.redo_baq = kwargs.get( "redo_baq", False )
+        self.extended_baq = kwargs.get( "extended_baq", False )
         self.iterdata.seq = NULL
         self.tid = 0
         self.pos = 0
         self.n_plp = 0
         self.plp = NULL
         self.pileup_iter = <bam_plp_t>NULL
+        self.fastforward = 0
 
     def __iter__(self):
         return self
@@ -1948,10 +2939,11 @@ cdef class IteratorColumn:
     cdef int cnext(self):
         '''perform next iteration.
         '''
-        self.plp = bam_plp_auto( self.pileup_iter,
-                                 &self.tid,
-                                 &self.pos,
-                                 &self.n_plp )
+        self.plp = pysam_bam_plp_auto( self.pileup_iter,
+                                       &self.tid,
+                                       &self.pos,
+                                       &self.n_plp,
+                                       &self.fastforward )
 
     cdef char * getSequence( self ):
         '''return current reference sequence underlying the iterator.
@@ -1982,6 +2974,8 @@ cdef class IteratorColumn:
         '''
         self.mask = mask
         bam_plp_set_mask( self.pileup_iter, self.mask )
+        if self.downsampler != NULL:
+            pysam_downsample_set_mask( self.downsampler, self.mask )
 
     cdef setupIteratorData( self,
                             int tid,
@@ -2001,13 +2995,45 @@ cdef class IteratorColumn:
         else:
             self.iterdata.fastafile = NULL
 
+        # BAQ flags, see bam_prob_realn_core
+        if self.compute_baq:
+            self.iterdata.baq_flag = 1
+            if self.extended_baq: self.iterdata.baq_flag |= 2
+            if self.redo_baq: self.iterdata.baq_flag |= 4
+        else:
+            self.iterdata.baq_flag = -1
+
+        # the downsampler takes reads from *source*, the
+        # pileup engine from *advance*.
+        cdef bam_plp_auto_f advance
+        cdef bam_plp_auto_f source
         if self.stepper == None or self.stepper == "all":
-            self.pileup_iter = bam_plp_init( &__advance_all, &self.iterdata )
+            advance = source = &__advance_all
         elif self.stepper == "samtools":
-            self.pileup_iter = bam_plp_init( &__advance_snpcalls, &self.iterdata )
+            advance = &__advance_snpcalls
+            source = &__advance_snpcalls_flags
         else:
             raise ValueError( "unknown stepper option `%s` in IteratorColumn" % self.stepper)
 
+        if self.downsample < 0:
+            raise ValueError( "downsample needs to be a positive number, got %i" % self.downsample )
+
+        self.iterdata.downsampler = NULL
+        if self.downsample:
+            self.downsampler = pysam_downsample_init( source,
+                                                      &self.iterdata,
+                                                      self.downsample,
+                                                      self.downsample_seed,
+                                                      self.mask )
+            if advance == source:
+                self.pileup_iter = bam_plp_init( &pysam_downsample_read, self.downsampler )
+            else:
+                # reads are processed after sampling
+                self.iterdata.downsampler = self.downsampler
+                self.pileup_iter = bam_plp_init( advance, &self.iterdata )
+        else:
+            self.pileup_iter = bam_plp_init( advance, &self.iterdata )
+
         if self.max_depth:
             bam_plp_set_maxcnt( self.pileup_iter, self.max_depth )
 
@@ -2030,6 +3056,8 @@ cdef class IteratorColumn:
 
         # self.pileup_iter = bam_plp_init( &__advancepileup, &self.iterdata )
         bam_plp_reset(self.pileup_iter)
+        if self.downsampler != NULL:
+            pysam_downsample_reset( self.downsampler )
 
     def __dealloc__(self):
         # reset in order to avoid memory leak messages for iterators 
@@ -2040,6 +3068,10 @@ cdef class IteratorColumn:
             self.pileup_iter = <bam_plp_t>NULL
             self.plp = <const_bam_pileup1_t_ptr>NULL
 
+        if self.downsampler != NULL:
+            pysam_downsample_destroy( self.downsampler )
+            self.downsampler = NULL
+
         if self.iterdata.seq != NULL:
             free(self.iterdata.seq)
             self.iterdata.seq = NULL
@@ -2060,26 +3092,70 @@ cdef class IteratorColumnRegion(IteratorColumn):
         self.end = end
         self.truncate = truncate
 
-    def __next__(self):
-        """python version of next().
-        """
+        # start the pileup engine at the first position in the
+        # region so that columns before it are never built.
+        if self.truncate:
+            pysam_bam_plp_set_start( self.pileup_iter, tid, start )
+            self.fastforward = 1
 
+    cdef int advance( self ) except -1:
+        '''advance to next column in region.
+
+        returns 0 if there are no more columns.
+        '''
         while 1:
             self.cnext()
             if self.n_plp < 0:
                 raise ValueError("error during iteration" )
 
             if self.plp == NULL:
-                raise StopIteration
+                return 0
             
             if self.truncate:
                 if self.start > self.pos: continue
-                if self.pos >= self.end: raise StopIteration
+                if self.pos >= self.end: return 0
+
+            return 1
+
+    cdef long foreach( self, pileup_cfunc func, void * data ) except -1:
+        '''call *func* for each remaining column.
 
-            return makePileupProxy( &self.plp,
-                                     self.tid,
-                                     self.pos,
-                                     self.n_plp )
+        *func* is called without the GIL and with *data* as its
+        last argument. Iteration stops early if *func* returns a
+        non-zero value.
+
+        returns the number of columns passed to *func*.
+        '''
+        cdef long n = 0
+        with nogil:
+            while 1:
+                self.plp = pysam_bam_plp_auto( self.pileup_iter,
+                                               &self.tid,
+                                               &self.pos,
+                                               &self.n_plp,
+                                               &self.fastforward )
+                if self.n_plp < 0 or self.plp == NULL: break
+                if self.truncate:
+                    if self.start > self.pos: continue
+                    if self.pos >= self.end: break
+                n += 1
+                if func( self.tid, self.pos, self.n_plp, self.plp, data ) != 0: break
+
+        if self.n_plp < 0:
+            raise ValueError("error during iteration" )
+        return n
+
+    def __next__(self):
+        """python version of next().
+        """
+
+        if not self.advance():
+            raise StopIteration
+
+        return makePileupProxy( &self.plp,
+                                 self.tid,
+                                 self.pos,
+                                 self.n_plp )
 
 cdef class IteratorColumnAllRefs(IteratorColumn):
     """iterates over all columns by chaining iterators over each reference
@@ -2119,6 +3195,546 @@ cdef class IteratorColumnAllRefs(IteratorColumn):
             else:
                 raise StopIteration
 
+cdef class IteratorMultiColumn:
+    '''iterates over columns in several files simultaneously.
+
+    The pileup engines of all files are advanced in lockstep. At each
+    position, the iterator returns a tuple ``(pos, columns)``.
+    ``columns`` contains a :class:`PileupProxy` for each file,
+    or None if the file has no reads at the position.
+
+    The same caveats as for :class:`IteratorColumn` apply -
+    :class:`PileupProxy` objects are only valid until the
+    iterator advances.
+    '''
+
+    def __cinit__( self,
+                   samfiles,
+                   reference = None,
+                   start = None,
+                   end = None,
+                   region = None,
+                   **kwargs ):
+
+        cdef int rtid, rstart, rend, has_coord
+        cdef int x
+        cdef Samfile samfile
+
+        self.iterators = []
+        for samfile in samfiles:
+            if not samfile._isOpen():
+                raise ValueError( "I/O operation on closed file" )
+            if not samfile.isbam:
+                raise NotImplementedError( "pileup of samfiles not implemented yet" )
+            if not samfile._hasIndex():
+                raise ValueError( "no index available for pileup" )
+
+            has_coord, rtid, rstart, rend = samfile._parseRegion( reference, start, end, region )
+            if not has_coord:
+                raise ValueError( "multi_pileup requires a region/reference" )
+
+            self.iterators.append( IteratorColumnRegion( samfile,
+                                                         tid = rtid,
+                                                         start = rstart,
+                                                         end = rend,
+                                                         **kwargs ) )
+
+        self.n = len( self.iterators )
+        # all iterators need to be advanced before the first column
+        self.status = <int*>malloc( self.n * sizeof(int) )
+        for x from 0 <= x < self.n: self.status[x] = 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """python version of next().
+        """
+        cdef int x
+        cdef int pos = -1
+        cdef IteratorColumnRegion it
+
+        # advance iterators returned at the previous position and
+        # find the next position.
+        for x from 0 <= x < self.n:
+            it = self.iterators[x]
+            if self.status[x] == 1:
+                if it.advance(): self.status[x] = 0
+                else: self.status[x] = -1
+            if self.status[x] == 0 and (pos < 0 or it.pos < pos):
+                pos = it.pos
+
+        if pos < 0:
+            raise StopIteration
+
+        columns = []
+        for x from 0 <= x < self.n:
+            it = self.iterators[x]
+            if self.status[x] == 0 and it.pos == pos:
+                columns.append( makePileupProxy( &it.plp,
+                                                 it.tid,
+                                                 it.pos,
+                                                 it.n_plp ) )
+                self.status[x] = 1
+            else:
+                columns.append( None )
+
+        return pos, columns
+
+    def __dealloc__(self):
+        if self.status != NULL:
+            free( self.status )
+            self.status = NULL
+
+def multi_pileup( samfiles,
+                  reference = None,
+                  start = None,
+                  end = None,
+                  region = None,
+                  **kwargs ):
+    '''*(samfiles, reference = None, start = None, end = None, region = None, **kwargs)*
+
+    perform a :term:`pileup` within a :term:`region` in several
+    :class:`Samfile` objects simultaneously. The :term:`region` is
+    specified as in :meth:`Samfile.pileup` and is required. The
+    files should have been aligned against the same reference.
+
+    Additional *kwargs* such as *truncate*, *stepper* or *max_depth*
+    are passed to the pileup iterator of each file.
+
+    returns an iterator of type :class:`IteratorMultiColumn`
+    yielding a tuple ``(pos, columns)`` for each position
+    covered in at least one file.
+    '''
+    return IteratorMultiColumn( samfiles,
+                                reference = reference,
+                                start = start,
+                                end = end,
+                                region = region,
+                                **kwargs )
+
+##-------------------------------------------------------------------
+##-------------------------------------------------------------------
+##-------------------------------------------------------------------
+cdef int __compute_baq_batch( bam1_t ** batch,
+                              int n,
+                              __iterdata * d,
+                              samfile_t * outfile,
+                              int threads ) except -1:
+    '''compute BAQ for *n* reads in *batch* and write them to *outfile*.
+
+    All reads in *batch* are aligned to the same reference. The
+    reference sequence is cached in *d* between calls.
+    '''
+    cdef int x
+    cdef int tid = batch[0].core.tid
+
+    if tid >= 0:
+        # reload sequence
+        if tid != d.tid:
+            if d.seq != NULL: free(d.seq)
+            d.tid = tid
+            d.seq = faidx_fetch_seq(d.fastafile,
+                                    d.samfile.header.target_name[tid],
+                                    0, max_pos,
+                                    &d.seq_len)
+            if d.seq == NULL:
+                raise ValueError( "reference sequence for '%s' (tid=%i) not found" % \
+                                      (d.samfile.header.target_name[tid],
+                                       tid))
+        pysam_bam_prob_realn_batch( batch, n, d.seq, d.baq_flag, threads )
+
+    for x from 0 <= x < n:
+        samwrite( outfile, batch[x] )
+
+    return 0
+
+def compute_baq( infile,
+                 outfile,
+                 fastafile,
+                 int threads = 1,
+                 extended = False,
+                 redo = False,
+                 int batch_size = 10000 ):
+    '''*(infile, outfile, fastafile, threads = 1, extended = False, redo = False, batch_size = 10000)*
+
+    compute base alignment qualities (BAQ) for all reads in the
+    :term:`BAM` file *infile* and write them to the :term:`BAM`
+    file *outfile*. The BAQ values are stored in the ``BQ`` tag,
+    base qualities are not changed.
+
+    The ``samtools`` stepper in :meth:`Samfile.pileup` uses the
+    stored values instead of realigning each read, thus the cost
+    of computing BAQ is only paid once per file.
+
+    *fastafile* is the indexed reference sequence. Reads are
+    processed in batches of *batch_size* reads on *threads*
+    threads. Set *extended* to compute extended BAQ. Reads that
+    already contain a ``BQ`` tag are left unchanged unless
+    *redo* is set.
+
+    returns the number of reads written.
+    '''
+    if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+    if batch_size < 1: raise ValueError( "invalid batch size: %i" % batch_size )
+
+    cdef Samfile inf = Samfile( infile, "rb" )
+    cdef Fastafile fasta = Fastafile( fastafile )
+    cdef Samfile outf = Samfile( outfile, "wb", template = inf )
+
+    cdef __iterdata d
+    d.samfile = inf.samfile
+    d.fastafile = fasta.fastafile
+    d.tid = -1
+    d.seq = NULL
+    d.baq_flag = 0
+    d.downsampler = NULL
+    if extended: d.baq_flag |= 2
+    if redo: d.baq_flag |= 4
+
+    cdef bam1_t ** batch = <bam1_t**>calloc( batch_size, sizeof(bam1_t*) )
+    cdef bam1_t * swap
+    cdef int x
+    cdef int n = 0
+    cdef long nreads = 0
+
+    for x from 0 <= x < batch_size: batch[x] = bam_init1()
+
+    try:
+        while samread( inf.samfile, batch[n] ) >= 0:
+            nreads += 1
+            # start a new batch if the reference changes
+            if n > 0 and batch[n].core.tid != batch[0].core.tid:
+                __compute_baq_batch( batch, n, &d, outf.samfile, threads )
+                swap = batch[0]
+                batch[0] = batch[n]
+                batch[n] = swap
+                n = 0
+            n += 1
+            if n == batch_size:
+                __compute_baq_batch( batch, n, &d, outf.samfile, threads )
+                n = 0
+
+        if n > 0:
+            __compute_baq_batch( batch, n, &d, outf.samfile, threads )
+    finally:
+        for x from 0 <= x < batch_size: bam_destroy1( batch[x] )
+        free( batch )
+        if d.seq != NULL: free( d.seq )
+        outf.close()
+        inf.close()
+        fasta.close()
+
+    return nreads
+
+def build_index( filename, index_filename = None, int threads = 1 ):
+    '''*(filename, index_filename = None, threads = 1)*
+
+    build an index for the sorted :term:`BAM` file *filename*.
+
+    Unlike :func:`pysam.index`, the index is built in-process
+    without going through the ``samtools`` command line. With
+    *threads* > 1, compressed blocks are decompressed in parallel.
+
+    The index is written to *index_filename*, by default
+    ``<filename>.bai``. It is written to a temporary file first
+    and renamed once complete, so that readers never open a
+    partially written index.
+    '''
+    if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+
+    filename = _encodeFilename( filename )
+    if index_filename is None:
+        index_filename = filename + b".bai"
+    else:
+        index_filename = _encodeFilename( index_filename )
+
+    if not os.path.exists( filename ):
+        raise IOError( "file `%s` not found" % _charptr_to_str( filename ) )
+
+    # write to temporary file in the same directory, unique per process
+    tmpfilename = index_filename + (".%i.tmp" % os.getpid()).encode( "ascii" )
+    cdef char * fn = filename
+    cdef char * fnidx = tmpfilename
+    cdef int ret
+
+    with nogil:
+        ret = pysam_bam_index_build( fn, fnidx, threads )
+
+    if ret != 0:
+        if os.path.exists( tmpfilename ): os.unlink( tmpfilename )
+        if ret == -1:
+            raise IOError( "could not open file `%s`" % _charptr_to_str( filename ) )
+        elif ret == -2:
+            raise ValueError( "could not build index for `%s` - is it a sorted BAM file?" %
+                              _charptr_to_str( filename ) )
+        else:
+            raise IOError( "could not write index to `%s`" % _charptr_to_str( index_filename ) )
+
+    os.rename( tmpfilename, index_filename )
+
+def _parseMemory( memory ):
+    '''convert a memory size like ``768M`` to bytes.'''
+    if isinstance( memory, (int, long) ):
+        return memory
+    units = { "K" : 1 << 10, "M" : 1 << 20, "G" : 1 << 30 }
+    memory = memory.strip().upper()
+    try:
+        if memory[-1:] in units:
+            return int( memory[:-1] ) * units[memory[-1]]
+        return int( memory )
+    except ValueError:
+        raise ValueError( "invalid memory size `%s`" % memory )
+
+def sort_records( infile,
+                  outfile,
+                  key = "coordinate",
+                  memory = "768M",
+                  int threads = 1,
+                  compresslevel = None,
+                  tmpdir = None ):
+    '''*(infile, outfile, key = "coordinate", memory = "768M", threads = 1, compresslevel = None, tmpdir = None)*
+
+    sort the :term:`BAM` file *infile* and write the result to the
+    :term:`BAM` file *outfile*.
+
+    Unlike :func:`pysam.sort`, sorting is done in-process. *key* is
+    ``coordinate``, ``queryname`` or a two-letter tag. Reads are sorted
+    by the value of the tag and then by coordinate, reads without the
+    tag come first.
+
+    Records are buffered until *memory* (bytes or a string such as
+    ``2G``) is used. Each buffer is sorted on *threads* threads and
+    written to a temporary file in *tmpdir*, which are merged at the
+    end. Set *compresslevel* to choose the compression of the output.
+
+    returns the number of reads written.
+    '''
+    if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+
+    cdef int by
+    cdef bytes tag = b""
+    if key == "coordinate":
+        by = PYSAM_SORT_COORDINATE
+    elif key == "queryname":
+        by = PYSAM_SORT_QUERYNAME
+    elif len( key ) == 2:
+        by = PYSAM_SORT_TAG
+        tag = _forceBytes( key )
+    else:
+        raise ValueError( "invalid sort key `%s`" % key )
+
+    cdef size_t max_mem = _parseMemory( memory )
+    if max_mem <= 0: raise ValueError( "invalid memory size `%s`" % memory )
+
+    cdef int level = -1
+    if compresslevel is not None:
+        if not 0 <= compresslevel <= 9:
+            raise ValueError( "invalid compresslevel `%s`" % compresslevel )
+        level = compresslevel
+
+    infile = _encodeFilename( infile )
+    outfile = _encodeFilename( outfile )
+    if not os.path.exists( infile ):
+        raise IOError( "file `%s` not found" % _charptr_to_str( infile ) )
+
+    tmpdir = tempfile.mkdtemp( prefix = "pysam_sort", dir = tmpdir )
+    prefix = _encodeFilename( os.path.join( tmpdir, "run" ) )
+
+    cdef char * fn = infile
+    cdef char * fnout = outfile
+    cdef char * cprefix = prefix
+    cdef char * ctag = tag
+    cdef int64_t n_reads = 0
+    cdef int ret
+
+    try:
+        with nogil:
+            ret = pysam_bam_sort( fn, fnout, cprefix, by, ctag,
+                                  max_mem, threads, level, &n_reads )
+    finally:
+        shutil.rmtree( tmpdir, ignore_errors = True )
+
+    if ret == -1:
+        raise IOError( "could not open file `%s`" % _charptr_to_str( infile ) )
+    elif ret == -2:
+        raise IOError( "error while reading `%s` - truncated file?" % _charptr_to_str( infile ) )
+    elif ret != 0:
+        raise IOError( "error while writing `%s`" % _charptr_to_str( outfile ) )
+
+    return n_reads
+
+def mark_duplicates( infile,
+                     outfile,
+                     int window = 1000,
+                     remove = False,
+                     int threads = 1,
+                     compresslevel = None ):
+    '''*(infile, outfile, window = 1000, remove = False, threads = 1, compresslevel = None)*
+
+    mark duplicate reads in the coordinate sorted :term:`BAM` file
+    *infile* and write them to the :term:`BAM` file *outfile*.
+
+    Unlike :func:`pysam.rmdup`, duplicates are flagged and kept
+    unless *remove* is set. Mapped primary reads are grouped by
+    reference, unclipped 5' position and orientation. Pairs are
+    additionally grouped by the position and orientation of the mate
+    and single reads at the position of a pair are duplicates. Of
+    each group, the read with the highest sum of base qualities of
+    at least 15 is kept, both mates of a pair share its status.
+    Existing duplicate flags of these reads are cleared.
+
+    Reads are streamed and held only until the input has moved
+    *window* bases beyond their group, which should be larger than
+    the longest clipped part of a read. With *threads* > 1 input
+    and output are decompressed and compressed in parallel.
+
+    returns a dictionary of counts and the fraction of duplicates
+    among the examined reads.
+    '''
+    if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+    if window < 0: raise ValueError( "invalid window: %i" % window )
+
+    cdef int level = -1
+    if compresslevel is not None:
+        if not 0 <= compresslevel <= 9:
+            raise ValueError( "invalid compresslevel `%s`" % compresslevel )
+        level = compresslevel
+
+    infile = _encodeFilename( infile )
+    outfile = _encodeFilename( outfile )
+    if not os.path.exists( infile ):
+        raise IOError( "file `%s` not found" % _charptr_to_str( infile ) )
+
+    cdef char * fn = infile
+    cdef char * fnout = outfile
+    cdef int cremove = bool( remove )
+    cdef pysam_markdup_stats_t stats
+    cdef int ret
+
+    with nogil:
+        ret = pysam_bam_markdup( fn, fnout, window, cremove, threads, level, &stats )
+
+    if ret == -1:
+        raise IOError( "could not open file `%s`" % _charptr_to_str( infile ) )
+    elif ret == -2:
+        raise IOError( "error while reading `%s` - truncated file?" % _charptr_to_str( infile ) )
+    elif ret == -4:
+        raise ValueError( "`%s` is not sorted by coordinate" % _charptr_to_str( infile ) )
+    elif ret != 0:
+        raise IOError( "error while writing `%s`" % _charptr_to_str( outfile ) )
+
+    examined = stats.n_unpaired + stats.n_paired
+    duplicates = stats.n_unpaired_dup + stats.n_paired_dup
+    return { "reads" : stats.n_reads,
+             "unmapped" : stats.n_unmapped,
+             "secondary" : stats.n_secondary,
+             "unpaired_reads" : stats.n_unpaired,
+             "unpaired_duplicates" : stats.n_unpaired_dup,
+             "paired_reads" : stats.n_paired,
+             "paired_duplicates" : stats.n_paired_dup,
+             "duplicate_fraction" : float( duplicates ) / examined if examined else 0.0 }
+
+def replace_header( path, new_header, output = None, compresslevel = None ):
+    '''*(path, new_header, output = None, compresslevel = None)*
+
+    replace the header of the :term:`BAM` file *path* by *new_header*
+    and write the result to *output*. Without *output*, *path* is
+    replaced.
+
+    *new_header* is a header dictionary as accepted by :class:`Samfile`
+    or a :class:`Samfile` to copy the header from. It has to list the
+    same number of references as the current header.
+
+    Unlike :func:`pysam.reheader`, only the compressed blocks holding
+    the header are inflated, all later blocks are copied unchanged.
+    An index of *path* is updated for the new file without reading
+    any reads. Files are written under a temporary name and renamed
+    once complete.
+
+    returns the number of compressed bytes copied unchanged.
+    '''
+    if bam_is_be: raise NotImplementedError( "replace_header is not available on big-endian platforms" )
+
+    cdef int level = -1
+    if compresslevel is not None:
+        if not 0 <= compresslevel <= 9:
+            raise ValueError( "invalid compresslevel `%s`" % compresslevel )
+        level = compresslevel
+
+    path = _encodeFilename( path )
+    output = path if output is None else _encodeFilename( output )
+    if not os.path.exists( path ):
+        raise IOError( "file `%s` not found" % _charptr_to_str( path ) )
+
+    # same lookup as bam_index_load_local
+    index_filename = path + b".bai"
+    if not os.path.exists( index_filename ) and path.endswith( b".bam" ):
+        index_filename = path[:-4] + b".bai"
+    if not os.path.exists( index_filename ):
+        index_filename = None
+    output_index = output + b".bai" if output != path or index_filename is None else index_filename
+
+    cdef Samfile infile = Samfile( path, "rb", lazy_index = True )
+    cdef Samfile template
+    cdef bam_header_t * header = NULL
+    cdef char * fn
+    cdef char * fnout
+    cdef char * fnidx = NULL
+    cdef char * fnidxout = NULL
+    cdef int64_t n_copied = 0
+    cdef int ret
+    try:
+        if not infile.isbam:
+            raise ValueError( "`%s` is not a bam file" % _charptr_to_str( path ) )
+        if isinstance( new_header, Samfile ):
+            template = new_header
+            if not template._isOpen(): raise ValueError( "I/O operation on closed file" )
+            header = template.samfile.header
+        else:
+            header = infile._buildHeader( new_header )
+        if header.n_targets != infile.samfile.header.n_targets:
+            raise ValueError( "new header has %i references instead of %i" % \
+                                  (header.n_targets, infile.samfile.header.n_targets) )
+
+        # write to temporary files in the same directories, unique per process
+        suffix = (".%i.tmp" % os.getpid()).encode( "ascii" )
+        tmpfilename = output + suffix
+        tmpindex = output_index + suffix
+        fn = path
+        fnout = tmpfilename
+        if index_filename is not None:
+            fnidx = index_filename
+            fnidxout = tmpindex
+        with nogil:
+            ret = pysam_bam_replace_header( fn, fnout, header, level, fnidx, fnidxout, &n_copied )
+    finally:
+        if header != NULL and not isinstance( new_header, Samfile ):
+            bam_header_destroy( header )
+        infile.close()
+
+    if ret != 0:
+        for tmp in (tmpfilename, tmpindex):
+            if os.path.exists( tmp ): os.unlink( tmp )
+        if ret == -1:
+            raise IOError( "could not open file `%s`" % _charptr_to_str( path ) )
+        elif ret == -2:
+            raise IOError( "error while reading `%s` - truncated file?" % _charptr_to_str( path ) )
+        elif ret == -4:
+            raise IOError( "could not read index `%s`" % _charptr_to_str( index_filename ) )
+        else:
+            raise IOError( "error while writing `%s`" % _charptr_to_str( output ) )
+
+    os.rename( tmpfilename, output )
+    if index_filename is not None: os.rename( tmpindex, output_index )
+
+    # headers cached for the old file are stale
+    key = os.path.abspath( output )
+    for cache_key in list( _header_cache ):
+        if cache_key[0] == key: del _header_cache[cache_key]
+
+    return n_copied
+
 ##-------------------------------------------------------------------
 ##-------------------------------------------------------------------
 ##-------------------------------------------------------------------
@@ -2410,6 +4026,27 @@ cdef class AlignedRead:
     def __hash__(self):
         return _Py_HashPointer(<void *>self)
 
+    def to_bytes(self):
+        '''return the read as a :term:`BAM` record.
+
+        The record is serialized as in a :term:`BAM` file including
+        the leading block size, see :meth:`from_bytes`.
+        '''
+        if bam_is_be: raise NotImplementedError( "to_bytes is not available on big-endian platforms" )
+        cdef bam1_t * src = self._delegate
+        buf = PyBytes_FromStringAndSize( NULL, 4 + BAM_CORE_SIZE + src.data_len )
+        pysam_bam_serialize( src, <uint8_t*><char*>buf )
+        return buf
+
+    @classmethod
+    def from_bytes(cls, buf):
+        '''return a new read from the :term:`BAM` record *buf*
+        created by :meth:`to_bytes`.'''
+        return _alignedReadFromBytes( cls, buf )
+
+    def __reduce__(self):
+        return ( _alignedReadFromBytes, (type(self), self.to_bytes()) )
+
     def _convert_python_tag(self, pytag, value, fmts, args):
 
         if not type(pytag) is bytes:
@@ -3384,6 +5021,20 @@ cdef class AlignedRead:
                 ret_string.append("%-30s %-10s= %s" % (f, "", self.__getattribute__(f)))
         return ret_string
 
+def _alignedReadFromBytes( cls, buf ):
+    '''build an instance of *cls* from the serialized record *buf*.'''
+    if bam_is_be: raise NotImplementedError( "from_bytes is not available on big-endian platforms" )
+    if not PyBytes_Check( buf ): buf = bytes( buf )
+    cdef AlignedRead dest = cls.__new__( cls )
+    dest._delegate = <bam1_t*>calloc( 1, sizeof( bam1_t ) )
+    cdef char * s = buf
+    cdef int ret = pysam_bam_deserialize( dest._delegate, <uint8_t*>s, len( buf ) )
+    if ret == -1:
+        raise ValueError( "invalid BAM record of %i bytes" % len( buf ) )
+    elif ret != 0:
+        raise MemoryError( "could not allocate BAM record of %i bytes" % len( buf ) )
+    return dest
+
 cdef class PileupProxy:
     '''A pileup column. A pileup column contains
     all the reads that map to a certain target base.
@@ -4160,16 +5811,32 @@ cdef class SNPCall:
 
 
 cdef class IndexedReads:
-    """index a bamfile by read.
+    """*(Samfile samfile, int reopen = True, on_disk = False, index_filename = None)*
+
+    index a bamfile by read.
 
-    The index is kept in memory.
+    The index is a sorted array of read name hashes and file
+    positions. By default, the index is kept in memory.
+
+    If *on_disk* is set, the index is saved in *index_filename*
+    (by default the name of the bam file with the suffix ``.qni``).
+    The index is memory mapped and searched in place, thus it is not
+    loaded into memory. An existing index is re-used unless it is
+    older than the bam file.
 
     By default, the file is re-openend to avoid conflicts if
     multiple operators work on the same file. Set *reopen* = False
     to not re-open *samfile*.
+
+    Only local files can be indexed, not streams, file objects or
+    remote files.
     """
 
-    def __init__(self, Samfile samfile, int reopen = True ):
+    def __init__(self,
+                 Samfile samfile,
+                 int reopen = True,
+                 on_disk = False,
+                 index_filename = None ):
         self.samfile = samfile
 
         if samfile.isbam: mode = b"rb"
@@ -4178,6 +5845,8 @@ cdef class IndexedReads:
         # reopen the file - note that this makes the iterator
         # slow and causes pileup to slow down significantly.
         if reopen:
+            if samfile.isstream:
+                raise ValueError( "can not reopen a stream or file object, use reopen = False" )
             self.fp = samopen( samfile._filename, mode, NULL )
             assert self.fp != NULL
             self.owns_samfile = True
@@ -4187,36 +5856,321 @@ cdef class IndexedReads:
 
         assert samfile.isbam, "can only IndexReads on bam files"
 
-    def build( self ):
-        '''build index.'''
+        self.on_disk = on_disk
+        if index_filename is None:
+            self.index_filename = samfile._filename + b".qni"
+        else:
+            self.index_filename = _encodeFilename( index_filename )
 
-        self.index = collections.defaultdict( list )
+    def build( self, int threads = 1 ):
+        '''build index.
 
-        # this method will start indexing from the current file position
-        # if you decide
-        cdef int ret = 1
-        cdef bam1_t * b = <bam1_t*> calloc(1, sizeof( bam1_t) )
+        The index is built from the current file position onwards.
+        If the bam file has been indexed, the file is split into
+        ranges that are processed by *threads* threads.
 
-        cdef uint64_t pos
+        If the index is kept on disk and an up-to-date index
+        exists, it is opened instead.
+        '''
+        if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+        # the index is built by reading the file by name
+        if self.samfile.isstream or self.samfile.isremote:
+            raise ValueError( "can only index reads of a local file, not a stream, file object or remote file" )
+
+        if self.index != NULL:
+            pysam_qname_index_destroy( self.index )
+            self.index = NULL
+
+        if self.on_disk and os.path.exists( self.index_filename ) and \
+                os.path.getmtime( self.index_filename ) >= \
+                os.path.getmtime( self.samfile._filename ):
+            self.index = pysam_qname_index_load( self.index_filename )
+            if self.index != NULL: return
+
+        cdef pysam_qname_index_t * idx
+        cdef char * filename = self.samfile._filename
+        self.samfile._prepareIndex( -1 )
+        cdef bam_index_t * bam_idx = self.samfile.index
+        cdef uint64_t start = bam_tell( self.fp.x.bam )
+
+        with nogil:
+            idx = pysam_qname_index_build( filename, bam_idx, start, threads )
+
+        if idx == NULL:
+            raise IOError( "error while reading %s" % _charptr_to_str( filename ) )
+
+        if not self.on_disk:
+            self.index = idx
+            return
 
-        while ret > 0:
-            pos = bam_tell( self.fp.x.bam )
-            ret = samread( self.fp, b)
-            if ret > 0:
-                qname = _charptr_to_str(bam1_qname( b ))
-                self.index[qname].append( pos )
+        # write to temporary file first to not leave a partial index
+        tmpfilename = self.index_filename + b".tmp"
+        cdef int ret = pysam_qname_index_save( idx, tmpfilename )
+        pysam_qname_index_destroy( idx )
+        if ret != 0:
+            if os.path.exists( tmpfilename ): os.unlink( tmpfilename )
+            raise IOError( "could not write index to %s" % _charptr_to_str( self.index_filename ) )
+        os.rename( tmpfilename, self.index_filename )
 
-        bam_destroy1( b )
+        self.index = pysam_qname_index_load( self.index_filename )
+        if self.index == NULL:
+            raise IOError( "could not open index %s" % _charptr_to_str( self.index_filename ) )
 
     def find( self, qname ):
-        if qname in self.index:
-            return IteratorRowSelection( self.samfile, self.index[qname], reopen = False )
+        '''*(qname)*
+
+        return an iterator over all reads with name *qname*.
+
+        *qname* can also be a list of read names. The reads for all
+        names are returned by a single iterator in file order, names
+        that are not found are ignored.
+
+        raises KeyError if no read is found.
+        '''
+        if self.index == NULL:
+            raise ValueError( "index not built" )
+
+        if PyBytes_Check( qname ) or PyUnicode_Check( qname ):
+            names = [ _forceBytes( qname ) ]
         else:
-            raise KeyError( "read %s not found" % qname )
+            names = [ _forceBytes( y ) for y in qname ]
+
+        cdef bytes name
+        cdef size_t first, x, n
+        cdef uint64_t pos
+
+        # collect candidate positions
+        candidates = []
+        for name in names:
+            n = pysam_qname_index_find( self.index,
+                                        pysam_qname_hash( name ),
+                                        &first )
+            for x from first <= x < first + n:
+                candidates.append( (self.index.entries[x].offset, name) )
+
+        # check read names in file order to exclude hash collisions
+        candidates.sort()
+        cdef bam1_t * b = bam_init1()
+        positions = []
+        for pos, name in candidates:
+            bam_seek( self.fp.x.bam, pos, 0 )
+            if samread( self.fp, b ) > 0 and strcmp( bam1_qname( b ), name ) == 0:
+                positions.append( pos )
+        bam_destroy1( b )
+
+        if not positions:
+            raise KeyError( "read %s not found" % (qname,) )
+
+        return IteratorRowSelection( self.samfile, positions, reopen = False )
 
     def __dealloc__(self):
+        if self.index != NULL:
+            pysam_qname_index_destroy( self.index )
+            self.index = NULL
         if self.owns_samfile: samclose( self.fp )
 
+# empty block marking the end of a BGZF file
+_BGZF_EOF = b"\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0\033\0\3\0\0\0\0\0\0\0\0\0"
+
+cdef enum:
+    SPLIT_CALLABLE, SPLIT_READ_GROUP, SPLIT_CONTIG, SPLIT_TAG
+
+cdef class _SplitOutput:
+    '''buffered records for a single output file of :class:`SplitWriter`.'''
+
+    def __cinit__( self ):
+        self.buffer.s = NULL
+        self.buffer.l = self.buffer.m = 0
+
+    def __dealloc__( self ):
+        pysam_buffer_free( &self.buffer )
+
+cdef class SplitWriter:
+    '''*(template, key = "read_group", path_pattern = "{key}.bam", max_open = 256, threads = 1, compresslevel = None, buffer_size = "64M")*
+
+    write reads to one :term:`BAM` file per key.
+
+    *key* is ``read_group``, ``contig``, a two-letter tag or a callable
+    returning the key for an :class:`AlignedRead`. Reads without a
+    read group or tag are written with the key ``unassigned``, reads
+    for which a callable returns None are skipped.
+    The file name for a key is ``path_pattern.format( key = key )``.
+    The header of all files is taken from the :class:`Samfile`
+    *template*.
+
+    Records are buffered per key. Once *buffer_size* bytes are
+    buffered in total, all buffers are compressed on *threads*
+    threads and appended to their files. At most *max_open* files
+    are kept open at the same time, so that the number of keys is not
+    limited by the number of file descriptors. The files are
+    complete once :meth:`close` has been called.
+    '''
+
+    def __init__( self,
+                  Samfile template,
+                  key = "read_group",
+                  path_pattern = "{key}.bam",
+                  int max_open = 256,
+                  int threads = 1,
+                  compresslevel = None,
+                  buffer_size = "64M" ):
+
+        if not template._isOpen(): raise ValueError( "I/O operation on closed file" )
+        if bam_is_be: raise NotImplementedError( "SplitWriter is not available on big-endian platforms" )
+        if max_open < 1: raise ValueError( "invalid max_open: %i" % max_open )
+        if threads < 1: raise ValueError( "invalid number of threads: %i" % threads )
+
+        if callable( key ):
+            self.key_type = SPLIT_CALLABLE
+        elif not isinstance( key, str ):
+            raise ValueError( "invalid key `%s`" % (key,) )
+        elif key == "read_group":
+            self.key_type = SPLIT_READ_GROUP
+        elif key == "contig":
+            self.key_type = SPLIT_CONTIG
+        elif len( key ) == 2:
+            self.key_type = SPLIT_TAG
+        else:
+            raise ValueError( "invalid key `%s`" % (key,) )
+
+        self.level = -1
+        if compresslevel is not None:
+            if not 0 <= compresslevel <= 9:
+                raise ValueError( "invalid compresslevel `%s`" % compresslevel )
+            self.level = compresslevel
+
+        self.key = key
+        self.path_pattern = path_pattern
+        self.max_open = max_open
+        self.threads = threads
+        self.buffer_size = _parseMemory( buffer_size )
+        self.buffered = 0
+        self.references = template.references
+        self.outputs = {}
+        self.files = {}
+        self.handles = collections.OrderedDict()
+
+        cdef pysam_buffer_t buf
+        buf.s = NULL
+        buf.l = buf.m = 0
+        pysam_buffer_add_header( &buf, template.samfile.header )
+        self.header = PyBytes_FromStringAndSize( <char*>buf.s, buf.l )
+        pysam_buffer_free( &buf )
+
+    cdef object _getOutput( self, AlignedRead read ):
+        '''return the output for *read* or None if the read is skipped.'''
+        if self.key_type == SPLIT_CONTIG:
+            if read._delegate.core.tid < 0: key = "unmapped"
+            else: key = self.references[read._delegate.core.tid]
+        elif self.key_type == SPLIT_CALLABLE:
+            key = self.key( read )
+            if key is None: return None
+        else:
+            try:
+                key = read.opt( "RG" if self.key_type == SPLIT_READ_GROUP else self.key )
+            except KeyError:
+                key = "unassigned"
+
+        cdef _SplitOutput output = self.outputs.get( key )
+        if output is None:
+            # keys such as 1 and "1" share a file
+            filename = self.path_pattern.format( key = key )
+            output = self.files.get( filename )
+            if output is None:
+                output = _SplitOutput()
+                output.filename = filename
+                pysam_buffer_add( &output.buffer, <char*>self.header, len( self.header ) )
+                self.buffered += output.buffer.l
+                self.files[filename] = output
+            self.outputs[key] = output
+        return output
+
+    def write( self, AlignedRead read ):
+        '''write *read* to the file for its key.'''
+        if self.handles is None: raise ValueError( "I/O operation on closed SplitWriter" )
+        cdef _SplitOutput output = self._getOutput( read )
+        if output is None: return
+        cdef size_t l = output.buffer.l
+        if pysam_buffer_add_bam( &output.buffer, read._delegate ) != 0:
+            raise MemoryError( "could not buffer read %s" % read.qname )
+        self.buffered += output.buffer.l - l
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_many( self, reads ):
+        '''write all reads in iterable *reads*.'''
+        for read in reads: self.write( read )
+
+    def _getHandle( self, _SplitOutput output ):
+        '''return an open file for *output*, closing the least
+        recently used file if too many are open.'''
+        handle = self.handles.pop( output.filename, None )
+        if handle is None:
+            if len( self.handles ) >= self.max_open:
+                self.handles.popitem( last = False )[1].close()
+            # truncate existing files on first use
+            handle = open( output.filename, "ab" if output.started else "wb" )
+            output.started = True
+        self.handles[output.filename] = handle
+        return handle
+
+    def flush( self ):
+        '''compress all buffered records and append them to their files.'''
+        if self.handles is None: return
+        cdef list pending = [ x for x in self.files.values() if (<_SplitOutput>x).buffer.l > 0 ]
+        cdef int n = len( pending )
+        if n == 0: return
+
+        cdef pysam_buffer_t ** src = <pysam_buffer_t**>calloc( n, sizeof(pysam_buffer_t*) )
+        cdef pysam_buffer_t ** dst = <pysam_buffer_t**>calloc( n, sizeof(pysam_buffer_t*) )
+        cdef pysam_buffer_t * compressed = <pysam_buffer_t*>calloc( n, sizeof(pysam_buffer_t) )
+        cdef _SplitOutput output
+        cdef int i, ret
+        for i from 0 <= i < n:
+            output = pending[i]
+            src[i] = &output.buffer
+            dst[i] = &compressed[i]
+
+        try:
+            with nogil:
+                ret = pysam_buffer_compress_many( src, dst, n, self.level, self.threads )
+            if ret != 0: raise IOError( "error while compressing reads" )
+
+            for i from 0 <= i < n:
+                output = pending[i]
+                self._getHandle( output ).write( PyBytes_FromStringAndSize( <char*>compressed[i].s, compressed[i].l ) )
+                # release memory, most keys receive few reads
+                pysam_buffer_free( &output.buffer )
+        finally:
+            for i from 0 <= i < n: pysam_buffer_free( &compressed[i] )
+            free( compressed )
+            free( dst )
+            free( src )
+        self.buffered = 0
+
+    def close( self ):
+        '''write all buffered records and complete the files.'''
+        if self.handles is None: return
+        try:
+            self.flush()
+            for output in self.files.values():
+                self._getHandle( output ).write( _BGZF_EOF )
+        finally:
+            for handle in self.handles.values(): handle.close()
+            self.handles = None
+
+    property filenames:
+        '''dictionary mapping keys to file names.'''
+        def __get__(self):
+            return dict( [ (key, (<_SplitOutput>x).filename) for key, x in self.outputs.items() ] )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
 __all__ = ["Samfile",
            "Fastafile",
            "Fastqfile",
@@ -4226,6 +6180,16 @@ __all__ = ["Samfile",
            "PileupColumn",
            "PileupProxy",
            "PileupRead",
+           "compute_baq",
+           "build_index",
+           "sort_records",
+           "mark_duplicates",
+           "replace_header",
+           "SplitWriter",
+           "Region",
+           "parse_regions",
+           "clear_header_cache",
+           "multi_pileup",
            # "IteratorSNPCalls",
            # "SNPCaller",
            # "IndelCaller",
@@ -220,6 +220,9 @@ cdef class Tabixfile:
     cdef char * _filename
 
     cdef Parser parser
+
+    # identifies the open file in the tid cache of Region objects
+    cdef object _regionKey
     
 cdef class TabixIterator:
     cdef ti_iter_t iterator
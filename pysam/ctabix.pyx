@@ -7,6 +7,8 @@ import tempfile, os, sys, types, itertools, struct, ctypes, gzip
 import io
 cimport TabProxies
 
+from pysam.csamtools import Region
+
 from cpython cimport PyErr_SetString, PyBytes_Check, \
     PyUnicode_Check, PyBytes_FromStringAndSize, \
     PyObject_AsFileDescriptor
@@ -120,6 +122,7 @@ cdef class Tabixfile:
         # close a previously opened file
         if self.tabixfile != NULL: self.close()
         self.tabixfile = NULL
+        self._regionKey = None
 
         filename_index = index or (filename + ".tbi")
         self.isremote = filename.startswith( "http:") or filename.startswith( "ftp:" )
@@ -178,16 +181,32 @@ cdef class Tabixfile:
 
         rtid = rstart = rend = 0
 
-        # translate to a region
+        if region is None and isinstance( reference, Region ):
+            region, reference = reference, None
+
+        if isinstance( region, Region ):
+            if reference is not None or start is not None or end is not None:
+                raise ValueError( "reference, start and end can not be combined with a Region" )
+            if self._regionKey is None: self._regionKey = object()
+            rtid = region._getTid( self._regionKey )
+            if rtid < 0:
+                rtid = ti_get_tid( self.tabixfile.idx, _force_bytes( region.reference ) )
+                if rtid < 0: raise KeyError( region.reference )
+                region._setTid( self._regionKey, rtid )
+            return region, rtid, region.start, region.end
+
+        # translate to a tid without going through a region string
         if reference:
-            if start != None and end != None:
-                region = "%s:%i-%i" % (reference, start+1, end)
-            elif start == None and end != None:
-                region = "%s:%i-%i" % (reference, 1, end)
-            elif end == None and start != None:
-                region = "%s:%i-%i" % (reference, start+1, max_pos-1)
-            else:
-                region = reference
+            rtid = ti_get_tid( self.tabixfile.idx, _force_bytes( reference ) )
+            if rtid < 0: raise KeyError( reference )
+            if start != None: rstart = start
+            if end != None: rend = end
+            elif start != None: rend = max_pos - 1
+            else: rend = 1 << 29
+            if not 0 <= rstart < max_pos: raise IndexError( 'start out of range (%i)' % rstart )
+            if rstart > rend: raise ValueError( 'invalid region: start (%i) > end (%i)' % (rstart, rend) )
+            if not 0 <= rend < max_pos: raise IndexError( 'end out of range (%i)' % rend )
+            return reference, rtid, rstart, rend
 
         if region:
             region = _force_bytes(region)
@@ -209,7 +228,8 @@ cdef class Tabixfile:
         '''
                
         fetch one or more rows in a :term:`region` using 0-based indexing. The region is specified by
-        :term:`reference`, *start* and *end*. Alternatively, a samtools :term:`region` string can be supplied.
+        :term:`reference`, *start* and *end*. Alternatively, a samtools :term:`region` string or a
+        :class:`pysam.Region` can be supplied.
 
         Without *reference* or *region* all entries will be fetched. 
         
@@ -282,6 +302,7 @@ cdef class Tabixfile:
         if self.tabixfile != NULL:
             ti_close( self.tabixfile )
             self.tabixfile = NULL
+        self._regionKey = None
 
     def __dealloc__( self ):
         # remember: dealloc cannot call other python methods
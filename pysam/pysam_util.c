@@ -40,6 +40,8 @@ void pysam_unset_stderr()
 // The order of the following declarations is important.
 // #######################################################
 #define BAM_MAX_BIN 37450 // =(8^6-1)/7+1
+// 1<<14 is the size of minimum bin.
+#define BAM_LIDX_SHIFT 14
 
 // initialize hashes
 typedef struct
@@ -245,6 +247,81 @@ uint32_t pysam_get_unmapped( const bam_index_t *idx, const int tid )
   return idx->n_no_coor;
 }
 
+// defined in bam_index.c
+pair64_t * get_chunk_coordinates(const bam_index_t *idx, int tid, int beg, int end, int *cnt_off);
+
+// BGZF blocks typically compress about four-fold. Used to
+// convert the within-block part of a virtual file offset
+// into an approximate compressed file position.
+#define PYSAM_BGZF_RATIO 4.0
+
+static inline double voffset2position( uint64_t offset )
+{
+  return (double)(offset >> 16) + (double)(offset & 0xffff) / PYSAM_BGZF_RATIO;
+}
+
+// Estimate the cost of reading region *tid*:*beg*-*end* from
+// the index alone. Sets *n_bytes* to the approximate number of
+// compressed bytes in the chunks that would be read and
+// *n_reads* to the approximate number of reads in these chunks
+// after the first offset in the linear index, scaled from the
+// total for *tid*.
+// Returns the number of chunks, -1 on error.
+int pysam_bam_index_estimate( const bam_index_t *idx,
+			      int tid, int beg, int end,
+			      uint64_t *n_bytes, uint64_t *n_reads )
+{
+  pair64_t *off;
+  int n_off, i;
+  khint_t k;
+  khash_t(i) *h;
+  const bam_lidx_t *lidx;
+  uint64_t min_off = 0;
+  double bytes = 0, span = 0, total_bytes, total_reads, reads;
+
+  *n_bytes = *n_reads = 0;
+  if (idx == NULL || tid < 0 || tid >= idx->n) return -1;
+  if (beg < 0) beg = 0;
+  if (end < beg) return 0;
+
+  // no read overlapping the region starts before the
+  // offset in the linear index
+  lidx = &idx->index2[tid];
+  if (lidx->n > 0)
+    min_off = lidx->offset[(beg >> BAM_LIDX_SHIFT) < lidx->n ? (beg >> BAM_LIDX_SHIFT) : lidx->n - 1];
+
+  off = get_chunk_coordinates( idx, tid, beg, end, &n_off );
+  if (off == NULL) return 0;
+  for (i = 0; i < n_off; ++i)
+    {
+      bytes += voffset2position( off[i].v ) - voffset2position( off[i].u );
+      span += voffset2position( off[i].v ) -
+	voffset2position( off[i].u > min_off ? off[i].u : min_off );
+    }
+  free( off );
+  if (n_off == 0) return 0;
+
+  *n_bytes = (uint64_t)(bytes + 0.5);
+
+  // the meta bin contains the offset range and the read counts
+  h = idx->index[tid];
+  k = kh_get(i, h, BAM_MAX_BIN);
+  if (k == kh_end(h)) return n_off;
+  total_bytes = voffset2position( kh_val(h, k).list[0].v ) - voffset2position( kh_val(h, k).list[0].u );
+  total_reads = (double)kh_val(h, k).list[1].u + (double)kh_val(h, k).list[1].v;
+  if (total_bytes <= 0 || span >= total_bytes)
+    *n_reads = (uint64_t)total_reads;
+  else
+    {
+      // round up so that non-empty regions report at least one read
+      if (span < 0) span = 0;
+      reads = total_reads * span / total_bytes;
+      *n_reads = (uint64_t)reads;
+      if (reads > *n_reads) ++*n_reads;
+    }
+  return n_off;
+}
+
 /* uint32_t pysam_glf_depth( glf1_t * g ) */
 /* { */
 /*   return g->depth; */
@@ -519,3 +596,3066 @@ int bam_aux_type2size(int x)
 
 
 
+
+// #######################################################
+// BAQ computation on batches of reads
+// #######################################################
+#include <pthread.h>
+#include "kprobaln.h"
+
+int bam_prob_realn_core(bam1_t *b, const char *ref, int flag);
+
+static pthread_once_t baq_once = PTHREAD_ONCE_INIT;
+
+// kpa_glocal fills a static table of error probabilities on
+// its first call. bam_prob_realn_core returns early for many
+// reads without reaching kpa_glocal, so call it once on a
+// dummy sequence before any worker is started.
+static void baq_init( void )
+{
+  uint8_t seq[4] = { 0, 1, 2, 3 }, q[4];
+  int state[4];
+  kpa_glocal( seq, 4, seq, 4, 0, &kpa_par_def, state, q );
+}
+
+typedef struct
+{
+  bam1_t **reads;
+  int n, step, offset;
+  const char *ref;
+  int flag;
+} baq_worker_t;
+
+static void * baq_worker( void * data )
+{
+  baq_worker_t * w = (baq_worker_t*)data;
+  int i;
+  for (i = w->offset; i < w->n; i += w->step)
+    bam_prob_realn_core( w->reads[i], w->ref, w->flag );
+  return 0;
+}
+
+// compute BAQ for *n* reads aligned to reference sequence *ref*
+// using *n_threads* threads. Reads are distributed round-robin
+// so that long and short reads are spread evenly.
+int pysam_bam_prob_realn_batch( bam1_t ** reads,
+				int n,
+				const char * ref,
+				int flag,
+				int n_threads )
+{
+  int i;
+  pthread_t * tid;
+  baq_worker_t * w;
+
+  if (n <= 0) return 0;
+  if (n_threads < 1) n_threads = 1;
+  if (n_threads > n) n_threads = n;
+
+  pthread_once( &baq_once, baq_init );
+
+  w = (baq_worker_t*)calloc( n_threads, sizeof(baq_worker_t) );
+  tid = (pthread_t*)calloc( n_threads, sizeof(pthread_t) );
+  for (i = 0; i < n_threads; ++i)
+    {
+      w[i].reads = reads;
+      w[i].n = n;
+      w[i].step = n_threads;
+      w[i].offset = i;
+      w[i].ref = ref;
+      w[i].flag = flag;
+    }
+
+  // worker 0 runs in the calling thread
+  for (i = 1; i < n_threads; ++i)
+    pthread_create( &tid[i], 0, baq_worker, &w[i] );
+  baq_worker( &w[0] );
+  for (i = 1; i < n_threads; ++i)
+    pthread_join( tid[i], 0 );
+
+  free( tid );
+  free( w );
+  return 0;
+}
+
+// #######################################################
+// pileup engine positioning
+// The following declarations have been taken from bam_pileup.c
+// The order of the following declarations is important.
+// #######################################################
+typedef struct {
+	int k, x, y, end;
+} cstate_t;
+
+typedef struct __plp_linkbuf_t {
+	bam1_t b;
+	uint32_t beg, end;
+	cstate_t s;
+	struct __plp_linkbuf_t *next;
+} plp_lbnode_t;
+
+struct __bam_plp_t {
+	mempool_t *mp;
+	plp_lbnode_t *head, *tail, *dummy;
+	int32_t tid, pos, max_tid, max_pos;
+	int is_eof, flag_mask, max_plp, error, maxcnt;
+	bam_pileup1_t *plp;
+	// for the "auto" interface only
+	bam1_t *b;
+	bam_plp_auto_f func;
+	void *data;
+};
+
+#define _cop(c) ((c)&BAM_CIGAR_MASK)
+#define _cln(c) ((c)>>BAM_CIGAR_SHIFT)
+#define _is_refop(op) ((op) == BAM_CMATCH || (op) == BAM_CDEL || (op) == BAM_CREF_SKIP || (op) == BAM_CEQUAL || (op) == BAM_CDIFF)
+
+// set the CIGAR state of *p* to the operation overlapping *pos*.
+// This corresponds to calling resolve_cigar2 in bam_pileup.c for
+// every position between the start of the alignment and *pos*.
+static void plp_resolve_cigar( plp_lbnode_t * p, int32_t pos )
+{
+  bam1_core_t *c = &p->b.core;
+  uint32_t *cigar = bam1_cigar(&p->b);
+  cstate_t *s = &p->s;
+  int k, op, l;
+
+  if (s->k == -1)
+    {
+      // find the first match or deletion
+      for (k = 0, s->x = c->pos, s->y = 0; k < c->n_cigar; ++k)
+	{
+	  op = _cop(cigar[k]); l = _cln(cigar[k]);
+	  if (op == BAM_CMATCH || op == BAM_CDEL || op == BAM_CEQUAL || op == BAM_CDIFF) break;
+	  else if (op == BAM_CREF_SKIP) s->x += l;
+	  else if (op == BAM_CINS || op == BAM_CSOFT_CLIP) s->y += l;
+	}
+      s->k = k;
+    }
+
+  while (s->k < c->n_cigar && pos - s->x >= _cln(cigar[s->k]))
+    {
+      op = _cop(cigar[s->k]); l = _cln(cigar[s->k]);
+      if (op == BAM_CMATCH || op == BAM_CEQUAL || op == BAM_CDIFF) s->y += l;
+      s->x += l;
+      // find the next M/D/N/=/X
+      for (k = s->k + 1; k < c->n_cigar; ++k)
+	{
+	  op = _cop(cigar[k]); l = _cln(cigar[k]);
+	  if (_is_refop(op)) break;
+	  else if (op == BAM_CINS || op == BAM_CSOFT_CLIP) s->y += l;
+	}
+      s->k = k;
+    }
+}
+
+// advance alignments in the pileup buffer that start before
+// the current engine position.
+static void plp_fastforward( bam_plp_t iter )
+{
+  plp_lbnode_t *p;
+  for (p = iter->head; p->next; p = p->next)
+    {
+      if (p->b.core.tid != iter->tid) continue;
+      if (p->beg >= iter->pos || p->end <= iter->pos) continue;
+      plp_resolve_cigar( p, iter->pos );
+    }
+}
+
+void pysam_bam_plp_set_start( bam_plp_t iter, int tid, int pos )
+{
+  iter->tid = tid;
+  iter->pos = pos;
+}
+
+static inline const bam_pileup1_t * plp_next( bam_plp_t iter,
+					      int *_tid, int *_pos, int *_n_plp,
+					      int *skip )
+{
+  // a column is about to be built - bring all buffered
+  // alignments to the start position first.
+  if (*skip && (iter->is_eof || iter->max_tid > iter->tid ||
+		(iter->max_tid == iter->tid && iter->max_pos > iter->pos)))
+    {
+      plp_fastforward( iter );
+      *skip = 0;
+    }
+  return bam_plp_next( iter, _tid, _pos, _n_plp );
+}
+
+// taken from bam_plp_auto in bam_pileup.c
+const bam_pileup1_t * pysam_bam_plp_auto( bam_plp_t iter,
+					  int *_tid, int *_pos, int *_n_plp,
+					  int *skip )
+{
+  const bam_pileup1_t *plp;
+  if (iter->func == 0 || iter->error) { *_n_plp = -1; return 0; }
+  if ((plp = plp_next(iter, _tid, _pos, _n_plp, skip)) != 0) return plp;
+  else { // no pileup line can be obtained; read alignments
+    *_n_plp = 0;
+    if (iter->is_eof) return 0;
+    while (iter->func(iter->data, iter->b) >= 0) {
+      if (bam_plp_push(iter, iter->b) < 0) {
+	*_n_plp = -1;
+	return 0;
+      }
+      if ((plp = plp_next(iter, _tid, _pos, _n_plp, skip)) != 0) return plp;
+      // otherwise no pileup line can be returned; read the next alignment.
+    }
+    bam_plp_push(iter, 0);
+    if ((plp = plp_next(iter, _tid, _pos, _n_plp, skip)) != 0) return plp;
+    return 0;
+  }
+}
+
+//////////////////////////////////////////////////////////////////
+// downsampling of alignments before they enter the pileup engine
+//
+// Alignments are grouped by start position. For each group, at most
+// depth - (number of accepted alignments still overlapping the start)
+// alignments are kept. Alignments are selected by the smallest hash
+// of their read name and the seed, so that the result is reproducible
+// for a given seed. As the number of alignments kept differs between
+// groups, the two reads of a pair may be treated differently.
+typedef struct {
+  bam1_t *b;
+  uint32_t hash;
+  // position of alignment within group
+  uint32_t idx;
+} ds_entry_t;
+
+struct __pysam_downsample_t {
+  bam_plp_auto_f func;
+  void *data;
+  int depth;
+  uint32_t seed;
+  int mask;
+  // look-ahead alignment
+  bam1_t *next;
+  int has_next, eof, eof_ret;
+  // end positions of accepted alignments, min-heap
+  uint32_t *ends;
+  int n_ends, m_ends, ends_tid;
+  // selected alignments of current group, max-heap on hash
+  ds_entry_t *sel;
+  int n_sel, i_out;
+};
+
+static inline uint32_t ds_hash( const bam1_t *b, uint32_t seed )
+{
+  const char *s = bam1_qname(b);
+  uint32_t h = seed ^ 0x9e3779b9U;
+  for (; *s; ++s) h = (h << 5) - h + (uint32_t)*s;
+  // finalizer taken from MurmurHash3
+  h ^= h >> 16; h *= 0x85ebca6bU;
+  h ^= h >> 13; h *= 0xc2b2ae35U;
+  h ^= h >> 16;
+  return h;
+}
+
+static void ds_ends_push( pysam_downsample_t *ds, uint32_t end )
+{
+  int i, j;
+  if (ds->n_ends == ds->m_ends)
+    {
+      ds->m_ends = ds->m_ends ? ds->m_ends << 1 : 256;
+      ds->ends = (uint32_t*)realloc( ds->ends, ds->m_ends * sizeof(uint32_t) );
+    }
+  i = ds->n_ends++;
+  while (i > 0 && ds->ends[j = (i - 1) >> 1] > end)
+    {
+      ds->ends[i] = ds->ends[j];
+      i = j;
+    }
+  ds->ends[i] = end;
+}
+
+static void ds_ends_pop( pysam_downsample_t *ds )
+{
+  int i = 0, j;
+  uint32_t x = ds->ends[--ds->n_ends];
+  while ((j = (i << 1) + 1) < ds->n_ends)
+    {
+      if (j + 1 < ds->n_ends && ds->ends[j+1] < ds->ends[j]) ++j;
+      if (x <= ds->ends[j]) break;
+      ds->ends[i] = ds->ends[j];
+      i = j;
+    }
+  ds->ends[i] = x;
+}
+
+// restore max-heap property of selected alignments after
+// the top element has been replaced.
+static void ds_sel_down( pysam_downsample_t *ds )
+{
+  int i = 0, j;
+  ds_entry_t x = ds->sel[0];
+  while ((j = (i << 1) + 1) < ds->n_sel)
+    {
+      if (j + 1 < ds->n_sel && ds->sel[j+1].hash > ds->sel[j].hash) ++j;
+      if (x.hash >= ds->sel[j].hash) break;
+      ds->sel[i] = ds->sel[j];
+      i = j;
+    }
+  ds->sel[i] = x;
+}
+
+static void ds_sel_up( pysam_downsample_t *ds )
+{
+  int i = ds->n_sel - 1, j;
+  ds_entry_t x = ds->sel[i];
+  while (i > 0 && ds->sel[j = (i - 1) >> 1].hash < x.hash)
+    {
+      ds->sel[i] = ds->sel[j];
+      i = j;
+    }
+  ds->sel[i] = x;
+}
+
+static int ds_entry_cmp( const void *a, const void *b )
+{
+  uint32_t x = ((const ds_entry_t*)a)->idx, y = ((const ds_entry_t*)b)->idx;
+  return (x > y) - (x < y);
+}
+
+static inline void ds_read_next( pysam_downsample_t *ds )
+{
+  int ret = ds->func( ds->data, ds->next );
+  if (ret < 0) { ds->has_next = 0; ds->eof = 1; ds->eof_ret = ret; }
+  else ds->has_next = 1;
+}
+
+// read the next group of alignments with the same start position
+// and select alignments from it. Returns < 0 at the end of the input.
+static int ds_fill( pysam_downsample_t *ds )
+{
+  int32_t tid, pos;
+  int k;
+  uint32_t h, idx = 0;
+  bam1_t *b;
+
+  ds->n_sel = ds->i_out = 0;
+  if (!ds->has_next)
+    {
+      if (ds->eof) return ds->eof_ret;
+      ds_read_next( ds );
+      if (!ds->has_next) return ds->eof_ret;
+    }
+
+  b = ds->next;
+  tid = b->core.tid;
+  pos = b->core.pos;
+
+  // remove alignments that do not overlap the group
+  if (tid != ds->ends_tid) { ds->n_ends = 0; ds->ends_tid = tid; }
+  while (ds->n_ends && ds->ends[0] <= (uint32_t)pos) ds_ends_pop( ds );
+  k = ds->depth - ds->n_ends;
+
+  do
+    {
+      if (!(b->core.flag & ds->mask) && k > 0)
+	{
+	  h = ds_hash( b, ds->seed );
+	  if (ds->n_sel < k)
+	    {
+	      bam_copy1( ds->sel[ds->n_sel].b, b );
+	      ds->sel[ds->n_sel].hash = h;
+	      ds->sel[ds->n_sel++].idx = idx;
+	      ds_sel_up( ds );
+	    }
+	  else if (h < ds->sel[0].hash)
+	    {
+	      bam_copy1( ds->sel[0].b, b );
+	      ds->sel[0].hash = h;
+	      ds->sel[0].idx = idx;
+	      ds_sel_down( ds );
+	    }
+	}
+      ++idx;
+      ds_read_next( ds );
+    }
+  while (ds->has_next && b->core.tid == tid && b->core.pos == pos);
+
+  // output alignments in input order
+  qsort( ds->sel, ds->n_sel, sizeof(ds_entry_t), ds_entry_cmp );
+  for (k = 0; k < ds->n_sel; ++k)
+    ds_ends_push( ds, bam_calend( &ds->sel[k].b->core, bam1_cigar(ds->sel[k].b) ) );
+
+  return 0;
+}
+
+pysam_downsample_t * pysam_downsample_init( bam_plp_auto_f func, void *data,
+					    int depth, uint32_t seed, int mask )
+{
+  int i;
+  pysam_downsample_t *ds = (pysam_downsample_t*)calloc( 1, sizeof(pysam_downsample_t) );
+  ds->func = func;
+  ds->data = data;
+  ds->depth = depth > 0 ? depth : 0;
+  ds->seed = seed;
+  ds->mask = mask;
+  ds->next = bam_init1();
+  ds->ends_tid = -1;
+  ds->sel = (ds_entry_t*)calloc( ds->depth + 1, sizeof(ds_entry_t) );
+  for (i = 0; i < ds->depth; ++i) ds->sel[i].b = bam_init1();
+  return ds;
+}
+
+int pysam_downsample_read( void *data, bam1_t *b )
+{
+  pysam_downsample_t *ds = (pysam_downsample_t*)data;
+  int ret;
+  while (ds->i_out == ds->n_sel)
+    if ((ret = ds_fill( ds )) < 0) return ret;
+  bam_copy1( b, ds->sel[ds->i_out++].b );
+  return b->data_len;
+}
+
+void pysam_downsample_set_mask( pysam_downsample_t *ds, int mask )
+{
+  ds->mask = mask;
+}
+
+void pysam_downsample_reset( pysam_downsample_t *ds )
+{
+  ds->has_next = ds->eof = ds->eof_ret = 0;
+  ds->n_ends = 0;
+  ds->ends_tid = -1;
+  ds->n_sel = ds->i_out = 0;
+}
+
+void pysam_downsample_destroy( pysam_downsample_t *ds )
+{
+  int i;
+  if (ds == NULL) return;
+  for (i = 0; i < ds->depth; ++i) bam_destroy1( ds->sel[i].b );
+  bam_destroy1( ds->next );
+  free( ds->sel );
+  free( ds->ends );
+  free( ds );
+}
+
+//////////////////////////////////////////////////////////////////
+// read name index
+//
+// The index is an array of (hash of read name, virtual file offset)
+// pairs sorted by hash. On disk, the array is preceded by a 16 byte
+// header (magic, byte order check and number of entries) so that it
+// can be memory mapped and searched in place.
+#ifndef _WIN32
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
+#endif
+
+#define QNI_MAGIC "QNI\1"
+#define QNI_BOM 0x01020304U
+#define QNI_HEADER_SIZE 16
+
+#define qni_lt(a, b) ((a).hash < (b).hash || ((a).hash == (b).hash && (a).offset < (b).offset))
+KSORT_INIT(qni, pysam_qname_entry_t, qni_lt);
+#define qni_offset_lt(a, b) ((a) < (b))
+KSORT_INIT(qni_offset, uint64_t, qni_offset_lt);
+
+uint64_t pysam_qname_hash( const char *s )
+{
+  // 64 bit FNV-1a
+  uint64_t h = 0xcbf29ce484222325ULL;
+  for (; *s; ++s)
+    {
+      h ^= (uint8_t)*s;
+      h *= 0x100000001b3ULL;
+    }
+  return h;
+}
+
+pysam_qname_index_t * pysam_qname_index_init()
+{
+  return (pysam_qname_index_t*)calloc( 1, sizeof(pysam_qname_index_t) );
+}
+
+void pysam_qname_index_add( pysam_qname_index_t *idx, uint64_t hash, uint64_t offset )
+{
+  if (idx->n == idx->m)
+    {
+      idx->m = idx->m ? idx->m << 1 : 1024;
+      idx->entries = (pysam_qname_entry_t*)realloc( idx->entries,
+						    idx->m * sizeof(pysam_qname_entry_t) );
+    }
+  idx->entries[idx->n].hash = hash;
+  idx->entries[idx->n++].offset = offset;
+}
+
+void pysam_qname_index_sort( pysam_qname_index_t *idx )
+{
+  ks_introsort( qni, idx->n, idx->entries );
+}
+
+int pysam_qname_index_save( const pysam_qname_index_t *idx, const char *fn )
+{
+  FILE *fp;
+  uint32_t bom = QNI_BOM;
+  uint64_t n = idx->n;
+  if ((fp = fopen( fn, "wb" )) == NULL) return -1;
+  if (fwrite( QNI_MAGIC, 1, 4, fp ) != 4 ||
+      fwrite( &bom, 4, 1, fp ) != 1 ||
+      fwrite( &n, 8, 1, fp ) != 1 ||
+      fwrite( idx->entries, sizeof(pysam_qname_entry_t), idx->n, fp ) != idx->n)
+    {
+      fclose( fp );
+      return -1;
+    }
+  return fclose( fp ) == 0 ? 0 : -1;
+}
+
+pysam_qname_index_t * pysam_qname_index_load( const char *fn )
+{
+  pysam_qname_index_t *idx;
+  char *map;
+  size_t len;
+  uint64_t n;
+#ifndef _WIN32
+  struct stat st;
+  int fd = open( fn, O_RDONLY );
+  if (fd < 0) return NULL;
+  if (fstat( fd, &st ) < 0 || st.st_size < QNI_HEADER_SIZE) { close( fd ); return NULL; }
+  len = st.st_size;
+  map = (char*)mmap( NULL, len, PROT_READ, MAP_SHARED, fd, 0 );
+  close( fd );
+  if (map == MAP_FAILED) return NULL;
+#else
+  FILE *fp = fopen( fn, "rb" );
+  if (fp == NULL) return NULL;
+  fseek( fp, 0, SEEK_END );
+  len = ftell( fp );
+  fseek( fp, 0, SEEK_SET );
+  if (len < QNI_HEADER_SIZE) { fclose( fp ); return NULL; }
+  map = (char*)malloc( len );
+  if (fread( map, 1, len, fp ) != len) { free( map ); fclose( fp ); return NULL; }
+  fclose( fp );
+#endif
+  memcpy( &n, map + 8, 8 );
+  if (memcmp( map, QNI_MAGIC, 4 ) != 0 || *(uint32_t*)(map + 4) != QNI_BOM ||
+      len != QNI_HEADER_SIZE + n * sizeof(pysam_qname_entry_t))
+    {
+#ifndef _WIN32
+      munmap( map, len );
+#else
+      free( map );
+#endif
+      return NULL;
+    }
+  idx = pysam_qname_index_init();
+  idx->entries = (pysam_qname_entry_t*)(map + QNI_HEADER_SIZE);
+  idx->n = idx->m = n;
+  idx->map = map;
+  idx->map_len = len;
+  return idx;
+}
+
+size_t pysam_qname_index_find( const pysam_qname_index_t *idx, uint64_t hash, size_t *first )
+{
+  size_t lo = 0, hi = idx->n, mid, end;
+  // lower bound
+  while (lo < hi)
+    {
+      mid = lo + ((hi - lo) >> 1);
+      if (idx->entries[mid].hash < hash) lo = mid + 1;
+      else hi = mid;
+    }
+  *first = lo;
+  for (end = lo; end < idx->n && idx->entries[end].hash == hash; ++end);
+  return end - lo;
+}
+
+void pysam_qname_index_destroy( pysam_qname_index_t *idx )
+{
+  if (idx == NULL) return;
+  if (idx->map != NULL)
+    {
+#ifndef _WIN32
+      munmap( idx->map, idx->map_len );
+#else
+      free( idx->map );
+#endif
+    }
+  else free( idx->entries );
+  free( idx );
+}
+
+// build the read name index from several threads. The file is split
+// at alignment boundaries taken from the linear index in *bam_idx*.
+typedef struct
+{
+  const char *fn;
+  const uint64_t *splits;
+  int n_ranges;
+  volatile int *next_range;
+  pthread_mutex_t *lock;
+  pysam_qname_index_t *result;
+  int error;
+} qni_worker_t;
+
+static void * qni_worker( void * data )
+{
+  qni_worker_t *w = (qni_worker_t*)data;
+  bamFile fp;
+  bam1_t *b;
+  uint64_t off, end;
+  int i, ret;
+
+  if ((fp = bam_open( w->fn, "r" )) == 0) { w->error = 1; return 0; }
+  b = bam_init1();
+  while (1)
+    {
+      pthread_mutex_lock( w->lock );
+      i = (*w->next_range)++;
+      pthread_mutex_unlock( w->lock );
+      if (i >= w->n_ranges) break;
+
+      end = w->splits[i+1];
+      if (bam_seek( fp, w->splits[i], SEEK_SET ) < 0) { w->error = 1; break; }
+      while (1)
+	{
+	  off = bam_tell( fp );
+	  if (end && off >= end) break;
+	  if ((ret = bam_read1( fp, b )) < 0)
+	    {
+	      // end of file is only expected in the last range
+	      if (ret < -1 || end) w->error = 1;
+	      break;
+	    }
+	  pysam_qname_index_add( w->result, pysam_qname_hash( bam1_qname(b) ), off );
+	}
+    }
+  bam_destroy1( b );
+  bam_close( fp );
+  return 0;
+}
+
+pysam_qname_index_t * pysam_qname_index_build( const char *fn,
+					       const bam_index_t *bam_idx,
+					       uint64_t start,
+					       int n_threads )
+{
+  pysam_qname_index_t *idx, **parts;
+  qni_worker_t *w;
+  pthread_t *tid;
+  pthread_mutex_t lock;
+  uint64_t *offsets, *splits;
+  size_t n_offsets = 0, n, i;
+  int t, n_ranges, next_range = 0, error = 0;
+
+  if (n_threads < 1) n_threads = 1;
+
+  // collect alignment start positions from the linear index
+  n = 0;
+  if (bam_idx != NULL && n_threads > 1)
+    for (t = 0; t < bam_idx->n; ++t) n += bam_idx->index2[t].n;
+  offsets = (uint64_t*)malloc( (n + 1) * sizeof(uint64_t) );
+  if (n > 0)
+    for (t = 0; t < bam_idx->n; ++t)
+      for (i = 0; i < (size_t)bam_idx->index2[t].n; ++i)
+	if (bam_idx->index2[t].offset[i] > start)
+	  offsets[n_offsets++] = bam_idx->index2[t].offset[i];
+  ks_introsort( qni_offset, n_offsets, offsets );
+
+  // choose split points evenly among the unique positions
+  for (i = 0, n = 0; i < n_offsets; ++i)
+    if (n == 0 || offsets[i] != offsets[n-1]) offsets[n++] = offsets[i];
+  n_ranges = n_threads * 4;
+  if ((size_t)n_ranges > n + 1) n_ranges = n + 1;
+  splits = (uint64_t*)malloc( (n_ranges + 1) * sizeof(uint64_t) );
+  splits[0] = start;
+  for (t = 1; t < n_ranges; ++t) splits[t] = offsets[(size_t)t * n / n_ranges];
+  // read last range to end of file
+  splits[n_ranges] = 0;
+  free( offsets );
+
+  if (n_threads > n_ranges) n_threads = n_ranges;
+  pthread_mutex_init( &lock, 0 );
+  w = (qni_worker_t*)calloc( n_threads, sizeof(qni_worker_t) );
+  tid = (pthread_t*)calloc( n_threads, sizeof(pthread_t) );
+  parts = (pysam_qname_index_t**)calloc( n_threads, sizeof(pysam_qname_index_t*) );
+  for (t = 0; t < n_threads; ++t)
+    {
+      parts[t] = pysam_qname_index_init();
+      w[t].fn = fn;
+      w[t].splits = splits;
+      w[t].n_ranges = n_ranges;
+      w[t].next_range = &next_range;
+      w[t].lock = &lock;
+      w[t].result = parts[t];
+    }
+
+  // worker 0 runs in the calling thread
+  for (t = 1; t < n_threads; ++t)
+    pthread_create( &tid[t], 0, qni_worker, &w[t] );
+  qni_worker( &w[0] );
+  for (t = 1; t < n_threads; ++t)
+    pthread_join( tid[t], 0 );
+
+  // merge results
+  idx = parts[0];
+  for (t = 1; t < n_threads; ++t)
+    {
+      for (i = 0; i < parts[t]->n; ++i)
+	pysam_qname_index_add( idx, parts[t]->entries[i].hash, parts[t]->entries[i].offset );
+      pysam_qname_index_destroy( parts[t] );
+    }
+  for (t = 0; t < n_threads; ++t) error |= w[t].error;
+
+  pthread_mutex_destroy( &lock );
+  free( parts );
+  free( tid );
+  free( w );
+  free( splits );
+
+  if (error)
+    {
+      fprintf(pysamerr, "[pysam_qname_index_build] truncated or corrupt file %s\n", fn);
+      pysam_qname_index_destroy( idx );
+      return NULL;
+    }
+  pysam_qname_index_sort( idx );
+  return idx;
+}
+
+// #######################################################
+// threaded index building
+// Compressed blocks are read sequentially and inflated in
+// parallel in batches. The indexing code has been taken
+// from bam_index_core in bam_index.c.
+// #######################################################
+#include <zlib.h>
+
+// not exported in bam.h
+bam_index_t *bam_index_core(bamFile fp);
+void bam_index_save(const bam_index_t *idx, FILE *fp);
+
+#define MT_BLOCK_SIZE 0x10000
+#define MT_BLOCKS_PER_THREAD 32
+
+typedef struct
+{
+  uint8_t cdata[MT_BLOCK_SIZE];
+  uint8_t udata[MT_BLOCK_SIZE];
+  int clen, ulen, error;
+  int64_t coffset;
+} mt_block_t;
+
+typedef struct __mt_reader_t mt_reader_t;
+
+typedef struct
+{
+  mt_reader_t *r;
+  int offset;
+} mt_worker_t;
+
+struct __mt_reader_t
+{
+  FILE *fp;
+  mt_block_t *blocks;
+  int n_blocks, m_blocks, i_block, uoffset;
+  // file offset after the last block read
+  int64_t next_coffset;
+  int error;
+  // worker pool. The calling thread is worker 0, *tid* and
+  // *workers* hold the other n_threads - 1 workers.
+  int n_threads, has_pool;
+  pthread_t *tid;
+  mt_worker_t *workers;
+  pthread_mutex_t lock;
+  pthread_cond_t work, done;
+  // *batch* is incremented for each batch of blocks, workers
+  // wait for it to change.
+  int batch, n_running, quit;
+};
+
+// inflate a single block
+static void mt_inflate( mt_block_t *b )
+{
+  z_stream zs;
+  zs.zalloc = NULL;
+  zs.zfree = NULL;
+  zs.next_in = b->cdata + 18;
+  zs.avail_in = b->clen - 16;
+  zs.next_out = b->udata;
+  zs.avail_out = MT_BLOCK_SIZE;
+  if (inflateInit2( &zs, -15 ) != Z_OK) { b->error = 1; return; }
+  if (inflate( &zs, Z_FINISH ) != Z_STREAM_END) { inflateEnd( &zs ); b->error = 1; return; }
+  if (inflateEnd( &zs ) != Z_OK) { b->error = 1; return; }
+  b->ulen = zs.total_out;
+}
+
+// inflate the share of worker *offset* of the current batch.
+// Blocks are distributed round-robin.
+static void mt_inflate_range( mt_reader_t *r, int offset )
+{
+  int i;
+  for (i = offset; i < r->n_blocks; i += r->n_threads)
+    mt_inflate( &r->blocks[i] );
+}
+
+static void * mt_inflate_worker( void * data )
+{
+  mt_worker_t *w = (mt_worker_t*)data;
+  mt_reader_t *r = w->r;
+  int batch = 0;
+  pthread_mutex_lock( &r->lock );
+  for (;;)
+    {
+      while (r->batch == batch && !r->quit)
+	pthread_cond_wait( &r->work, &r->lock );
+      if (r->quit) break;
+      batch = r->batch;
+      pthread_mutex_unlock( &r->lock );
+      mt_inflate_range( r, w->offset );
+      pthread_mutex_lock( &r->lock );
+      if (--r->n_running == 0) pthread_cond_signal( &r->done );
+    }
+  pthread_mutex_unlock( &r->lock );
+  return 0;
+}
+
+static void mt_reader_destroy( mt_reader_t *r )
+{
+  int i;
+  if (r->has_pool)
+    {
+      pthread_mutex_lock( &r->lock );
+      r->quit = 1;
+      pthread_cond_broadcast( &r->work );
+      pthread_mutex_unlock( &r->lock );
+      for (i = 1; i < r->n_threads; ++i)
+	pthread_join( r->tid[i], 0 );
+      pthread_cond_destroy( &r->work );
+      pthread_cond_destroy( &r->done );
+      pthread_mutex_destroy( &r->lock );
+      r->has_pool = 0;
+    }
+  free( r->blocks );
+  free( r->tid );
+  free( r->workers );
+  r->blocks = 0;
+  r->tid = 0;
+  r->workers = 0;
+}
+
+// set up *r* to read blocks from *fp* starting at file offset
+// *coffset* using *n_threads* threads. If some threads can not be
+// started, the others do their share. Returns -1 if out of memory.
+static int mt_reader_init( mt_reader_t *r, FILE *fp, int64_t coffset, int n_threads )
+{
+  int i;
+  memset( r, 0, sizeof(mt_reader_t) );
+  if (n_threads < 1) n_threads = 1;
+  r->fp = fp;
+  r->next_coffset = coffset;
+  r->m_blocks = n_threads * MT_BLOCKS_PER_THREAD;
+  r->blocks = (mt_block_t*)malloc( r->m_blocks * sizeof(mt_block_t) );
+  r->tid = (pthread_t*)calloc( n_threads, sizeof(pthread_t) );
+  r->workers = (mt_worker_t*)calloc( n_threads, sizeof(mt_worker_t) );
+  if (r->blocks == 0 || r->tid == 0 || r->workers == 0)
+    {
+      mt_reader_destroy( r );
+      return -1;
+    }
+  pthread_mutex_init( &r->lock, 0 );
+  pthread_cond_init( &r->work, 0 );
+  pthread_cond_init( &r->done, 0 );
+  r->has_pool = 1;
+  r->n_threads = 1;
+  for (i = 1; i < n_threads; ++i)
+    {
+      r->workers[i].r = r;
+      r->workers[i].offset = i;
+      if (pthread_create( &r->tid[i], 0, mt_inflate_worker, &r->workers[i] ) != 0) break;
+      ++r->n_threads;
+    }
+  return 0;
+}
+
+// read the next batch of blocks and inflate them.
+// returns the number of blocks read, -1 on error.
+static int mt_fill( mt_reader_t *r )
+{
+  mt_block_t *b;
+  int i;
+  size_t count;
+
+  r->n_blocks = r->i_block = r->uoffset = 0;
+  while (r->n_blocks < r->m_blocks)
+    {
+      b = &r->blocks[r->n_blocks];
+      b->coffset = r->next_coffset;
+      b->error = 0;
+      count = fread( b->cdata, 1, 18, r->fp );
+      if (count == 0) break;
+      if (count != 18 || b->cdata[0] != 31 || b->cdata[1] != 139 || b->cdata[2] != 8 ||
+	  (b->cdata[3] & 4) == 0 || b->cdata[12] != 'B' || b->cdata[13] != 'C')
+	{
+	  r->error = 1;
+	  return -1;
+	}
+      b->clen = (b->cdata[16] | b->cdata[17] << 8) + 1;
+      if (b->clen < 18 ||
+	  fread( b->cdata + 18, 1, b->clen - 18, r->fp ) != (size_t)(b->clen - 18))
+	{
+	  r->error = 1;
+	  return -1;
+	}
+      r->next_coffset += b->clen;
+      ++r->n_blocks;
+    }
+  if (r->n_blocks == 0) return 0;
+
+  // wake up the pool and do the share of worker 0
+  pthread_mutex_lock( &r->lock );
+  ++r->batch;
+  r->n_running = r->n_threads - 1;
+  pthread_cond_broadcast( &r->work );
+  pthread_mutex_unlock( &r->lock );
+  mt_inflate_range( r, 0 );
+  pthread_mutex_lock( &r->lock );
+  while (r->n_running > 0)
+    pthread_cond_wait( &r->done, &r->lock );
+  pthread_mutex_unlock( &r->lock );
+
+  for (i = 0; i < r->n_blocks; ++i)
+    if (r->blocks[i].error) { r->error = 1; return -1; }
+  return r->n_blocks;
+}
+
+// virtual file offset, same as bgzf_tell
+static inline int64_t mt_tell( const mt_reader_t *r )
+{
+  if (r->i_block < r->n_blocks)
+    return r->blocks[r->i_block].coffset << 16 | r->uoffset;
+  return r->next_coffset << 16;
+}
+
+static int mt_read( mt_reader_t *r, void *data, int length )
+{
+  int copied = 0, n;
+  mt_block_t *b;
+  while (copied < length)
+    {
+      if (r->i_block >= r->n_blocks && mt_fill( r ) <= 0) break;
+      b = &r->blocks[r->i_block];
+      n = b->ulen - r->uoffset;
+      if (n > length - copied) n = length - copied;
+      memcpy( (uint8_t*)data + copied, b->udata + r->uoffset, n );
+      copied += n;
+      r->uoffset += n;
+      // move to next block at block end as in bgzf_read
+      while (r->i_block < r->n_blocks && r->uoffset == r->blocks[r->i_block].ulen)
+	{
+	  ++r->i_block;
+	  r->uoffset = 0;
+	}
+    }
+  return copied;
+}
+
+// taken from bam_read1 in bam.c
+static int mt_read1( mt_reader_t *r, bam1_t *b )
+{
+  bam1_core_t *c = &b->core;
+  int32_t block_len, ret;
+  uint32_t x[8];
+
+  if ((ret = mt_read( r, &block_len, 4 )) != 4) {
+    if (ret == 0 && !r->error) return -1; // normal end-of-file
+    else return -2; // truncated
+  }
+  if (mt_read( r, x, BAM_CORE_SIZE ) != BAM_CORE_SIZE) return -3;
+  c->tid = x[0]; c->pos = x[1];
+  c->bin = x[2]>>16; c->qual = x[2]>>8&0xff; c->l_qname = x[2]&0xff;
+  c->flag = x[3]>>16; c->n_cigar = x[3]&0xffff;
+  c->l_qseq = x[4];
+  c->mtid = x[5]; c->mpos = x[6]; c->isize = x[7];
+  b->data_len = block_len - BAM_CORE_SIZE;
+  if (b->m_data < b->data_len) {
+    b->m_data = b->data_len;
+    kroundup32(b->m_data);
+    b->data = (uint8_t*)realloc(b->data, b->m_data);
+  }
+  if (mt_read( r, b->data, b->data_len ) != b->data_len) return -4;
+  b->l_aux = b->data_len - c->n_cigar * 4 - c->l_qname - c->l_qseq - (c->l_qseq+1)/2;
+  return 4 + block_len;
+}
+
+// read header and return number of targets, -1 on error.
+static int mt_read_header( mt_reader_t *r )
+{
+  char magic[4];
+  int32_t l, n_targets, i;
+  uint8_t *buf;
+  if (mt_read( r, magic, 4 ) != 4 || strncmp( magic, "BAM\1", 4 ) != 0) return -1;
+  if (mt_read( r, &l, 4 ) != 4 || l < 0) return -1;
+  buf = (uint8_t*)malloc( l + 1 );
+  if (mt_read( r, buf, l ) != l) { free( buf ); return -1; }
+  free( buf );
+  if (mt_read( r, &n_targets, 4 ) != 4 || n_targets < 0) return -1;
+  for (i = 0; i < n_targets; ++i)
+    {
+      if (mt_read( r, &l, 4 ) != 4 || l < 0) return -1;
+      buf = (uint8_t*)malloc( l + 4 );
+      // name and length
+      if (mt_read( r, buf, l + 4 ) != l + 4) { free( buf ); return -1; }
+      free( buf );
+    }
+  return n_targets;
+}
+
+// the following functions have been taken from bam_index.c
+static inline void mt_insert_offset(khash_t(i) *h, int bin, uint64_t beg, uint64_t end)
+{
+  khint_t k;
+  bam_binlist_t *l;
+  int ret;
+  k = kh_put(i, h, bin, &ret);
+  l = &kh_value(h, k);
+  if (ret) { // not present
+    l->m = 1; l->n = 0;
+    l->list = (pair64_t*)calloc(l->m, 16);
+  }
+  if (l->n == l->m) {
+    l->m <<= 1;
+    l->list = (pair64_t*)realloc(l->list, l->m * 16);
+  }
+  l->list[l->n].u = beg; l->list[l->n++].v = end;
+}
+
+static inline void mt_insert_offset2(bam_lidx_t *index2, bam1_t *b, uint64_t offset)
+{
+  int i, beg, end;
+  beg = b->core.pos >> BAM_LIDX_SHIFT;
+  end = (bam_calend(&b->core, bam1_cigar(b)) - 1) >> BAM_LIDX_SHIFT;
+  if (index2->m < end + 1) {
+    int old_m = index2->m;
+    index2->m = end + 1;
+    kroundup32(index2->m);
+    index2->offset = (uint64_t*)realloc(index2->offset, index2->m * 8);
+    memset(index2->offset + old_m, 0, 8 * (index2->m - old_m));
+  }
+  if (beg == end) {
+    if (index2->offset[beg] == 0) index2->offset[beg] = offset;
+  } else {
+    for (i = beg; i <= end; ++i)
+      if (index2->offset[i] == 0) index2->offset[i] = offset;
+  }
+  index2->n = end + 1;
+}
+
+static void mt_merge_chunks(bam_index_t *idx)
+{
+  khash_t(i) *index;
+  int i, l, m;
+  khint_t k;
+  for (i = 0; i < idx->n; ++i) {
+    index = idx->index[i];
+    for (k = kh_begin(index); k != kh_end(index); ++k) {
+      bam_binlist_t *p;
+      if (!kh_exist(index, k) || kh_key(index, k) == BAM_MAX_BIN) continue;
+      p = &kh_value(index, k);
+      m = 0;
+      for (l = 1; l < (int)p->n; ++l) {
+	if (p->list[m].v>>16 == p->list[l].u>>16) p->list[m].v = p->list[l].v;
+	else p->list[++m] = p->list[l];
+      } // ~for(l)
+      p->n = m + 1;
+    } // ~for(k)
+  } // ~for(i)
+}
+
+static void mt_fill_missing(bam_index_t *idx)
+{
+  int i, j;
+  for (i = 0; i < idx->n; ++i) {
+    bam_lidx_t *idx2 = &idx->index2[i];
+    for (j = 1; j < idx2->n; ++j)
+      if (idx2->offset[j] == 0)
+	idx2->offset[j] = idx2->offset[j-1];
+  }
+}
+
+// #######################################################
+// incremental index building
+// The code has been taken from bam_index_core in bam_index.c.
+// Records are passed in one by one together with the virtual
+// file offset after them. It is used for building an index
+// with several threads and while writing a file.
+// #######################################################
+struct __pysam_index_writer_t
+{
+  bam_index_t *idx;
+  uint32_t last_bin, save_bin;
+  int32_t last_coor, last_tid, save_tid;
+  uint64_t save_off, last_off, n_mapped, n_unmapped, off_beg, off_end, n_no_coor;
+  // set once reads without coordinates have been reached
+  int done;
+  int error;
+};
+
+pysam_index_writer_t * pysam_index_writer_init( int n_targets, uint64_t offset )
+{
+  int i;
+  pysam_index_writer_t *w = (pysam_index_writer_t*)calloc( 1, sizeof(pysam_index_writer_t) );
+  bam_index_t *idx = (bam_index_t*)calloc( 1, sizeof(bam_index_t) );
+  idx->n = n_targets;
+  idx->index = (khash_t(i)**)calloc( idx->n, sizeof(void*) );
+  for (i = 0; i < idx->n; ++i) idx->index[i] = kh_init(i);
+  idx->index2 = (bam_lidx_t*)calloc( idx->n, sizeof(bam_lidx_t) );
+  w->idx = idx;
+  w->save_bin = w->last_bin = 0xffffffffu;
+  w->save_tid = w->last_tid = -1;
+  w->last_coor = -1;
+  w->save_off = w->last_off = w->off_beg = w->off_end = offset;
+  return w;
+}
+
+int pysam_index_writer_push( pysam_index_writer_t *w, const bam1_t *b, uint64_t offset )
+{
+  const bam1_core_t *c = &b->core;
+  bam_index_t *idx = w->idx;
+
+  if (w->error) return -1;
+  if (w->done)
+    {
+      ++w->n_no_coor;
+      if (c->tid >= 0) w->error = 1;
+      return -w->error;
+    }
+  if (c->tid < 0) ++w->n_no_coor;
+  if (w->last_tid < c->tid || (w->last_tid >= 0 && c->tid < 0))
+    { // change of chromosomes
+      w->last_tid = c->tid;
+      w->last_bin = 0xffffffffu;
+    }
+  else if ((uint32_t)w->last_tid > (uint32_t)c->tid ||
+	   (c->tid >= 0 && (uint32_t)w->last_coor > (uint32_t)c->pos))
+    {
+      w->error = 1;
+      return -1;
+    }
+  if (c->tid >= 0 && !(c->flag & BAM_FUNMAP))
+    mt_insert_offset2( &idx->index2[c->tid], (bam1_t*)b, w->last_off );
+  if (c->bin != w->last_bin)
+    { // then possibly write the binning index
+      if (w->save_bin != 0xffffffffu) // save_bin==0xffffffffu only happens to the first record
+	mt_insert_offset( idx->index[w->save_tid], w->save_bin, w->save_off, w->last_off );
+      if (w->last_bin == 0xffffffffu && w->save_tid != -1)
+	{ // write the meta element
+	  w->off_end = w->last_off;
+	  mt_insert_offset( idx->index[w->save_tid], BAM_MAX_BIN, w->off_beg, w->off_end );
+	  mt_insert_offset( idx->index[w->save_tid], BAM_MAX_BIN, w->n_mapped, w->n_unmapped );
+	  w->n_mapped = w->n_unmapped = 0;
+	  w->off_beg = w->off_end;
+	}
+      w->save_off = w->last_off;
+      w->save_bin = w->last_bin = c->bin;
+      w->save_tid = c->tid;
+      if (w->save_tid < 0)
+	{
+	  w->done = 1;
+	  return 0;
+	}
+    }
+  if (c->flag & BAM_FUNMAP) ++w->n_unmapped;
+  else ++w->n_mapped;
+  w->last_off = offset;
+  w->last_coor = c->pos;
+  return 0;
+}
+
+// finish the index at virtual file *offset*, the end of the data.
+static void iw_finish( pysam_index_writer_t *w, uint64_t offset )
+{
+  bam_index_t *idx = w->idx;
+  if (w->save_tid >= 0)
+    {
+      mt_insert_offset( idx->index[w->save_tid], w->save_bin, w->save_off, offset );
+      mt_insert_offset( idx->index[w->save_tid], BAM_MAX_BIN, w->off_beg, offset );
+      mt_insert_offset( idx->index[w->save_tid], BAM_MAX_BIN, w->n_mapped, w->n_unmapped );
+      // prevent a second call from adding the chunks again
+      w->save_tid = -1;
+      mt_merge_chunks( idx );
+      mt_fill_missing( idx );
+      idx->n_no_coor = w->n_no_coor;
+    }
+}
+
+int pysam_index_writer_save( pysam_index_writer_t *w, uint64_t offset, const char *fnidx )
+{
+  FILE *fpidx;
+  if (w->error) return -2;
+  iw_finish( w, offset );
+  if ((fpidx = fopen( fnidx, "wb" )) == 0) return -3;
+  bam_index_save( w->idx, fpidx );
+  if (fclose( fpidx ) != 0) return -3;
+  return 0;
+}
+
+void pysam_index_writer_destroy( pysam_index_writer_t *w )
+{
+  bam_index_destroy( w->idx );
+  free( w );
+}
+
+// same as bam_index_core, reading with several threads.
+static bam_index_t * mt_index_core( mt_reader_t *r )
+{
+  bam1_t *b;
+  int ret, n_targets;
+  pysam_index_writer_t *w;
+  bam_index_t *idx = 0;
+
+  n_targets = mt_read_header( r );
+  if (n_targets < 0) {
+    fprintf(pysamerr, "[pysam_bam_index_build] Invalid BAM header.\n");
+    return NULL;
+  }
+
+  w = pysam_index_writer_init( n_targets, mt_tell(r) );
+  b = bam_init1();
+  while ((ret = mt_read1(r, b)) >= 0)
+    if (pysam_index_writer_push( w, b, mt_tell(r) ) != 0) break;
+
+  if (w->error)
+    fprintf(pysamerr, "[pysam_bam_index_build] the alignment is not sorted (%s).\n", bam1_qname(b));
+  else if (r->error)
+    fprintf(pysamerr, "[pysam_bam_index_build] corrupt BGZF block\n");
+  else
+    {
+      if (ret < -1) fprintf(pysamerr, "[pysam_bam_index_build] truncated file? Continue anyway. (%d)\n", ret);
+      iw_finish( w, mt_tell(r) );
+      idx = w->idx;
+      w->idx = 0;
+    }
+  bam_destroy1( b );
+  pysam_index_writer_destroy( w );
+  return idx;
+}
+
+int pysam_bam_index_build( const char *fn, const char *fnidx, int n_threads )
+{
+  bam_index_t *idx;
+  FILE *fpidx;
+
+  if (n_threads > 1 && !bam_is_be)
+    {
+      mt_reader_t r;
+      FILE *fp;
+      if ((fp = fopen( fn, "rb" )) == 0) return -1;
+      if (mt_reader_init( &r, fp, 0, n_threads ) != 0) { fclose( fp ); return -2; }
+      idx = mt_index_core( &r );
+      mt_reader_destroy( &r );
+      fclose( fp );
+    }
+  else
+    {
+      bamFile fp;
+      if ((fp = bam_open( fn, "r" )) == 0) return -1;
+      idx = bam_index_core( fp );
+      bam_close( fp );
+    }
+  if (idx == 0) return -2;
+
+  if ((fpidx = fopen( fnidx, "wb" )) == 0)
+    {
+      bam_index_destroy( idx );
+      return -3;
+    }
+  bam_index_save( idx, fpidx );
+  bam_index_destroy( idx );
+  if (fclose( fpidx ) != 0) return -3;
+  return 0;
+}
+
+// #######################################################
+// opening files
+// #######################################################
+#include "sam.h"
+
+// taken from sam.c
+#define TYPE_BAM  1
+#define TYPE_READ 2
+
+int pysam_sniff_bam( const char *fn )
+{
+  bamFile fp;
+  char magic[4];
+  int r;
+  if ((fp = bam_open( fn, "r" )) == 0) return -1;
+  // bam_read fails on files that are not BGZF compressed
+  r = bam_read( fp, magic, 4 );
+  bam_close( fp );
+  return r == 4 && strncmp( magic, "BAM\1", 4 ) == 0;
+}
+
+samfile_t * pysam_samopen_with_header( const char *fn,
+				       const bam_header_t *header,
+				       int64_t offset )
+{
+  samfile_t *fp;
+  fp = (samfile_t*)calloc(1, sizeof(samfile_t));
+  fp->type = TYPE_READ | TYPE_BAM;
+  if ((fp->x.bam = bam_open( fn, "r" )) == 0)
+    {
+      free( fp );
+      return NULL;
+    }
+  if (bam_seek( fp->x.bam, offset, SEEK_SET ) < 0)
+    {
+      bam_close( fp->x.bam );
+      free( fp );
+      return NULL;
+    }
+  fp->header = bam_header_dup( header );
+  return fp;
+}
+
+// #######################################################
+// lazily loaded bam index
+// The index file is memory mapped and nothing but the
+// header is read when the index is opened. The format has
+// no table of contents, so the position of a reference is
+// found by skipping over the references before it. Positions
+// are cached so that every reference is skipped at most once.
+// Bins and linear index of a reference are decoded on first
+// use, read counts of the meta bin when they are asked for.
+// The format is described in bam_index_load_core in
+// bam_index.c.
+// #######################################################
+#define LAZY_META   1
+#define LAZY_BINS   2
+
+typedef struct
+{
+  // must be first, passed to samtools functions
+  bam_index_t idx;
+  char *map;
+  size_t map_len;
+  // position of each reference in the mapped file. offset[n]
+  // is the end of the last reference. Only the first
+  // n_located entries are known.
+  size_t *offset;
+  int32_t n_located;
+  // LAZY_* flags of the parts decoded for each reference
+  uint8_t *loaded;
+} pysam_lazy_index_t;
+
+static inline int32_t lazy_get32( const char *p ) { int32_t x; memcpy( &x, p, 4 ); return x; }
+
+// return position after the data for a reference starting
+// at *p* or 0 if the file is truncated.
+static size_t lazy_skip_reference( const pysam_lazy_index_t *lidx, size_t p )
+{
+  int32_t n_bin, n_chunk, n_intv, j;
+  if (p + 4 > lidx->map_len) return 0;
+  n_bin = lazy_get32( lidx->map + p ); p += 4;
+  for (j = 0; j < n_bin; ++j)
+    {
+      if (p + 8 > lidx->map_len) return 0;
+      n_chunk = lazy_get32( lidx->map + p + 4 );
+      p += 8 + (size_t)n_chunk * 16;
+    }
+  if (p + 4 > lidx->map_len) return 0;
+  n_intv = lazy_get32( lidx->map + p ); p += 4;
+  p += (size_t)n_intv * 8;
+  if (p > lidx->map_len) return 0;
+  return p;
+}
+
+// make sure the positions of reference *tid* and of the
+// reference after it are known, scanning forward from the
+// last known position. Returns -1 if the file is truncated.
+static int lazy_locate( pysam_lazy_index_t *lidx, int32_t tid )
+{
+  size_t p;
+  while (lidx->n_located <= tid + 1)
+    {
+      p = lazy_skip_reference( lidx, lidx->offset[lidx->n_located - 1] );
+      if (p == 0)
+	{
+	  fprintf(pysamerr, "[pysam_bam_index_load_lazy] invalid or truncated index.\n");
+	  return -1;
+	}
+      lidx->offset[lidx->n_located++] = p;
+    }
+  return 0;
+}
+
+// add bins of the reference at *p* to *index*. *which*
+// selects the meta bin (LAZY_META), all other bins
+// (LAZY_BINS) or both.
+static void lazy_load_bins( const pysam_lazy_index_t *lidx, size_t p, khash_t(i) *index, int which )
+{
+  int32_t n_bin, j;
+  uint32_t key;
+  khint_t k;
+  int ret;
+  bam_binlist_t *l;
+  n_bin = lazy_get32( lidx->map + p ); p += 4;
+  for (j = 0; j < n_bin; ++j)
+    {
+      memcpy( &key, lidx->map + p, 4 );
+      if (!(which & (key == BAM_MAX_BIN ? LAZY_META : LAZY_BINS)))
+	{
+	  p += 8 + (size_t)lazy_get32( lidx->map + p + 4 ) * 16;
+	  continue;
+	}
+      k = kh_put(i, index, key, &ret);
+      l = &kh_value(index, k);
+      l->n = l->m = lazy_get32( lidx->map + p + 4 );
+      l->list = (pair64_t*)malloc( l->m * 16 );
+      memcpy( l->list, lidx->map + p + 8, l->n * 16 );
+      p += 8 + (size_t)l->n * 16;
+    }
+}
+
+// decode the parts in *which* of reference *tid*.
+static int lazy_load( pysam_lazy_index_t *lidx, int32_t tid, int which )
+{
+  bam_index_t *idx = &lidx->idx;
+  bam_lidx_t *index2;
+  size_t p;
+  int32_t n_intv;
+
+  which &= ~lidx->loaded[tid];
+  if (which == 0) return 0;
+  if (lazy_locate( lidx, tid ) < 0) return -2;
+
+  if (idx->index[tid] == NULL) idx->index[tid] = kh_init(i);
+  p = lidx->offset[tid];
+  lazy_load_bins( lidx, p, idx->index[tid], which );
+
+  if (which & LAZY_BINS)
+    {
+      // linear index follows the bins
+      int32_t j, n_bin = lazy_get32( lidx->map + p );
+      p += 4;
+      for (j = 0; j < n_bin; ++j)
+	p += 8 + (size_t)lazy_get32( lidx->map + p + 4 ) * 16;
+      n_intv = lazy_get32( lidx->map + p ); p += 4;
+      index2 = &idx->index2[tid];
+      index2->n = index2->m = n_intv;
+      index2->offset = (uint64_t*)calloc( n_intv, 8 );
+      memcpy( index2->offset, lidx->map + p, (size_t)n_intv * 8 );
+    }
+  lidx->loaded[tid] |= which;
+  return 0;
+}
+
+bam_index_t * pysam_bam_index_load_lazy( const char *fnidx )
+{
+  pysam_lazy_index_t *lidx;
+  bam_index_t *idx;
+  char *map;
+  size_t len;
+  int32_t n;
+
+  // keep it simple on big-endian machines
+  if (bam_is_be) return NULL;
+
+#ifndef _WIN32
+  struct stat st;
+  int fd = open( fnidx, O_RDONLY );
+  if (fd < 0) return NULL;
+  if (fstat( fd, &st ) < 0 || st.st_size < 8) { close( fd ); return NULL; }
+  len = st.st_size;
+  map = (char*)mmap( NULL, len, PROT_READ, MAP_SHARED, fd, 0 );
+  close( fd );
+  if (map == MAP_FAILED) return NULL;
+#else
+  FILE *fp = fopen( fnidx, "rb" );
+  if (fp == NULL) return NULL;
+  fseek( fp, 0, SEEK_END );
+  len = ftell( fp );
+  fseek( fp, 0, SEEK_SET );
+  if (len < 8) { fclose( fp ); return NULL; }
+  map = (char*)malloc( len );
+  if (fread( map, 1, len, fp ) != len) { free( map ); fclose( fp ); return NULL; }
+  fclose( fp );
+#endif
+
+  lidx = (pysam_lazy_index_t*)calloc( 1, sizeof(pysam_lazy_index_t) );
+  lidx->map = map;
+  lidx->map_len = len;
+  idx = &lidx->idx;
+  n = lazy_get32( map + 4 );
+  if (memcmp( map, "BAI\1", 4 ) != 0 || n < 0)
+    {
+      fprintf(pysamerr, "[pysam_bam_index_load_lazy] invalid or truncated index.\n");
+      pysam_bam_index_destroy_lazy( idx );
+      return NULL;
+    }
+
+  // hashes are created when a reference is first used
+  idx->n = n;
+  idx->index = (khash_t(i)**)calloc( n, sizeof(void*) );
+  idx->index2 = (bam_lidx_t*)calloc( n, sizeof(bam_lidx_t) );
+  lidx->offset = (size_t*)calloc( n + 1, sizeof(size_t) );
+  lidx->loaded = (uint8_t*)calloc( n, 1 );
+  lidx->offset[0] = 8;
+  lidx->n_located = 1;
+  return idx;
+}
+
+int pysam_bam_index_load_tid( bam_index_t *idx, int tid )
+{
+  pysam_lazy_index_t *lidx = (pysam_lazy_index_t*)idx;
+  if (tid < 0)
+    {
+      for (tid = 0; tid < idx->n; ++tid)
+	if (lazy_load( lidx, tid, LAZY_META | LAZY_BINS ) < 0) return -2;
+      return 0;
+    }
+  if (tid >= idx->n) return -1;
+  return lazy_load( lidx, tid, LAZY_META | LAZY_BINS );
+}
+
+int pysam_bam_index_load_counts( bam_index_t *idx, int tid )
+{
+  pysam_lazy_index_t *lidx = (pysam_lazy_index_t*)idx;
+  if (tid < 0)
+    {
+      for (tid = 0; tid < idx->n; ++tid)
+	if (lazy_load( lidx, tid, LAZY_META ) < 0) return -2;
+      // reads without coordinate follow the last reference
+      if (lazy_locate( lidx, idx->n - 1 ) < 0) return -2;
+      if (lidx->offset[idx->n] + 8 <= lidx->map_len)
+	memcpy( &idx->n_no_coor, lidx->map + lidx->offset[idx->n], 8 );
+      return 0;
+    }
+  if (tid >= idx->n) return -1;
+  return lazy_load( lidx, tid, LAZY_META );
+}
+
+void pysam_bam_index_destroy_lazy( bam_index_t *idx )
+{
+  pysam_lazy_index_t *lidx = (pysam_lazy_index_t*)idx;
+  int i;
+  if (idx == NULL) return;
+  if (lidx->map != NULL)
+    {
+#ifndef _WIN32
+      munmap( lidx->map, lidx->map_len );
+#else
+      free( lidx->map );
+#endif
+    }
+  free( lidx->offset );
+  free( lidx->loaded );
+  // references never used have no hash
+  for (i = 0; i < idx->n; ++i)
+    if (idx->index[i] == NULL) idx->index[i] = kh_init(i);
+  // frees lidx
+  bam_index_destroy( idx );
+}
+
+// #######################################################
+// external merge sort
+// Records are buffered up to a memory limit. Each buffer is
+// split into slices that are sorted in parallel and merged
+// into a temporary run file. The runs are merged into the
+// output file at the end. Adapted from bam_sort.c
+// #######################################################
+#define SRT_NONE  0
+#define SRT_NUM   1
+#define SRT_STR   2
+#define SRT_QNAME 3
+
+typedef struct
+{
+  int type;
+  double num;
+  const char *str;
+  uint64_t pos;
+  bam1_t *b;
+} srt_key_t;
+
+typedef struct
+{
+  int by;
+  char tag[2];
+} srt_conf_t;
+
+// a sorted source of records, either a slice of keys in memory
+// or a run file on disk.
+typedef struct
+{
+  srt_key_t key;
+  srt_key_t *next, *end;
+  bamFile fp;
+  bam1_t *b;
+  int i;
+} srt_src_t;
+
+typedef struct
+{
+  srt_key_t *keys;
+  size_t n;
+} srt_worker_t;
+
+// taken from bam_sort.c
+static int srt_strnum_cmp( const char *_a, const char *_b )
+{
+  const unsigned char *a = (const unsigned char*)_a, *b = (const unsigned char*)_b;
+  const unsigned char *pa = a, *pb = b;
+  while (*pa && *pb) {
+    if (isdigit(*pa) && isdigit(*pb)) {
+      while (*pa == '0') ++pa;
+      while (*pb == '0') ++pb;
+      while (isdigit(*pa) && isdigit(*pb) && *pa == *pb) ++pa, ++pb;
+      if (isdigit(*pa) && isdigit(*pb)) {
+	int i = 0;
+	while (isdigit(pa[i]) && isdigit(pb[i])) ++i;
+	return isdigit(pa[i])? 1 : isdigit(pb[i])? -1 : (int)*pa - (int)*pb;
+      } else if (isdigit(*pa)) return 1;
+      else if (isdigit(*pb)) return -1;
+      else if (pa - a != pb - b) return pa - a < pb - b? 1 : -1;
+    } else {
+      if (*pa != *pb) return (int)*pa - (int)*pb;
+      ++pa; ++pb;
+    }
+  }
+  return *pa? 1 : *pb? -1 : 0;
+}
+
+// taken from bam_sort.c
+static int srt_change_SO( bam_header_t *h, const char *so )
+{
+  char *p, *q, *beg = 0, *end = 0, *newtext;
+  if (h->l_text > 3) {
+    if (strncmp(h->text, "@HD", 3) == 0) {
+      if ((p = strchr(h->text, '\n')) == 0) return -1;
+      *p = '\0';
+      if ((q = strstr(h->text, "\tSO:")) != 0) {
+	*p = '\n'; // change back
+	if (strncmp(q + 4, so, p - q - 4) != 0) {
+	  beg = q;
+	  for (q += 4; *q != '\n' && *q != '\t'; ++q);
+	  end = q;
+	} else return 0; // no need to change
+      } else beg = end = p, *p = '\n';
+    }
+  }
+  if (beg == 0) { // no @HD
+    h->l_text += strlen(so) + 15;
+    newtext = malloc(h->l_text + 1);
+    sprintf(newtext, "@HD\tVN:1.3\tSO:%s\n", so);
+    if (h->text) strcat(newtext, h->text);
+  } else { // has @HD but different or no SO
+    h->l_text = (beg - h->text) + (4 + strlen(so)) + (h->text + h->l_text - end);
+    newtext = malloc(h->l_text + 1);
+    strncpy(newtext, h->text, beg - h->text);
+    sprintf(newtext + (beg - h->text), "\tSO:%s", so);
+    strcat(newtext, end);
+  }
+  free(h->text);
+  h->text = newtext;
+  return 0;
+}
+
+static void srt_set_key( srt_key_t *k, bam1_t *b, const srt_conf_t *c )
+{
+  uint8_t *s;
+  k->b = b;
+  k->pos = (uint64_t)b->core.tid<<32 | (uint32_t)((b->core.pos+1)<<1 | bam1_strand(b));
+  k->type = SRT_NONE;
+  k->num = 0;
+  k->str = 0;
+  if (c->by == PYSAM_SORT_QUERYNAME)
+    {
+      k->type = SRT_QNAME;
+      k->str = bam1_qname(b);
+      k->num = b->core.flag & 0xc0;
+    }
+  else if (c->by == PYSAM_SORT_TAG && (s = bam_aux_get( b, c->tag )) != 0)
+    {
+      switch (*s) {
+      case 'c': case 'C': case 's': case 'S': case 'i': case 'I':
+	k->type = SRT_NUM; k->num = bam_aux2i(s); break;
+      case 'f':
+	k->type = SRT_NUM; k->num = bam_aux2f(s); break;
+      case 'd':
+	k->type = SRT_NUM; k->num = bam_aux2d(s); break;
+      case 'A':
+	k->type = SRT_NUM; k->num = bam_aux2A(s); break;
+      case 'Z': case 'H':
+	k->type = SRT_STR; k->str = bam_aux2Z(s); break;
+      }
+    }
+}
+
+static inline int srt_cmp( const srt_key_t *a, const srt_key_t *b )
+{
+  int t;
+  if (a->type != b->type) return a->type < b->type ? -1 : 1;
+  switch (a->type) {
+  case SRT_NUM:
+    if (a->num != b->num) return a->num < b->num ? -1 : 1;
+    break;
+  case SRT_STR:
+    if ((t = strcmp( a->str, b->str )) != 0) return t;
+    break;
+  case SRT_QNAME:
+    if ((t = srt_strnum_cmp( a->str, b->str )) != 0) return t;
+    if (a->num != b->num) return a->num < b->num ? -1 : 1;
+    return 0;
+  }
+  if (a->pos != b->pos) return a->pos < b->pos ? -1 : 1;
+  return 0;
+}
+
+#define srt_lt(a, b) (srt_cmp( &(a), &(b) ) < 0)
+KSORT_INIT(srt, srt_key_t, srt_lt);
+
+// ties are broken by source so that the sort is stable
+static inline int srt_src_lt( const srt_src_t *a, const srt_src_t *b )
+{
+  int t = srt_cmp( &a->key, &b->key );
+  return t < 0 || (t == 0 && a->i < b->i);
+}
+
+// move to next record. Returns 1 on success, 0 at the end
+// and -1 on error.
+static int srt_src_advance( srt_src_t *s, const srt_conf_t *c )
+{
+  int r;
+  if (s->fp)
+    {
+      if ((r = bam_read1( s->fp, s->b )) < 0) return r == -1 ? 0 : -1;
+      srt_set_key( &s->key, s->b, c );
+      return 1;
+    }
+  if (s->next == s->end) return 0;
+  s->key = *s->next++;
+  return 1;
+}
+
+static void srt_heap_down( srt_src_t **h, int n, int i )
+{
+  int k;
+  srt_src_t *tmp = h[i];
+  while ((k = (i << 1) + 1) < n)
+    {
+      if (k + 1 < n && srt_src_lt( h[k+1], h[k] )) ++k;
+      if (!srt_src_lt( h[k], tmp )) break;
+      h[i] = h[k];
+      i = k;
+    }
+  h[i] = tmp;
+}
+
+// merge *n* sorted sources into *out*.
+static int srt_merge( srt_src_t *src, int n, bamFile out, const srt_conf_t *c, int64_t *n_reads )
+{
+  srt_src_t **h = (srt_src_t**)malloc( n * sizeof(srt_src_t*) );
+  int i, r, m = 0, ret = 0;
+  for (i = 0; i < n; ++i)
+    {
+      if ((r = srt_src_advance( &src[i], c )) < 0) { ret = -2; goto merge_end; }
+      if (r) h[m++] = &src[i];
+    }
+  for (i = m / 2 - 1; i >= 0; --i) srt_heap_down( h, m, i );
+  while (m > 0)
+    {
+      if (bam_write1( out, h[0]->key.b ) < 0) { ret = -3; goto merge_end; }
+      ++*n_reads;
+      if ((r = srt_src_advance( h[0], c )) < 0) { ret = -2; goto merge_end; }
+      if (r == 0) h[0] = h[--m];
+      if (m > 0) srt_heap_down( h, m, 0 );
+    }
+ merge_end:
+  free( h );
+  return ret;
+}
+
+static void * srt_worker( void * data )
+{
+  srt_worker_t *w = (srt_worker_t*)data;
+  ks_mergesort( srt, w->n, w->keys, 0 );
+  return 0;
+}
+
+// sort *n* keys using *n_threads* threads and write them to *out*.
+static int srt_write_block( srt_key_t *keys, size_t n, int n_threads,
+			    bamFile out, const srt_conf_t *c )
+{
+  int i, ret;
+  size_t rest = n;
+  int64_t n_written = 0;
+  srt_key_t *p = keys;
+  srt_worker_t *w;
+  srt_src_t *src;
+  pthread_t *tid;
+
+  // use a single thread for small blocks
+  if (n_threads < 1 || n < (size_t)n_threads * 64) n_threads = 1;
+  w = (srt_worker_t*)calloc( n_threads, sizeof(srt_worker_t) );
+  src = (srt_src_t*)calloc( n_threads, sizeof(srt_src_t) );
+  for (i = 0; i < n_threads; ++i)
+    {
+      w[i].keys = p;
+      w[i].n = rest / (n_threads - i);
+      p += w[i].n; rest -= w[i].n;
+    }
+  if (n_threads == 1)
+    srt_worker( &w[0] );
+  else
+    {
+      tid = (pthread_t*)calloc( n_threads, sizeof(pthread_t) );
+      for (i = 0; i < n_threads; ++i)
+	pthread_create( &tid[i], 0, srt_worker, &w[i] );
+      for (i = 0; i < n_threads; ++i)
+	pthread_join( tid[i], 0 );
+      free( tid );
+    }
+  for (i = 0; i < n_threads; ++i)
+    {
+      src[i].next = w[i].keys;
+      src[i].end = w[i].keys + w[i].n;
+      src[i].i = i;
+    }
+  ret = srt_merge( src, n_threads, out, c, &n_written );
+  free( src );
+  free( w );
+  return ret;
+}
+
+static char * srt_run_name( const char *prefix, int i )
+{
+  char *name = (char*)calloc( strlen( prefix ) + 20, 1 );
+  sprintf( name, "%s.%.4d.bam", prefix, i );
+  return name;
+}
+
+// write *k* records in *buf* as run file *n_runs*.
+static int srt_write_run( const char *prefix, int n_runs, bam1_t **buf, srt_key_t *keys,
+			  size_t k, const bam_header_t *h, int n_threads, const srt_conf_t *c )
+{
+  size_t i;
+  int ret;
+  bamFile fp;
+  char *name = srt_run_name( prefix, n_runs );
+  fp = bam_open( name, "w1" );
+  free( name );
+  if (fp == 0) return -3;
+  for (i = 0; i < k; ++i) srt_set_key( &keys[i], buf[i], c );
+  bam_header_write( fp, h );
+  ret = srt_write_block( keys, k, n_threads, fp, c );
+  if (bam_close( fp ) < 0 && ret == 0) ret = -3;
+  return ret;
+}
+
+int pysam_bam_sort( const char *fn, const char *fnout, const char *prefix,
+		    int by, const char *tag, size_t max_mem, int n_threads,
+		    int level, int64_t *n_reads )
+{
+  int r, ret = 0, n_runs = 0, i;
+  size_t mem = 0, max_k = 0, k = 0;
+  char mode[8];
+  srt_conf_t conf;
+  bam_header_t *header;
+  bamFile fp, out = 0;
+  bam1_t *b, **buf = 0;
+  srt_key_t *keys = 0;
+  srt_src_t *src;
+
+  *n_reads = 0;
+  if (n_threads < 1) n_threads = 1;
+  conf.by = by;
+  if (by == PYSAM_SORT_TAG) memcpy( conf.tag, tag, 2 );
+
+  if ((fp = bam_open( fn, "r" )) == 0) return -1;
+  header = bam_header_read( fp );
+  if (header == 0) { bam_close( fp ); return -2; }
+  srt_change_SO( header, by == PYSAM_SORT_COORDINATE ? "coordinate" :
+		 by == PYSAM_SORT_QUERYNAME ? "queryname" : "unknown" );
+
+  // write sorted runs
+  for (;;)
+    {
+      if (k == max_k)
+	{
+	  size_t old_max = max_k;
+	  max_k = max_k ? max_k << 1 : 0x10000;
+	  buf = (bam1_t**)realloc( buf, max_k * sizeof(bam1_t*) );
+	  keys = (srt_key_t*)realloc( keys, max_k * sizeof(srt_key_t) );
+	  memset( buf + old_max, 0, sizeof(bam1_t*) * (max_k - old_max) );
+	}
+      if (buf[k] == 0) buf[k] = bam_init1();
+      b = buf[k];
+      if ((r = bam_read1( fp, b )) < 0) break;
+      if (b->data_len < b->m_data >> 2)
+	{ // shrink
+	  b->m_data = b->data_len;
+	  kroundup32( b->m_data );
+	  b->data = realloc( b->data, b->m_data );
+	}
+      mem += sizeof(bam1_t) + b->m_data + sizeof(bam1_t*) + sizeof(srt_key_t);
+      ++k;
+      if (mem >= max_mem)
+	{
+	  if ((ret = srt_write_run( prefix, n_runs++, buf, keys, k, header, n_threads, &conf )) != 0)
+	    goto sort_end;
+	  mem = k = 0;
+	}
+    }
+  if (r != -1) { ret = -2; goto sort_end; }
+
+  strcpy( mode, "w" );
+  if (level >= 0) sprintf( mode + 1, "%d", level < 9 ? level : 9 );
+  if ((out = bam_open( fnout, mode )) == 0) { ret = -3; goto sort_end; }
+  if (n_threads > 1) bgzf_mt( out, n_threads, 256 );
+  bam_header_write( out, header );
+
+  if (n_runs == 0)
+    {
+      // a single block, sort in memory
+      size_t j;
+      for (j = 0; j < k; ++j) srt_set_key( &keys[j], buf[j], &conf );
+      ret = srt_write_block( keys, k, n_threads, out, &conf );
+      *n_reads = k;
+    }
+  else
+    {
+      if (k > 0 &&
+	  (ret = srt_write_run( prefix, n_runs++, buf, keys, k, header, n_threads, &conf )) != 0)
+	goto sort_end;
+      // release the buffer before merging
+      for (k = 0; k < max_k; ++k) if (buf[k]) bam_destroy1( buf[k] );
+      free( buf ); buf = 0; max_k = 0;
+      free( keys ); keys = 0;
+
+      src = (srt_src_t*)calloc( n_runs, sizeof(srt_src_t) );
+      for (i = 0; i < n_runs; ++i)
+	{
+	  char *name = srt_run_name( prefix, i );
+	  src[i].i = i;
+	  src[i].b = bam_init1();
+	  if ((src[i].fp = bam_open( name, "r" )) == 0) ret = -3;
+	  else bam_header_destroy( bam_header_read( src[i].fp ) );
+	  free( name );
+	}
+      if (ret == 0) ret = srt_merge( src, n_runs, out, &conf, n_reads );
+      for (i = 0; i < n_runs; ++i)
+	{
+	  if (src[i].fp) bam_close( src[i].fp );
+	  bam_destroy1( src[i].b );
+	}
+      free( src );
+    }
+
+ sort_end:
+  if (out && bam_close( out ) < 0 && ret == 0) ret = -3;
+  for (i = 0; i < n_runs; ++i)
+    {
+      char *name = srt_run_name( prefix, i );
+      unlink( name );
+      free( name );
+    }
+  for (k = 0; k < max_k; ++k) if (buf[k]) bam_destroy1( buf[k] );
+  free( buf );
+  free( keys );
+  bam_header_destroy( header );
+  bam_close( fp );
+  return ret;
+}
+
+// #######################################################
+// reading and writing through a file descriptor
+// #######################################################
+
+// bam_header_read without the check for the EOF marker, which
+// requires seeking and is not possible on pipes.
+static bam_header_t * stream_header_read( bamFile fp )
+{
+  bam_header_t *header;
+  char buf[4];
+  int32_t i, name_len;
+  if (bam_read( fp, buf, 4 ) != 4 || strncmp( buf, "BAM\001", 4 ) != 0)
+    return 0;
+  header = bam_header_init();
+  bam_read(fp, &header->l_text, 4);
+  if (bam_is_be) bam_swap_endian_4p(&header->l_text);
+  header->text = (char*)calloc(header->l_text + 1, 1);
+  bam_read(fp, header->text, header->l_text);
+  bam_read(fp, &header->n_targets, 4);
+  if (bam_is_be) bam_swap_endian_4p(&header->n_targets);
+  header->target_name = (char**)calloc(header->n_targets, sizeof(char*));
+  header->target_len = (uint32_t*)calloc(header->n_targets, 4);
+  for (i = 0; i != header->n_targets; ++i) {
+    bam_read(fp, &name_len, 4);
+    if (bam_is_be) bam_swap_endian_4p(&name_len);
+    header->target_name[i] = (char*)calloc(name_len, 1);
+    bam_read(fp, header->target_name[i], name_len);
+    bam_read(fp, &header->target_len[i], 4);
+    if (bam_is_be) bam_swap_endian_4p(&header->target_len[i]);
+  }
+  return header;
+}
+
+samfile_t * pysam_samdopen( int fd, const char *mode, const bam_header_t *header )
+{
+  samfile_t *fp = (samfile_t*)calloc( 1, sizeof(samfile_t) );
+  if (strchr( mode, 'r' ))
+    {
+      fp->type = TYPE_READ | TYPE_BAM;
+      if ((fp->x.bam = bam_dopen( fd, "r" )) == 0) goto dopen_err;
+      if ((fp->header = stream_header_read( fp->x.bam )) == 0)
+	{
+	  bam_close( fp->x.bam );
+	  free( fp );
+	  return NULL;
+	}
+    }
+  else
+    {
+      // taken from samopen
+      char bmode[3];
+      int i, compress_level = -1;
+      for (i = 0; mode[i]; ++i) if (mode[i] >= '0' && mode[i] <= '9') break;
+      if (mode[i]) compress_level = mode[i] - '0';
+      if (strchr(mode, 'u')) compress_level = 0;
+      bmode[0] = 'w'; bmode[1] = compress_level < 0? 0 : compress_level + '0'; bmode[2] = 0;
+      fp->type = TYPE_BAM;
+      if ((fp->x.bam = bam_dopen( fd, bmode )) == 0) goto dopen_err;
+      fp->header = bam_header_dup( header );
+      bam_header_write( fp->x.bam, fp->header );
+    }
+  return fp;
+
+ dopen_err:
+  close( fd );
+  free( fp );
+  return NULL;
+}
+
+// #######################################################
+// serializing and compressing records in memory
+// #######################################################
+static int buffer_reserve( pysam_buffer_t *buf, size_t len )
+{
+  if (buf->l + len > buf->m)
+    {
+      size_t m = buf->l + len;
+      uint8_t *s;
+      kroundup32( m );
+      if ((s = (uint8_t*)realloc( buf->s, m )) == 0) return -1;
+      buf->s = s;
+      buf->m = m;
+    }
+  return 0;
+}
+
+int pysam_buffer_add( pysam_buffer_t *buf, const void *data, size_t len )
+{
+  if (buffer_reserve( buf, len ) < 0) return -1;
+  memcpy( buf->s + buf->l, data, len );
+  buf->l += len;
+  return 0;
+}
+
+void pysam_buffer_free( pysam_buffer_t *buf )
+{
+  free( buf->s );
+  buf->s = 0;
+  buf->l = buf->m = 0;
+}
+
+// same layout as bam_write1_core, little endian only
+void pysam_bam_serialize( const bam1_t *b, uint8_t *dst )
+{
+  const bam1_core_t *c = &b->core;
+  uint32_t x[8];
+  int32_t block_len = b->data_len + BAM_CORE_SIZE;
+  x[0] = c->tid;
+  x[1] = c->pos;
+  x[2] = (uint32_t)c->bin<<16 | c->qual<<8 | c->l_qname;
+  x[3] = (uint32_t)c->flag<<16 | c->n_cigar;
+  x[4] = c->l_qseq;
+  x[5] = c->mtid;
+  x[6] = c->mpos;
+  x[7] = c->isize;
+  memcpy( dst, &block_len, 4 );
+  memcpy( dst + 4, x, BAM_CORE_SIZE );
+  memcpy( dst + 4 + BAM_CORE_SIZE, b->data, b->data_len );
+}
+
+// same layout as bam_read1, little endian only
+int pysam_bam_deserialize( bam1_t *b, const uint8_t *src, size_t len )
+{
+  bam1_core_t *c = &b->core;
+  int32_t block_len;
+  uint32_t x[8];
+  int data_len;
+  if (len < 4 + BAM_CORE_SIZE) return -1;
+  memcpy( &block_len, src, 4 );
+  if (block_len < BAM_CORE_SIZE || (size_t)block_len + 4 != len) return -1;
+  memcpy( x, src + 4, BAM_CORE_SIZE );
+  data_len = block_len - BAM_CORE_SIZE;
+  if ((x[2] & 0xff) == 0) return -1;
+  // the variable length fields must fit into the record
+  if ((int64_t)(x[2] & 0xff) + (int64_t)(x[3] & 0xffff) * 4 +
+      (int64_t)x[4] + ((int64_t)x[4] + 1) / 2 > data_len)
+    return -1;
+  if (b->m_data < data_len)
+    {
+      uint8_t *data = (uint8_t*)realloc( b->data, data_len );
+      if (data == 0) return -2;
+      b->data = data;
+      b->m_data = data_len;
+    }
+  c->tid = x[0]; c->pos = x[1];
+  c->bin = x[2]>>16; c->qual = x[2]>>8&0xff; c->l_qname = x[2]&0xff;
+  c->flag = x[3]>>16; c->n_cigar = x[3]&0xffff;
+  c->l_qseq = x[4];
+  c->mtid = x[5]; c->mpos = x[6]; c->isize = x[7];
+  b->data_len = data_len;
+  memcpy( b->data, src + 4 + BAM_CORE_SIZE, data_len );
+  b->l_aux = data_len - c->n_cigar * 4 - c->l_qname - c->l_qseq - (c->l_qseq+1)/2;
+  return 0;
+}
+
+int pysam_buffer_add_bam( pysam_buffer_t *buf, const bam1_t *b )
+{
+  if (buffer_reserve( buf, 4 + BAM_CORE_SIZE + b->data_len ) < 0) return -1;
+  pysam_bam_serialize( b, buf->s + buf->l );
+  buf->l += 4 + BAM_CORE_SIZE + b->data_len;
+  return 0;
+}
+
+// same layout as bam_header_write, little endian only
+int pysam_buffer_add_header( pysam_buffer_t *buf, const bam_header_t *h )
+{
+  int32_t i, name_len;
+  if (pysam_buffer_add( buf, "BAM\001", 4 ) < 0) return -1;
+  if (pysam_buffer_add( buf, &h->l_text, 4 ) < 0) return -1;
+  if (h->l_text && pysam_buffer_add( buf, h->text, h->l_text ) < 0) return -1;
+  if (pysam_buffer_add( buf, &h->n_targets, 4 ) < 0) return -1;
+  for (i = 0; i < h->n_targets; ++i)
+    {
+      name_len = strlen( h->target_name[i] ) + 1;
+      if (pysam_buffer_add( buf, &name_len, 4 ) < 0) return -1;
+      if (pysam_buffer_add( buf, h->target_name[i], name_len ) < 0) return -1;
+      if (pysam_buffer_add( buf, &h->target_len[i], 4 ) < 0) return -1;
+    }
+  return 0;
+}
+
+#define BGZF_MAX_BLOCK 0x10000
+#define BGZF_DATA_BLOCK 0xff00
+
+// taken from bgzf_compress in bgzf.c
+static int bgzf_block_compress( uint8_t *dst, int *dlen, const uint8_t *src, int slen, int level )
+{
+  static const uint8_t magic[19] = "\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0\0\0";
+  uint32_t crc;
+  z_stream zs;
+  zs.zalloc = NULL; zs.zfree = NULL;
+  zs.next_in = (Bytef*)src;
+  zs.avail_in = slen;
+  zs.next_out = dst + 18;
+  zs.avail_out = *dlen - 18 - 8;
+  if (deflateInit2(&zs, level, Z_DEFLATED, -15, 8, Z_DEFAULT_STRATEGY) != Z_OK) return -1;
+  if (deflate(&zs, Z_FINISH) != Z_STREAM_END) { deflateEnd(&zs); return -1; }
+  if (deflateEnd(&zs) != Z_OK) return -1;
+  *dlen = zs.total_out + 18 + 8;
+  memcpy(dst, magic, 18);
+  dst[16] = (*dlen - 1) & 0xff; dst[17] = (*dlen - 1) >> 8;
+  crc = crc32(crc32(0L, NULL, 0L), src, slen);
+  dst[*dlen - 8] = crc; dst[*dlen - 7] = crc >> 8; dst[*dlen - 6] = crc >> 16; dst[*dlen - 5] = crc >> 24;
+  dst[*dlen - 4] = slen; dst[*dlen - 3] = slen >> 8; dst[*dlen - 2] = slen >> 16; dst[*dlen - 1] = slen >> 24;
+  return 0;
+}
+
+static int buffer_compress( const pysam_buffer_t *src, pysam_buffer_t *dst, int level )
+{
+  size_t p;
+  int slen, dlen;
+  dst->l = 0;
+  for (p = 0; p < src->l; p += slen)
+    {
+      slen = src->l - p < BGZF_DATA_BLOCK ? src->l - p : BGZF_DATA_BLOCK;
+      if (buffer_reserve( dst, BGZF_MAX_BLOCK ) < 0) return -1;
+      dlen = BGZF_MAX_BLOCK;
+      if (bgzf_block_compress( dst->s + dst->l, &dlen, src->s + p, slen, level ) < 0) return -1;
+      dst->l += dlen;
+    }
+  return 0;
+}
+
+typedef struct
+{
+  pysam_buffer_t **src, **dst;
+  int n, level, next, error;
+  pthread_mutex_t *lock;
+} compress_worker_t;
+
+static void * compress_worker( void * data )
+{
+  compress_worker_t *w = (compress_worker_t*)data;
+  int i;
+  for (;;)
+    {
+      pthread_mutex_lock( w->lock );
+      i = w->next++;
+      pthread_mutex_unlock( w->lock );
+      if (i >= w->n) break;
+      if (buffer_compress( w->src[i], w->dst[i], w->level ) < 0)
+	{
+	  pthread_mutex_lock( w->lock );
+	  w->error = 1;
+	  pthread_mutex_unlock( w->lock );
+	}
+    }
+  return 0;
+}
+
+int pysam_buffer_compress_many( pysam_buffer_t **src, pysam_buffer_t **dst,
+				int n, int level, int n_threads )
+{
+  compress_worker_t w;
+  pthread_mutex_t lock;
+  pthread_t *tid;
+  int i;
+  if (level < 0) level = Z_DEFAULT_COMPRESSION;
+  pthread_mutex_init( &lock, 0 );
+  w.src = src; w.dst = dst; w.n = n; w.level = level;
+  w.next = 0; w.error = 0; w.lock = &lock;
+  if (n_threads > n) n_threads = n;
+  if (n_threads <= 1)
+    compress_worker( &w );
+  else
+    {
+      tid = (pthread_t*)calloc( n_threads, sizeof(pthread_t) );
+      for (i = 0; i < n_threads; ++i)
+	pthread_create( &tid[i], 0, compress_worker, &w );
+      for (i = 0; i < n_threads; ++i)
+	pthread_join( tid[i], 0 );
+      free( tid );
+    }
+  pthread_mutex_destroy( &lock );
+  return w.error ? -1 : 0;
+}
+
+// #######################################################
+// marking duplicates
+// Reads are grouped by reference, unclipped 5' position and
+// orientation, pairs additionally by the position and
+// orientation of the mate. Within a group, the read with the
+// highest sum of base qualities >= 15 is kept. Reads are
+// buffered until no later read can join their groups.
+// #######################################################
+#define MD_FRAGMENT 0
+#define MD_PAIR     1
+
+#define MD_NONE   0
+#define MD_SINGLE 1
+#define MD_FIRST  2
+#define MD_SECOND 3
+
+#define MD_MIN_QUAL 15
+#define MD_FSUPPLEMENTARY 2048
+
+typedef struct
+{
+  int32_t tid, pos, mtid, mpos;
+  uint8_t strand, mstrand, type;
+} md_key_t;
+
+typedef struct
+{
+  // sequence number of the best read, -1 if none
+  int64_t best;
+  int score;
+  // set in fragment groups if a paired read starts here
+  int has_pair;
+} md_group_t;
+
+static inline khint_t md_key_hash( md_key_t k )
+{
+  khint_t h = (khint_t)k.tid;
+  h = h * 31 + (khint_t)k.pos;
+  h = h * 31 + (khint_t)k.mtid;
+  h = h * 31 + (khint_t)k.mpos;
+  return h * 31 + (k.strand | k.mstrand << 1 | k.type << 2);
+}
+
+#define md_key_eq(a, b) ((a).tid == (b).tid && (a).pos == (b).pos && \
+			 (a).mtid == (b).mtid && (a).mpos == (b).mpos && \
+			 (a).strand == (b).strand && (a).mstrand == (b).mstrand && \
+			 (a).type == (b).type)
+
+KHASH_INIT(md, md_key_t, md_group_t, 1, md_key_hash, md_key_eq)
+
+typedef struct
+{
+  bam1_t *b;
+  // the groups of the read are complete once a read beyond
+  // this position has been seen
+  int32_t final;
+  int role;
+} md_entry_t;
+
+typedef struct
+{
+  // ring buffer of m entries, reads first_seq to next_seq - 1 are pending
+  md_entry_t *fifo;
+  size_t m;
+  int64_t first_seq, next_seq;
+  khash_t(md) *groups;
+  // duplicate status of first mates by read name
+  khash_t(s) *mates;
+  size_t purge_at;
+  int32_t window;
+  int remove;
+  bamFile out;
+  pysam_markdup_stats_t *stats;
+} md_state_t;
+
+#define md_entry(s, seq) (&(s)->fifo[(seq) & ((s)->m - 1)])
+
+static inline int md_score( const bam1_t *b )
+{
+  const uint8_t *q = bam1_qual( b );
+  int i, score = 0;
+  if (b->core.l_qseq == 0 || q[0] == 0xff) return 0;
+  for (i = 0; i < b->core.l_qseq; ++i)
+    if (q[i] >= MD_MIN_QUAL) score += q[i];
+  return score;
+}
+
+// unclipped 5' position
+static inline int32_t md_pos5( const bam1_t *b )
+{
+  const bam1_core_t *c = &b->core;
+  const uint32_t *cigar = bam1_cigar( b );
+  int32_t pos;
+  int i, op;
+  if (c->flag & BAM_FREVERSE)
+    {
+      pos = bam_calend( c, cigar ) - 1;
+      for (i = c->n_cigar - 1; i >= 0; --i)
+	{
+	  op = cigar[i] & BAM_CIGAR_MASK;
+	  if (op != BAM_CSOFT_CLIP && op != BAM_CHARD_CLIP) break;
+	  pos += cigar[i] >> BAM_CIGAR_SHIFT;
+	}
+    }
+  else
+    {
+      pos = c->pos;
+      for (i = 0; i < c->n_cigar; ++i)
+	{
+	  op = cigar[i] & BAM_CIGAR_MASK;
+	  if (op != BAM_CSOFT_CLIP && op != BAM_CHARD_CLIP) break;
+	  pos -= cigar[i] >> BAM_CIGAR_SHIFT;
+	}
+    }
+  return pos;
+}
+
+// mark read *seq* as duplicate. Returns 0 if it has already been written.
+static inline int md_mark( md_state_t *s, int64_t seq )
+{
+  if (seq < s->first_seq) return 0;
+  md_entry( s, seq )->b->core.flag |= BAM_FDUP;
+  return 1;
+}
+
+// add read *seq* to the group *key*. If *paired* is set, the read
+// is part of a pair and all fragments in the group are duplicates.
+static void md_add( md_state_t *s, const md_key_t *key, int64_t seq, int score, int paired )
+{
+  md_group_t *g;
+  khint_t k;
+  int ret;
+  k = kh_put( md, s->groups, *key, &ret );
+  g = &kh_val( s->groups, k );
+  if (ret)
+    {
+      g->best = -1;
+      g->score = 0;
+      g->has_pair = 0;
+    }
+  if (paired)
+    {
+      if (!g->has_pair && g->best >= 0) md_mark( s, g->best );
+      g->has_pair = 1;
+      g->best = -1;
+    }
+  else if (g->has_pair)
+    md_mark( s, seq );
+  else if (g->best < 0)
+    {
+      g->best = seq;
+      g->score = score;
+    }
+  // keep the earlier read on ties
+  else if (score > g->score && md_mark( s, g->best ))
+    {
+      g->best = seq;
+      g->score = score;
+    }
+  else
+    md_mark( s, seq );
+}
+
+// remove groups that can not receive further reads
+static void md_purge( md_state_t *s, int32_t pos )
+{
+  khint_t k;
+  for (k = kh_begin( s->groups ); k != kh_end( s->groups ); ++k)
+    if (kh_exist( s->groups, k ) && (int64_t)kh_key( s->groups, k ).pos + s->window < pos)
+      kh_del( md, s->groups, k );
+  s->purge_at = kh_size( s->groups ) * 2;
+  if (s->purge_at < 0x10000) s->purge_at = 0x10000;
+}
+
+// write the oldest pending read. Returns -3 on a write error.
+static int md_emit( md_state_t *s )
+{
+  md_entry_t *e = md_entry( s, s->first_seq );
+  bam1_t *b = e->b;
+  pysam_markdup_stats_t *st = s->stats;
+  int dup = (b->core.flag & BAM_FDUP) != 0;
+  khint_t k;
+
+  ++s->first_seq;
+  ++st->n_reads;
+  switch (e->role)
+    {
+    case MD_NONE:
+      if (b->core.flag & BAM_FUNMAP) ++st->n_unmapped;
+      else ++st->n_secondary;
+      // leave as is
+      dup = 0;
+      break;
+    case MD_SINGLE:
+      ++st->n_unpaired;
+      st->n_unpaired_dup += dup;
+      break;
+    case MD_FIRST:
+      k = kh_get( s, s->mates, bam1_qname( b ) );
+      if (k != kh_end( s->mates )) kh_val( s->mates, k ) = dup;
+      ++st->n_paired;
+      st->n_paired_dup += dup;
+      break;
+    case MD_SECOND:
+      // the first mate has been written already
+      k = kh_get( s, s->mates, bam1_qname( b ) );
+      if (k != kh_end( s->mates ))
+	{
+	  if (kh_val( s->mates, k ) == 1)
+	    {
+	      b->core.flag |= BAM_FDUP;
+	      dup = 1;
+	    }
+	  free( (char*)kh_key( s->mates, k ) );
+	  kh_del( s, s->mates, k );
+	}
+      ++st->n_paired;
+      st->n_paired_dup += dup;
+      break;
+    }
+  if (s->remove && dup) return 0;
+  return bam_write1( s->out, b ) < 0 ? -3 : 0;
+}
+
+// write pending reads whose groups are complete before *pos*
+static int md_flush( md_state_t *s, int64_t pos )
+{
+  while (s->first_seq < s->next_seq && md_entry( s, s->first_seq )->final < pos)
+    if (md_emit( s ) != 0) return -3;
+  return 0;
+}
+
+// make room for one more pending read
+static void md_reserve( md_state_t *s )
+{
+  md_entry_t *fifo;
+  size_t i, m;
+  int64_t seq;
+  if ((size_t)(s->next_seq - s->first_seq) < s->m) return;
+  m = s->m ? s->m << 1 : 0x1000;
+  fifo = (md_entry_t*)calloc( m, sizeof(md_entry_t) );
+  for (seq = s->first_seq; seq < s->next_seq; ++seq)
+    {
+      fifo[seq & (m - 1)] = *md_entry( s, seq );
+      md_entry( s, seq )->b = 0;
+    }
+  for (i = 0; i < s->m; ++i)
+    if (s->fifo[i].b) bam_destroy1( s->fifo[i].b );
+  free( s->fifo );
+  s->fifo = fifo;
+  s->m = m;
+}
+
+// process the read at the end of the ring buffer
+static void md_push( md_state_t *s )
+{
+  md_entry_t *e = md_entry( s, s->next_seq );
+  bam1_core_t *c = &e->b->core;
+  md_key_t key;
+  khint_t k;
+  int score, ret;
+
+  e->role = MD_NONE;
+  e->final = c->pos;
+  if ((c->flag & (BAM_FUNMAP | BAM_FSECONDARY | MD_FSUPPLEMENTARY)) == 0)
+    {
+      c->flag &= ~BAM_FDUP;
+      score = md_score( e->b );
+      memset( &key, 0, sizeof(md_key_t) );
+      key.tid = c->tid;
+      key.pos = md_pos5( e->b );
+      key.strand = (c->flag & BAM_FREVERSE) != 0;
+      key.mtid = key.mpos = -1;
+      key.type = MD_FRAGMENT;
+      e->final = key.pos + s->window;
+      if ((c->flag & BAM_FPAIRED) && !(c->flag & BAM_FMUNMAP))
+	{
+	  k = kh_get( s, s->mates, bam1_qname( e->b ) );
+	  if (k != kh_end( s->mates ))
+	    e->role = MD_SECOND;
+	  else
+	    {
+	      e->role = MD_FIRST;
+	      k = kh_put( s, s->mates, strdup( bam1_qname( e->b ) ), &ret );
+	      kh_val( s->mates, k ) = -1;
+	    }
+	  md_add( s, &key, s->next_seq, score, 1 );
+	  if (e->role == MD_FIRST)
+	    {
+	      key.type = MD_PAIR;
+	      key.mtid = c->mtid;
+	      key.mpos = c->mpos;
+	      key.mstrand = (c->flag & BAM_FMREVERSE) != 0;
+	      md_add( s, &key, s->next_seq, score, 0 );
+	    }
+	}
+      else
+	{
+	  e->role = MD_SINGLE;
+	  md_add( s, &key, s->next_seq, score, 0 );
+	}
+    }
+  ++s->next_seq;
+}
+
+int pysam_bam_markdup( const char *fn, const char *fnout, int32_t window, int remove,
+		       int n_threads, int level, pysam_markdup_stats_t *stats )
+{
+  md_state_t s;
+  mt_reader_t r;
+  FILE *in = 0;
+  bamFile fp;
+  bam_header_t *header;
+  bam1_core_t *c;
+  md_entry_t *e;
+  int64_t offset;
+  int32_t last_tid = -1, last_pos = -1;
+  int ret = 0, n;
+  char mode[8];
+  khint_t k;
+  size_t i;
+
+  memset( stats, 0, sizeof(pysam_markdup_stats_t) );
+  memset( &s, 0, sizeof(md_state_t) );
+  memset( &r, 0, sizeof(mt_reader_t) );
+  if ((fp = bam_open( fn, "r" )) == 0) return -1;
+  if ((header = bam_header_read( fp )) == 0) { bam_close( fp ); return -2; }
+
+  if (n_threads > 1 && !bam_is_be)
+    {
+      // continue with parallel decompression after the header
+      uint8_t *skip;
+      offset = bam_tell( fp );
+      bam_close( fp );
+      fp = 0;
+      if ((in = fopen( fn, "rb" )) == 0 || fseek( in, offset >> 16, SEEK_SET ) != 0)
+	{
+	  ret = -1;
+	  goto markdup_end;
+	}
+      if (mt_reader_init( &r, in, offset >> 16, n_threads ) != 0)
+	{
+	  ret = -2;
+	  goto markdup_end;
+	}
+      n = offset & 0xffff;
+      skip = (uint8_t*)malloc( n + 1 );
+      if (mt_read( &r, skip, n ) != n) ret = -2;
+      free( skip );
+      if (ret != 0) goto markdup_end;
+    }
+
+  strcpy( mode, "w" );
+  if (level >= 0) sprintf( mode + 1, "%d", level < 9 ? level : 9 );
+  if ((s.out = bam_open( fnout, mode )) == 0) { ret = -3; goto markdup_end; }
+  if (n_threads > 1) bgzf_mt( s.out, n_threads, 256 );
+  bam_header_write( s.out, header );
+
+  s.groups = kh_init( md );
+  s.mates = kh_init( s );
+  s.purge_at = 0x10000;
+  s.window = window;
+  s.remove = remove;
+  s.stats = stats;
+
+  for (;;)
+    {
+      md_reserve( &s );
+      e = md_entry( &s, s.next_seq );
+      if (e->b == 0) e->b = bam_init1();
+      n = fp ? bam_read1( fp, e->b ) : mt_read1( &r, e->b );
+      if (n < 0)
+	{
+	  if (n != -1) ret = -2;
+	  break;
+	}
+      c = &e->b->core;
+      if (c->tid >= 0 &&
+	  (last_tid == -2 || c->tid < last_tid || (c->tid == last_tid && c->pos < last_pos)))
+	{
+	  ret = -4;
+	  break;
+	}
+      if (c->tid != last_tid)
+	{
+	  if ((ret = md_flush( &s, INT64_MAX )) != 0) break;
+	  kh_clear( md, s.groups );
+	}
+      else if ((ret = md_flush( &s, c->pos )) != 0)
+	break;
+      else if (kh_size( s.groups ) > s.purge_at)
+	md_purge( &s, c->pos );
+      // reads without coordinates come last
+      last_tid = c->tid < 0 ? -2 : c->tid;
+      last_pos = c->pos;
+      md_push( &s );
+    }
+  if (ret == 0) ret = md_flush( &s, INT64_MAX );
+
+ markdup_end:
+  if (s.out && bam_close( s.out ) < 0 && ret == 0) ret = -3;
+  for (i = 0; i < s.m; ++i)
+    if (s.fifo[i].b) bam_destroy1( s.fifo[i].b );
+  free( s.fifo );
+  if (s.groups) kh_destroy( md, s.groups );
+  if (s.mates)
+    {
+      for (k = kh_begin( s.mates ); k != kh_end( s.mates ); ++k)
+	if (kh_exist( s.mates, k )) free( (char*)kh_key( s.mates, k ) );
+      kh_destroy( s, s.mates );
+    }
+  mt_reader_destroy( &r );
+  if (in) fclose( in );
+  if (fp) bam_close( fp );
+  bam_header_destroy( header );
+  return ret;
+}
+
+// #######################################################
+// extracting regions
+// Records between the first and the last read of a region are
+// copied as compressed blocks, only the blocks at the ends of
+// the copied range are inflated and compressed again.
+// #######################################################
+#define EX_BUFFER_SIZE 0x10000
+
+// read and inflate the BGZF block at file offset *coffset*
+static int ex_read_block( FILE *fp, int64_t coffset, mt_block_t *b )
+{
+  if (fseeko( fp, coffset, SEEK_SET ) != 0) return -1;
+  if (fread( b->cdata, 1, 18, fp ) != 18 || b->cdata[0] != 31 || b->cdata[1] != 139 ||
+      b->cdata[2] != 8 || (b->cdata[3] & 4) == 0 || b->cdata[12] != 'B' || b->cdata[13] != 'C')
+    return -1;
+  b->clen = (b->cdata[16] | b->cdata[17] << 8) + 1;
+  if (b->clen < 18 ||
+      fread( b->cdata + 18, 1, b->clen - 18, fp ) != (size_t)(b->clen - 18))
+    return -1;
+  b->coffset = coffset;
+  b->error = 0;
+  mt_inflate( b );
+  return b->error ? -1 : 0;
+}
+
+// append the compressed data between file offsets *beg* and *end*
+// of *in* to *out*.
+static int ex_copy( FILE *in, BGZF *out, int64_t beg, int64_t end, uint8_t *buf, int64_t *n_copied )
+{
+  size_t n;
+  if (bgzf_flush( out ) != 0) return -3;
+  if (fseeko( in, beg, SEEK_SET ) != 0) return -2;
+  *n_copied += end - beg;
+  out->block_address += end - beg;
+  while (beg < end)
+    {
+      n = end - beg < EX_BUFFER_SIZE ? end - beg : EX_BUFFER_SIZE;
+      if (fread( buf, 1, n, in ) != n) return -2;
+      if (fwrite( buf, 1, n, (FILE*)out->fp ) != n) return -3;
+      beg += n;
+    }
+  return 0;
+}
+
+// same as is_overlap in bam_index.c
+static inline int ex_overlap( const bam1_t *b, int beg, int end )
+{
+  uint32_t rend = b->core.n_cigar ? bam_calend( &b->core, bam1_cigar( b ) ) : (uint32_t)b->core.pos + 1;
+  return (int64_t)rend > beg && b->core.pos < end;
+}
+
+// write the reads from the current position of *fp* that overlap
+// [beg, end). Reading stops at the first read at or beyond *end*,
+// whose offset is stored in *last*.
+static int ex_write_reads( bamFile fp, bamFile out, bam1_t *b, int tid, int beg, int end, uint64_t *last )
+{
+  int r;
+  for (;;)
+    {
+      *last = bam_tell( fp );
+      if ((r = bam_read1( fp, b )) < 0) return r == -1 ? 0 : -2;
+      if (b->core.tid != tid || b->core.pos >= end) return 0;
+      if (ex_overlap( b, beg, end ) && bam_write1( out, b ) < 0) return -3;
+    }
+}
+
+int pysam_bam_extract( const char *fn, const bam_index_t *idx, const bam_header_t *header,
+		       const char *fnout, int level, const int *tids, const int *begs,
+		       const int *ends, int n, int64_t *n_copied )
+{
+  bamFile fp = 0, out = 0;
+  FILE *raw = 0;
+  bam1_t *b = bam_init1();
+  mt_block_t *block = (mt_block_t*)malloc( sizeof(mt_block_t) );
+  uint8_t *buf = (uint8_t*)malloc( EX_BUFFER_SIZE );
+  // records before this offset have been written
+  uint64_t last, off, start, stop;
+  int i, r, ret = 0;
+  char mode[8];
+
+  *n_copied = 0;
+  if ((fp = bam_open( fn, "r" )) == 0 || (raw = fopen( fn, "rb" )) == 0)
+    {
+      ret = -1;
+      goto extract_end;
+    }
+  bam_header_destroy( bam_header_read( fp ) );
+  last = bam_tell( fp );
+
+  strcpy( mode, "w" );
+  if (level >= 0) sprintf( mode + 1, "%d", level < 9 ? level : 9 );
+  if ((out = bam_open( fnout, mode )) == 0) { ret = -3; goto extract_end; }
+  bam_header_write( out, header );
+
+  for (i = 0; i < n && ret == 0; ++i)
+    {
+      const bam_lidx_t *lidx = &idx->index2[tids[i]];
+      int beg = begs[i], end = ends[i], n_chunks, w;
+      // unmapped reads are not in the linear index, so start
+      // at the first chunk as bam_iter_query does
+      pair64_t *chunks = get_chunk_coordinates( idx, tids[i], beg, end, &n_chunks );
+      start = n_chunks > 0 ? chunks[0].u : 0;
+      free( chunks );
+      if (n_chunks <= 0) continue;
+      if (start < last) start = last;
+
+      // reads starting before the region are checked for overlap
+      bam_seek( fp, start, SEEK_SET );
+      for (;;)
+	{
+	  off = bam_tell( fp );
+	  if ((r = bam_read1( fp, b )) < 0)
+	    {
+	      if (r != -1) ret = -2;
+	      break;
+	    }
+	  if (b->core.tid != tids[i] || b->core.pos >= beg) break;
+	  if (ex_overlap( b, beg, end ) && bam_write1( out, b ) < 0)
+	    {
+	      ret = -3;
+	      break;
+	    }
+	}
+      last = off;
+      if (ret != 0 || r < 0 || b->core.tid != tids[i] || b->core.pos >= end) continue;
+
+      // all reads from *off* up to the first read at or beyond
+      // *end* are written. Mapped reads overlapping the window
+      // before *end* come before that read.
+      w = (end >> BAM_LIDX_SHIFT) - 1;
+      if (w >= lidx->n) w = lidx->n - 1;
+      stop = w >= 0 ? lidx->offset[w] : 0;
+      if (stop >> 16 > off >> 16)
+	{
+	  int64_t cbeg = off >> 16, cend = stop >> 16;
+	  if ((off & 0xffff) != 0)
+	    {
+	      // tail of the first block
+	      if (ex_read_block( raw, cbeg, block ) != 0) { ret = -2; break; }
+	      if (bgzf_write( out, block->udata + (off & 0xffff),
+			      block->ulen - (off & 0xffff) ) < 0) { ret = -3; break; }
+	      cbeg += block->clen;
+	    }
+	  if ((ret = ex_copy( raw, out, cbeg, cend, buf, n_copied )) != 0) break;
+	  if ((stop & 0xffff) != 0)
+	    {
+	      // head of the last block
+	      if (ex_read_block( raw, cend, block ) != 0) { ret = -2; break; }
+	      if (bgzf_write( out, block->udata, stop & 0xffff ) < 0) { ret = -3; break; }
+	    }
+	  off = stop;
+	}
+      bam_seek( fp, off, SEEK_SET );
+      ret = ex_write_reads( fp, out, b, tids[i], beg, end, &last );
+    }
+
+ extract_end:
+  if (out && bam_close( out ) < 0 && ret == 0) ret = -3;
+  if (raw) fclose( raw );
+  if (fp) bam_close( fp );
+  bam_destroy1( b );
+  free( block );
+  free( buf );
+  return ret;
+}
+
+// #######################################################
+// replacing the header
+// Only the blocks holding the header are inflated, all later
+// blocks are copied unchanged. The rest of the block in which
+// the header ends is compressed again into at most two blocks.
+// #######################################################
+static const uint8_t rh_eof[28] = "\037\213\010\4\0\0\0\0\0\377\6\0\102\103\2\0\033\0\3\0\0\0\0\0\0\0\0\0";
+
+// maps virtual file offsets of the input to the output
+typedef struct
+{
+  // first block after the header block and its new offset
+  int64_t next_coffset, next_new;
+  // block in which the header ends, -1 if it ends at a block
+  // boundary, and the uncompressed offset of the header end
+  int64_t tail_coffset;
+  int tail_offset;
+  // new blocks of the rest of that block and the size of the first
+  int64_t tail_new[2];
+  int tail_split;
+} rh_map_t;
+
+static uint64_t rh_map( const rh_map_t *m, uint64_t voffset )
+{
+  int64_t c = voffset >> 16;
+  int u = voffset & 0xffff;
+  if (c >= m->next_coffset)
+    return (uint64_t)(c - m->next_coffset + m->next_new) << 16 | u;
+  if (c == m->tail_coffset && u >= m->tail_offset)
+    {
+      u -= m->tail_offset;
+      if (u < m->tail_split) return (uint64_t)m->tail_new[0] << 16 | u;
+      return (uint64_t)m->tail_new[1] << 16 | (u - m->tail_split);
+    }
+  // within the header, map to the first record
+  return (uint64_t)(m->tail_coffset >= 0 ? m->tail_new[0] : m->next_new) << 16;
+}
+
+// size of the BAM header at the start of *s*, -1 if incomplete and -2 if invalid
+static int64_t rh_header_size( const uint8_t *s, size_t l )
+{
+  int32_t x, n, i;
+  size_t p;
+  if (l < 8) return -1;
+  if (memcmp( s, "BAM\1", 4 ) != 0) return -2;
+  memcpy( &x, s + 4, 4 );
+  if (x < 0) return -2;
+  p = 8 + (size_t)x;
+  if (l < p + 4) return -1;
+  memcpy( &n, s + p, 4 );
+  if (n < 0) return -2;
+  p += 4;
+  for (i = 0; i < n; ++i)
+    {
+      if (l < p + 4) return -1;
+      memcpy( &x, s + p, 4 );
+      if (x < 0) return -2;
+      p += 8 + (size_t)x;
+      if (l < p) return -1;
+    }
+  return p;
+}
+
+#define rh_get32(p) (lazy_get32( (const char*)(p) ))
+
+// rewrite the virtual file offsets in the index *fnidx* and
+// save it as *fnidxout*. The layout of the index is kept.
+static int rh_remap_index( const char *fnidx, const char *fnidxout, const rh_map_t *m )
+{
+  FILE *fp;
+  uint8_t *s = 0, *end;
+  int64_t size;
+  int32_t n_ref, n_bin, n_chunk, n_intv, i, j, k, bin;
+  int ret = 0;
+
+  if ((fp = fopen( fnidx, "rb" )) == 0) return -4;
+  if (fseeko( fp, 0, SEEK_END ) != 0 || (size = ftello( fp )) < 8 ||
+      fseeko( fp, 0, SEEK_SET ) != 0)
+    {
+      fclose( fp );
+      return -4;
+    }
+  s = (uint8_t*)malloc( size );
+  if (fread( s, 1, size, fp ) != (size_t)size || memcmp( s, "BAI\1", 4 ) != 0) ret = -4;
+  fclose( fp );
+  if (ret != 0) goto remap_end;
+
+#define RH_NEED(p, n) if ((p) + (n) > end) { ret = -4; goto remap_end; }
+  end = s + size;
+  n_ref = rh_get32( s + 4 );
+  {
+    uint8_t *p = s + 8;
+    for (i = 0; i < n_ref; ++i)
+      {
+	RH_NEED( p, 4 );
+	n_bin = rh_get32( p ); p += 4;
+	for (j = 0; j < n_bin; ++j)
+	  {
+	    RH_NEED( p, 8 );
+	    bin = rh_get32( p );
+	    n_chunk = rh_get32( p + 4 );
+	    p += 8;
+	    RH_NEED( p, (int64_t)n_chunk * 16 );
+	    for (k = 0; k < n_chunk; ++k, p += 16)
+	      {
+		// the second pair of the pseudo bin holds read counts
+		if (bin == BAM_MAX_BIN && k > 0) continue;
+		{
+		  uint64_t u, v;
+		  memcpy( &u, p, 8 ); memcpy( &v, p + 8, 8 );
+		  u = rh_map( m, u ); v = rh_map( m, v );
+		  memcpy( p, &u, 8 ); memcpy( p + 8, &v, 8 );
+		}
+	      }
+	  }
+	RH_NEED( p, 4 );
+	n_intv = rh_get32( p ); p += 4;
+	RH_NEED( p, (int64_t)n_intv * 8 );
+	for (j = 0; j < n_intv; ++j, p += 8)
+	  {
+	    uint64_t u;
+	    memcpy( &u, p, 8 );
+	    // 0 marks windows before the first read
+	    if (u != 0) u = rh_map( m, u );
+	    memcpy( p, &u, 8 );
+	  }
+      }
+  }
+#undef RH_NEED
+
+  if ((fp = fopen( fnidxout, "wb" )) == 0) { ret = -3; goto remap_end; }
+  if (fwrite( s, 1, size, fp ) != (size_t)size) ret = -3;
+  if (fclose( fp ) != 0) ret = -3;
+
+ remap_end:
+  free( s );
+  return ret;
+}
+
+int pysam_bam_replace_header( const char *fn, const char *fnout, const bam_header_t *h,
+			      int level, const char *fnidx, const char *fnidxout,
+			      int64_t *n_copied )
+{
+  FILE *raw;
+  BGZF *out = 0;
+  mt_block_t *block = (mt_block_t*)malloc( sizeof(mt_block_t) );
+  uint8_t *buf = (uint8_t*)malloc( EX_BUFFER_SIZE );
+  uint8_t eof[28];
+  pysam_buffer_t hdr;
+  rh_map_t m;
+  int64_t coffset = 0, size, data_end, header_size, ulen = 0;
+  int ret = 0;
+  char mode[8];
+
+  *n_copied = 0;
+  hdr.s = 0;
+  hdr.l = hdr.m = 0;
+  memset( &m, 0, sizeof(rh_map_t) );
+  m.tail_coffset = -1;
+
+  if ((raw = fopen( fn, "rb" )) == 0) { ret = -1; goto replace_end; }
+  if (fseeko( raw, 0, SEEK_END ) != 0 || (size = ftello( raw )) < 0) { ret = -2; goto replace_end; }
+  // the end-of-file marker is added by bgzf_close
+  data_end = size;
+  if (size >= 28 && fseeko( raw, size - 28, SEEK_SET ) == 0 &&
+      fread( eof, 1, 28, raw ) == 28 && memcmp( eof, rh_eof, 28 ) == 0)
+    data_end = size - 28;
+
+  // inflate blocks until the header is complete
+  for (;;)
+    {
+      if (coffset >= data_end || ex_read_block( raw, coffset, block ) != 0)
+	{
+	  ret = -2;
+	  goto replace_end;
+	}
+      if (pysam_buffer_add( &hdr, block->udata, block->ulen ) < 0) { ret = -2; goto replace_end; }
+      header_size = rh_header_size( hdr.s, hdr.l );
+      if (header_size == -2) { ret = -2; goto replace_end; }
+      coffset += block->clen;
+      if (header_size >= 0 && header_size < ulen + block->ulen)
+	{
+	  m.tail_coffset = coffset - block->clen;
+	  m.tail_offset = header_size - ulen;
+	  break;
+	}
+      ulen += block->ulen;
+      if (header_size >= 0) break;
+    }
+
+  strcpy( mode, "w" );
+  if (level >= 0) sprintf( mode + 1, "%d", level < 9 ? level : 9 );
+  if ((out = bam_open( fnout, mode )) == 0) { ret = -3; goto replace_end; }
+  bam_header_write( out, h );
+  if (bgzf_flush( out ) != 0) { ret = -3; goto replace_end; }
+
+  if (m.tail_coffset >= 0)
+    {
+      // records in the block with the end of the header
+      int tail = block->ulen - m.tail_offset;
+      m.tail_split = tail < BGZF_BLOCK_SIZE ? tail : BGZF_BLOCK_SIZE;
+      m.tail_new[0] = out->block_address;
+      if (bgzf_write( out, block->udata + m.tail_offset, m.tail_split ) < 0 ||
+	  bgzf_flush( out ) != 0)
+	{
+	  ret = -3;
+	  goto replace_end;
+	}
+      m.tail_new[1] = out->block_address;
+      if (tail > m.tail_split &&
+	  (bgzf_write( out, block->udata + m.tail_offset + m.tail_split, tail - m.tail_split ) < 0 ||
+	   bgzf_flush( out ) != 0))
+	{
+	  ret = -3;
+	  goto replace_end;
+	}
+    }
+  m.next_coffset = coffset;
+  m.next_new = out->block_address;
+  if ((ret = ex_copy( raw, out, coffset, data_end, buf, n_copied )) != 0) goto replace_end;
+
+ replace_end:
+  if (out && bam_close( out ) < 0 && ret == 0) ret = -3;
+  if (ret == 0 && fnidx) ret = rh_remap_index( fnidx, fnidxout, &m );
+  if (raw) fclose( raw );
+  free( hdr.s );
+  free( block );
+  free( buf );
+  return ret;
+}
@@ -64,6 +64,217 @@ uint32_t pysam_get_mapped( const bam_index_t *idx, const int tid );
 // return number of unmapped reads for tid
 uint32_t pysam_get_unmapped( const bam_index_t *idx, const int tid );
 
+// estimate compressed bytes and number of reads in a region
+// from the index. Returns the number of chunks, -1 on error.
+int pysam_bam_index_estimate( const bam_index_t *idx,
+			      int tid, int beg, int end,
+			      uint64_t *n_bytes, uint64_t *n_reads );
+
+// compute BAQ for *n* reads aligned to *ref* using *n_threads* threads.
+// *flag* is passed on to bam_prob_realn_core.
+int pysam_bam_prob_realn_batch( bam1_t ** reads,
+				int n,
+				const char * ref,
+				int flag,
+				int n_threads );
+
+// position the pileup engine *iter* at *pos* on *tid*. Alignments
+// ending before *pos* are discarded when pushed and no columns
+// before *pos* are built. Call after bam_plp_reset and before
+// any alignment has been pushed.
+void pysam_bam_plp_set_start( bam_plp_t iter, int tid, int pos );
+
+// same as bam_plp_auto. If *skip* is set, buffered alignments
+// are advanced to the start position set by pysam_bam_plp_set_start
+// before the first column is built and *skip* is cleared.
+const bam_pileup1_t * pysam_bam_plp_auto( bam_plp_t iter,
+					  int *_tid, int *_pos, int *_n_plp,
+					  int *skip );
+
+// downsampling of alignments read by *func*. Alignments are grouped
+// by start position and from each group the alignments with the
+// smallest hash of the read name are kept such that at most *depth*
+// alignments overlap the start position. Alignments with a flag in
+// *mask* are discarded. pysam_downsample_read can be passed as the
+// read function to bam_plp_init.
+typedef struct __pysam_downsample_t pysam_downsample_t;
+
+pysam_downsample_t * pysam_downsample_init( bam_plp_auto_f func, void *data,
+					    int depth, uint32_t seed, int mask );
+int pysam_downsample_read( void *data, bam1_t *b );
+void pysam_downsample_set_mask( pysam_downsample_t *ds, int mask );
+void pysam_downsample_reset( pysam_downsample_t *ds );
+void pysam_downsample_destroy( pysam_downsample_t *ds );
+
+// index of read names. Entries are sorted by the hash of the read
+// name and map to virtual file offsets. The index is either held
+// in memory or memory mapped from a file (*map* is set).
+typedef struct {
+  uint64_t hash;
+  uint64_t offset;
+} pysam_qname_entry_t;
+
+typedef struct {
+  pysam_qname_entry_t *entries;
+  size_t n, m;
+  void *map;
+  size_t map_len;
+} pysam_qname_index_t;
+
+// hash function for read names
+uint64_t pysam_qname_hash( const char *s );
+pysam_qname_index_t * pysam_qname_index_init();
+void pysam_qname_index_add( pysam_qname_index_t *idx, uint64_t hash, uint64_t offset );
+void pysam_qname_index_sort( pysam_qname_index_t *idx );
+// save index to *fn*. Returns 0 on success.
+int pysam_qname_index_save( const pysam_qname_index_t *idx, const char *fn );
+// memory map index in *fn*. Returns NULL on error.
+pysam_qname_index_t * pysam_qname_index_load( const char *fn );
+// return number of entries with *hash*, the first is at *first*.
+size_t pysam_qname_index_find( const pysam_qname_index_t *idx, uint64_t hash, size_t *first );
+void pysam_qname_index_destroy( pysam_qname_index_t *idx );
+// build index for the alignments in file *fn* starting at
+// virtual offset *start* using *n_threads* threads. If *bam_idx* is
+// given, the file is split at alignment positions in the linear
+// index, otherwise it is read by a single thread.
+// Returns NULL on error.
+pysam_qname_index_t * pysam_qname_index_build( const char *fn,
+					       const bam_index_t *bam_idx,
+					       uint64_t start,
+					       int n_threads );
+
+// build bam index for file *fn* and save it to *fnidx*. If
+// *n_threads* > 1, compressed blocks are inflated in parallel.
+// Returns 0 on success, -1 if *fn* can not be opened, -2 if
+// the index can not be built and -3 if *fnidx* can not be written.
+int pysam_bam_index_build( const char *fn, const char *fnidx, int n_threads );
+
+#include "sam.h"
+// defined in sam.c
+bam_header_t *bam_header_dup(const bam_header_t *h0);
+
+// return 1 if *fn* is a BAM file, 0 if not and -1 if it
+// can not be opened.
+int pysam_sniff_bam( const char *fn );
+
+// open BAM file *fn* for reading using a copy of *header*
+// instead of reading the header. Reading starts at
+// virtual file *offset*, the end of the header.
+// Returns NULL on error.
+samfile_t * pysam_samopen_with_header( const char *fn,
+				       const bam_header_t *header,
+				       int64_t offset );
+
+// open a BAM file on file descriptor *fd*, for example a pipe,
+// for reading or writing. No seeks are done. When writing,
+// *header* is written first. The descriptor is closed by
+// samclose or on error. Returns NULL on error.
+samfile_t * pysam_samdopen( int fd, const char *mode, const bam_header_t *header );
+
+// load index in file *fnidx* lazily. The file is memory mapped
+// and the bins and linear index of a reference are decoded by
+// pysam_bam_index_load_tid, read counts by
+// pysam_bam_index_load_counts. Returns NULL on error.
+bam_index_t * pysam_bam_index_load_lazy( const char *fnidx );
+// decode index for *tid* if not done already. If *tid* < 0,
+// decode all. Returns 0 on success, -1 for an invalid *tid*
+// and -2 for a truncated index.
+int pysam_bam_index_load_tid( bam_index_t *idx, int tid );
+// decode read counts for *tid*. If *tid* < 0, decode counts
+// for all references and reads without coordinate. Return
+// values as for pysam_bam_index_load_tid.
+int pysam_bam_index_load_counts( bam_index_t *idx, int tid );
+void pysam_bam_index_destroy_lazy( bam_index_t *idx );
+
+#define PYSAM_SORT_COORDINATE 0
+#define PYSAM_SORT_QUERYNAME  1
+#define PYSAM_SORT_TAG        2
+
+// sort BAM file *fn* by coordinate, query name or the value of
+// the two-letter *tag* into *fnout* using at most about *max_mem*
+// bytes for buffering records. Sorted runs are written to
+// temporary files starting with *prefix*. *level* is the
+// compression level of the output (-1 for default). The number
+// of reads written is stored in *n_reads*. Returns 0 on success,
+// -1 if *fn* can not be opened, -2 on a read error and -3 on a
+// write error.
+int pysam_bam_sort( const char *fn, const char *fnout, const char *prefix,
+		    int by, const char *tag, size_t max_mem, int n_threads,
+		    int level, int64_t *n_reads );
+
+// build an index for a BAM file while it is being written.
+typedef struct __pysam_index_writer_t pysam_index_writer_t;
+// *offset* is the virtual file offset after the header.
+pysam_index_writer_t * pysam_index_writer_init( int n_targets, uint64_t offset );
+// add record *b* ending at virtual file *offset*. Returns -1
+// if the records are not sorted.
+int pysam_index_writer_push( pysam_index_writer_t *w, const bam1_t *b, uint64_t offset );
+// finish the index at virtual file *offset*, the end of the
+// data, and save it to *fnidx*. Returns 0 on success, -2 if
+// the records were not sorted and -3 on a write error.
+int pysam_index_writer_save( pysam_index_writer_t *w, uint64_t offset, const char *fnidx );
+void pysam_index_writer_destroy( pysam_index_writer_t *w );
+
+// growable byte buffer
+typedef struct
+{
+  uint8_t *s;
+  size_t l, m;
+} pysam_buffer_t;
+
+int pysam_buffer_add( pysam_buffer_t *buf, const void *data, size_t len );
+void pysam_buffer_free( pysam_buffer_t *buf );
+// write record *b* in BAM format including the block size to *dst*,
+// which must hold 4 + BAM_CORE_SIZE + b->data_len bytes (little endian only).
+void pysam_bam_serialize( const bam1_t *b, uint8_t *dst );
+// fill *b* from the *len* bytes written by pysam_bam_serialize. Returns
+// -1 if the data is not a single record and -2 if out of memory.
+int pysam_bam_deserialize( bam1_t *b, const uint8_t *src, size_t len );
+// append record *b* or header *h* in BAM format (little endian only).
+int pysam_buffer_add_bam( pysam_buffer_t *buf, const bam1_t *b );
+int pysam_buffer_add_header( pysam_buffer_t *buf, const bam_header_t *h );
+// compress each of the *n* buffers in *src* into BGZF blocks in *dst*
+// using *n_threads* threads. Returns 0 on success.
+int pysam_buffer_compress_many( pysam_buffer_t **src, pysam_buffer_t **dst,
+				int n, int level, int n_threads );
+
+// counts collected while marking duplicates
+typedef struct
+{
+  int64_t n_reads, n_unmapped, n_secondary;
+  int64_t n_unpaired, n_unpaired_dup, n_paired, n_paired_dup;
+} pysam_markdup_stats_t;
+
+// mark duplicate reads in the coordinate sorted BAM file *fn* and
+// write them to *fnout*. Reads are grouped by unclipped 5' position
+// and orientation, pairs also by mate position. Groups are complete
+// once the input has moved *window* bases beyond their position.
+// Duplicates are dropped if *remove* is set. Returns 0 on success,
+// -1 if *fn* can not be opened, -2 on a read error, -3 on a
+// write error and -4 if *fn* is not sorted.
+int pysam_bam_markdup( const char *fn, const char *fnout, int32_t window, int remove,
+		       int n_threads, int level, pysam_markdup_stats_t *stats );
+
+// write the reads overlapping the regions *tids*, *begs* and *ends*
+// of the indexed BAM file *fn* to *fnout*. The *n* regions must be
+// sorted and must not overlap. Compressed blocks inside a region
+// are copied without inflating them, their total size is stored in
+// *n_copied*. Returns 0 on success, -1 if *fn* can not be opened,
+// -2 on a read error and -3 on a write error.
+int pysam_bam_extract( const char *fn, const bam_index_t *idx, const bam_header_t *header,
+		       const char *fnout, int level, const int *tids, const int *begs,
+		       const int *ends, int n, int64_t *n_copied );
+
+// write BAM file *fn* with header *h* to *fnout*. Only the blocks
+// holding the old header are inflated, the size of the blocks copied
+// unchanged is stored in *n_copied*. If *fnidx* is given, the index
+// is updated for the new file and saved to *fnidxout*. Returns 0 on
+// success, -1 if *fn* can not be opened, -2 on a read error, -3 on
+// a write error and -4 if the index can not be read.
+int pysam_bam_replace_header( const char *fn, const char *fnout, const bam_header_t *h,
+			      int level, const char *fnidx, const char *fnidxout,
+			      int64_t *n_copied );
+
 // debugging functions
 /* #include "glf.h" */
 /* uint32_t pysam_glf_depth( glf1_t * g); */
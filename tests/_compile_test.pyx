@@ -1,4 +1,6 @@
 from pysam.csamtools cimport Samfile, AlignedRead
+from pysam.csamtools cimport IteratorRowRegion, IteratorColumnRegion
+from pysam.csamtools cimport bam1_t, const_bam_pileup1_t_ptr
 from pysam.ctabix cimport Tabixfile
 
 cdef Samfile samfile
@@ -18,6 +20,30 @@ def testCountBAM( Samfile samfile ):
             
     return n
 
+cdef int countRead( bam1_t * b, void * data ) nogil:
+    (<long*>data)[0] += 1
+    return 0
+
+cdef int countColumn( int tid, int pos, int n,
+                      const_bam_pileup1_t_ptr plp,
+                      void * data ) nogil:
+    (<long*>data)[0] += n
+    return 0
+
+def testFetchCallback( Samfile samfile, reference ):
+    '''test counting reads with a C level callback.'''
+    cdef long n = 0
+    cdef IteratorRowRegion it = samfile.fetch( reference )
+    it.foreach( &countRead, &n )
+    return n
+
+def testPileupCallback( Samfile samfile, reference ):
+    '''test computing total depth with a C level callback.'''
+    cdef long n = 0
+    cdef IteratorColumnRegion it = samfile.pileup( reference )
+    it.foreach( &countColumn, &n )
+    return n
+
 def testCountGTF( Tabixfile tabixfile ):
     '''test reading from a tabixfile.'''
     
@@ -24,6 +24,16 @@ class BAMTest(unittest.TestCase):
             pysam.Samfile(self.input_filename))
         self.assertEqual(nread, 3270)
 
+    def testFetchCallback(self):
+        samfile = pysam.Samfile(self.input_filename)
+        nread = _compile_test.testFetchCallback(samfile, "chr1")
+        self.assertEqual(nread, samfile.count("chr1"))
+
+    def testPileupCallback(self):
+        samfile = pysam.Samfile(self.input_filename)
+        depth = _compile_test.testPileupCallback(samfile, "chr1")
+        self.assertEqual(depth, sum([x.n for x in samfile.pileup("chr1")]))
+
 
 class GTFTest(unittest.TestCase):
 
@@ -7,11 +7,14 @@ and data files located there.
 
 import pysam
 import unittest
+import io
 import os, re, sys
 import itertools
 import collections
 import subprocess
 import shutil
+import tempfile
+import gzip
 import logging
 
 IS_PYTHON3 = sys.version_info[0] >= 3
@@ -619,6 +622,37 @@ class IOTest(unittest.TestCase):
         self.checkEcho( input_filename, reference_filename, output_filename,
                         "rU", "w" )
 
+    def testWriteMany( self ):
+        '''write reads in batches.'''
+        output_filename = "pysam_ex1.bam"
+        infile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        outfile = pysam.Samfile( output_filename, "wb", template = infile )
+        # batch size not a divisor of the number of reads
+        self.assertTrue( outfile.write_many( infile.fetch(), batch_size = 7 ) > 0 )
+        self.assertEqual( outfile.write_many( [] ), 0 )
+        self.assertRaises( TypeError, outfile.write_many, [ None ] )
+        infile.close()
+        outfile.close()
+        self.assertTrue( checkBinaryEqual( os.path.join( DATADIR, "ex1.bam" ), output_filename ) )
+
+    def testCompressionLevel( self ):
+        '''write bam files with different compression levels.'''
+        infile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        reads = [ x.qname for x in infile.fetch() ]
+        sizes = []
+        for mode, kwargs in ( ("wb0", {}), ("wb1", {}), ("wb", { "compresslevel" : 9 }) ):
+            output_filename = "pysam_ex1_%s.bam" % mode
+            outfile = pysam.Samfile( output_filename, mode, template = infile, **kwargs )
+            outfile.write_many( infile.fetch() )
+            outfile.close()
+            self.assertEqual( [ x.qname for x in pysam.Samfile( output_filename, "rb" ) ], reads )
+            sizes.append( os.path.getsize( output_filename ) )
+            os.unlink( output_filename )
+        self.assertTrue( sizes[0] > sizes[1] >= sizes[2] )
+        self.assertRaises( AssertionError, pysam.Samfile, "pysam_ex1.bam", "wb", template = infile, compresslevel = 10 )
+        self.assertRaises( AssertionError, pysam.Samfile, "pysam_ex1.sam", "w", template = infile, compresslevel = 1 )
+        infile.close()
+
 class TestFloatTagBug( unittest.TestCase ):
     '''see issue 71'''
 
@@ -892,6 +926,67 @@ class TestIteratorColumn2(unittest.TestCase):
         self.assertEqual( len(columns), 3)
         self.assertEqual( columns, [169,170,171] )
 
+    def testTruncateContents( self ):
+        '''truncated pileup must agree with the full pileup within the region.'''
+
+        def _collect( columns ):
+            return [ (x.pos, x.n,
+                      [ (r.alignment.qname, r.qpos, r.indel, r.is_del) for r in x.pileups ] )
+                     for x in columns ]
+
+        for contig, length in zip(self.samfile.references, self.samfile.lengths):
+            for start in range( 0, length, 250 ):
+                end = start + 50
+                full = [ x for x in _collect( self.samfile.pileup( contig, start, end ) )
+                         if start <= x[0] < end ]
+                truncated = _collect( self.samfile.pileup( contig, start, end, truncate = True ) )
+                self.assertEqual( full, truncated,
+                                  "pileup mismatch in %s:%i-%i" % (contig, start, end) )
+
+    def testDownsample( self ):
+        '''downsampled pileup does not exceed target depth.'''
+
+        def _collect( **kwargs ):
+            return [ (x.pos, [ r.alignment.qname for r in x.pileups ])
+                     for x in self.samfile.pileup( 'chr1', **kwargs ) ]
+
+        full = _collect()
+        self.assertGreater( max( [ len(x[1]) for x in full ] ), 5 )
+
+        sampled = _collect( downsample = 5 )
+        for pos, names in sampled:
+            self.assertLessEqual( len(names), 5 )
+
+        # reproducible for a given seed
+        self.assertEqual( sampled, _collect( downsample = 5 ) )
+        self.assertNotEqual( sampled, _collect( downsample = 5, downsample_seed = 1 ) )
+
+        # sampled reads are a subset of the reads in the column
+        d = dict( full )
+        for pos, names in sampled:
+            self.assertTrue( set(names).issubset( set(d[pos] ) ) )
+
+        # no downsampling if depth is not exceeded
+        self.assertEqual( full, _collect( downsample = 1000 ) )
+
+    def testDownsampleSamtoolsStepper( self ):
+        '''reads are sampled before BAQ is computed.'''
+
+        fastafile = pysam.Fastafile( os.path.join( DATADIR, "ex1.fa" ) )
+        def _collect( **kwargs ):
+            return [ (x.pos, [ (r.alignment.qname, r.alignment.qual) for r in x.pileups ])
+                     for x in self.samfile.pileup( 'chr1', stepper = "samtools",
+                                                   fastafile = fastafile, **kwargs ) ]
+
+        full = dict( _collect() )
+        sampled = _collect( downsample = 5 )
+        self.assertEqual( sampled, _collect( downsample = 5 ) )
+        for pos, reads in sampled:
+            self.assertLessEqual( len(reads), 5 )
+            # qualities are those after BAQ
+            self.assertTrue( set(reads).issubset( set(full[pos]) ) )
+        self.assertEqual( sorted( full.items() ), _collect( downsample = 1000 ) )
+
     def testAccessOnClosedIterator( self ):
         '''see issue 131
 
@@ -900,6 +995,123 @@ class TestIteratorColumn2(unittest.TestCase):
         pcolumn = self.samfile.pileup('chr1', 170, 180).__next__()
         self.assertRaises( ValueError, getattr, pcolumn, "pileups" )
 
+class TestMultiPileup(unittest.TestCase):
+    '''test simultaneous pileup of several files.'''
+
+    filenames = ( "ex1.bam", "ex4.bam" )
+
+    def setUp(self):
+        self.samfiles = [ pysam.Samfile( os.path.join(DATADIR, x), "rb" ) for x in self.filenames ]
+
+    def checkRegion( self, *args, **kwargs ):
+        '''compare with pileups of individual files.'''
+        expected = {}
+        for x, samfile in enumerate( self.samfiles ):
+            for column in samfile.pileup( *args, **kwargs ):
+                expected.setdefault( column.pos, [None] * len(self.samfiles) )[x] = \
+                    [ r.alignment.qname for r in column.pileups ]
+        
+        result = []
+        for pos, columns in pysam.multi_pileup( self.samfiles, *args, **kwargs ):
+            self.assertEqual( len(columns), len(self.samfiles) )
+            result.append( (pos, [ None if c is None else [ r.alignment.qname for r in c.pileups ] 
+                                   for c in columns ] ) )
+
+        self.assertEqual( result, sorted( expected.items() ) )
+
+    def testRegion( self ):
+        self.checkRegion( "chr1", 10, 60 )
+        self.checkRegion( "chr2", 10, 60 )
+        self.checkRegion( region = "chr1:1-100" )
+
+    def testTruncate( self ):
+        self.checkRegion( "chr1", 30, 40, truncate = True )
+
+    def testRequiresRegion( self ):
+        self.assertRaises( ValueError, pysam.multi_pileup, self.samfiles )
+
+    def tearDown(self):
+        for samfile in self.samfiles: samfile.close()
+
+class TestBAQ(unittest.TestCase):
+    '''test precomputed base alignment qualities.'''
+
+    filename = os.path.join(DATADIR, "ex1.bam")
+    fastafilename = os.path.join(DATADIR, "ex1.fa")
+    outfile = "test_baq.bam"
+
+    def setUp(self):
+        pysam.compute_baq( self.filename, self.outfile, self.fastafilename )
+        pysam.index( self.outfile )
+
+    def getQualities( self, filename, **kwargs ):
+        samfile = pysam.Samfile( filename, "rb" )
+        fastafile = pysam.Fastafile( self.fastafilename )
+        result = [ [ r.alignment.qual for r in column.pileups ] \
+                       for column in samfile.pileup( "chr1", 100, 300,
+                                                     stepper = "samtools",
+                                                     fastafile = fastafile,
+                                                     **kwargs ) ]
+        samfile.close()
+        return result
+
+    def testTags( self ):
+        samfile = pysam.Samfile( self.outfile, "rb" )
+        for read in samfile.fetch():
+            if read.is_unmapped: continue
+            self.assertTrue( "BQ" in dict(read.tags) )
+        samfile.close()
+
+    def testCachedPileup( self ):
+        '''pileup with stored BAQ is identical to computing BAQ.'''
+        reference = self.getQualities( self.filename )
+        self.assertEqual( reference, self.getQualities( self.outfile ) )
+        self.assertEqual( reference, self.getQualities( self.outfile, redo_baq = True ) )
+        self.assertNotEqual( reference, self.getQualities( self.filename, compute_baq = False ) )
+
+    def testThreads( self ):
+        pysam.compute_baq( self.filename, "test_baq_threads.bam", self.fastafilename,
+                           threads = 4, batch_size = 100 )
+        self.assertTrue( checkBinaryEqual( self.outfile, "test_baq_threads.bam" ) )
+        os.unlink( "test_baq_threads.bam" )
+
+    def testThreadsUnmappedFirst( self ):
+        '''threads with a batch starting with an unmapped read.'''
+        infile = pysam.Samfile( self.filename, "rb" )
+        outfile = pysam.Samfile( "test_baq_in.bam", "wb", template = infile )
+        for x, read in enumerate( infile ):
+            if x == 0:
+                unmapped = pysam.AlignedRead.from_bytes( read.to_bytes() )
+                unmapped.is_unmapped = True
+                outfile.write( unmapped )
+            outfile.write( read )
+        outfile.close()
+        infile.close()
+        pysam.compute_baq( "test_baq_in.bam", "test_baq_1.bam", self.fastafilename )
+        pysam.compute_baq( "test_baq_in.bam", "test_baq_4.bam", self.fastafilename,
+                           threads = 4, batch_size = 100 )
+        self.assertTrue( checkBinaryEqual( "test_baq_1.bam", "test_baq_4.bam" ) )
+        for fn in ( "test_baq_in.bam", "test_baq_1.bam", "test_baq_4.bam" ):
+            os.unlink( fn )
+
+    def testExtended( self ):
+        pysam.compute_baq( self.filename, "test_baq_ext.bam", self.fastafilename,
+                           extended = True )
+        pysam.compute_baq( self.filename, "test_baq_ext4.bam", self.fastafilename,
+                           extended = True, threads = 4, batch_size = 100 )
+        self.assertTrue( checkBinaryEqual( "test_baq_ext.bam", "test_baq_ext4.bam" ) )
+        self.assertFalse( checkBinaryEqual( self.outfile, "test_baq_ext.bam" ) )
+        pysam.index( "test_baq_ext.bam" )
+        reference = self.getQualities( self.filename, extended_baq = True )
+        self.assertEqual( reference, self.getQualities( "test_baq_ext.bam", extended_baq = True ) )
+        self.assertNotEqual( reference, self.getQualities( self.filename ) )
+        for fn in ( "test_baq_ext.bam", "test_baq_ext.bam.bai", "test_baq_ext4.bam" ):
+            os.unlink( fn )
+
+    def tearDown( self ):
+        os.unlink( self.outfile )
+        os.unlink( self.outfile + ".bai" )
+
 class TestAlignedReadFromBam(unittest.TestCase):
 
     def setUp(self):
@@ -1123,8 +1335,20 @@ class TestHeaderSam(unittest.TestCase):
             self.assertEqual( ref, y )
 
         self.assertEqual( self.samfile.gettid("chr?"), -1 )
+        self.assertEqual( self.samfile.gettid(b"chr2"), 1 )
         self.assertRaises( ValueError, self.samfile.getrname, 2 )
 
+    def testHeaderCache( self ):
+        '''modifying the returned header does not change the cached copy.'''
+        header = self.samfile.header
+        header["HD"]["VN"] = "2.0"
+        header["SQ"][0]["LN"] = 1
+        header["CO"].append( "yet another comment" )
+        del header["PG"]
+        self.compareHeaders( self.header, self.samfile.header )
+        self.assertTrue( self.samfile.references is self.samfile.references )
+        self.assertTrue( self.samfile.lengths is self.samfile.lengths )
+
     def tearDown(self):
         self.samfile.close()
 
@@ -1163,6 +1387,127 @@ class TestHeader1000Genomes( unittest.TestCase ):
         data = f.header.copy()
         self.assertTrue( data )
 
+class TestOpen( unittest.TestCase ):
+    '''test format detection and the header cache.'''
+
+    def testAutoDetect( self ):
+        samfile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ) )
+        self.assertTrue( samfile.filename.endswith( b"ex1.bam" ) )
+        self.assertEqual( len( list( samfile.fetch( "chr1", 100, 200 ) ) ), samfile.count( "chr1", 100, 200 ) )
+        samfile.close()
+        samfile = pysam.Samfile( os.path.join( DATADIR, "ex3.sam" ) )
+        self.assertRaises( ValueError, samfile.fetch, "chr1", 100, 200 )
+        self.assertEqual( [ x.qname for x in samfile.fetch() ],
+                          [ x.qname for x in pysam.Samfile( os.path.join( DATADIR, "ex3.sam" ), "r" ) ] )
+        samfile.close()
+
+    def testHeaderCache( self ):
+        pysam.clear_header_cache()
+        filename = os.path.join( DATADIR, "ex3.bam" )
+        ref = pysam.Samfile( filename, "rb" )
+        samfile1 = pysam.Samfile( filename, "rb", cache_header = True )
+        samfile2 = pysam.Samfile( filename, "rb", cache_header = True )
+        # reference names are shared between cached files
+        self.assertTrue( samfile1.references is samfile2.references )
+        for samfile in (samfile1, samfile2):
+            self.assertEqual( samfile.references, ref.references )
+            self.assertEqual( samfile.lengths, ref.lengths )
+            self.assertEqual( samfile.header, ref.header )
+            self.assertEqual( samfile.text, ref.text )
+            self.assertEqual( samfile.gettid( "chr2" ), 1 )
+            self.assertEqual( [ x.qname for x in samfile ],
+                              [ x.qname for x in pysam.Samfile( filename, "rb" ) ] )
+        samfile1.close()
+        samfile2.close()
+        ref.close()
+        pysam.clear_header_cache()
+
+    def testLazyIndex( self ):
+        filename = os.path.join( DATADIR, "ex1.bam" )
+        ref = pysam.Samfile( filename, "rb" )
+        samfile = pysam.Samfile( filename, "rb", lazy_index = True )
+        # counts are available without decoding any reference
+        self.assertEqual( samfile.mapped, ref.mapped )
+        self.assertEqual( samfile.unmapped, ref.unmapped )
+        self.assertEqual( samfile.estimate( "chr2", 100, 1000 ), ref.estimate( "chr2", 100, 1000 ) )
+        for region in ( ("chr2", 100, 1000), ("chr1", 0, 1575), ("chr1", 1000, 1200) ):
+            self.assertEqual( [ x.qname for x in samfile.fetch( *region ) ],
+                              [ x.qname for x in ref.fetch( *region ) ] )
+            self.assertEqual( samfile.count( *region ), ref.count( *region ) )
+        self.assertEqual( [ x.pos for x in samfile.pileup( "chr1", 100, 120 ) ],
+                          [ x.pos for x in ref.pileup( "chr1", 100, 120 ) ] )
+        samfile.close()
+        ref.close()
+
+    def testLazyIndexTruncated( self ):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join( tmpdir, "ex1.bam" )
+        shutil.copy( os.path.join( DATADIR, "ex1.bam" ), filename )
+        data = open( os.path.join( DATADIR, "ex1.bam.bai" ), "rb" ).read()
+        # cut the index in the linear index of chr2
+        open( filename + ".bai", "wb" ).write( data[:len(data) - 16] )
+        ref = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        samfile = pysam.Samfile( filename, "rb", lazy_index = True )
+        self.assertEqual( samfile.count( "chr1", 100, 1000 ), ref.count( "chr1", 100, 1000 ) )
+        self.assertRaises( IOError, samfile.count, "chr2", 100, 1000 )
+        self.assertRaises( IOError, getattr, samfile, "mapped" )
+        samfile.close()
+        ref.close()
+        shutil.rmtree( tmpdir )
+
+class TestFileObject( unittest.TestCase ):
+    '''test reading from and writing to python file objects.'''
+
+    filename = os.path.join( DATADIR, "ex1.bam" )
+
+    def testWriteRead( self ):
+        infile = pysam.Samfile( self.filename, "rb" )
+        reads = [ x.qname for x in infile.fetch() ]
+        buf = io.BytesIO()
+        outfile = pysam.Samfile( buf, "wb", template = infile )
+        for read in infile.fetch(): outfile.write( read )
+        outfile.close()
+        data = buf.getvalue()
+        self.assertEqual( data, open( self.filename, "rb" ).read() )
+
+        samfile = pysam.Samfile( io.BytesIO( data ) )
+        self.assertEqual( samfile.references, infile.references )
+        self.assertEqual( [ x.qname for x in samfile ], reads )
+        samfile.close()
+        samfile = pysam.Samfile( io.BytesIO( data ), "rb" )
+        self.assertEqual( [ x.qname for x in samfile.fetch( until_eof = True ) ], reads )
+        self.assertRaises( ValueError, samfile.fetch, "chr1", 100, 200 )
+        samfile.close()
+        infile.close()
+
+    def testWriteMany( self ):
+        infile = pysam.Samfile( self.filename, "rb" )
+        buf = io.BytesIO()
+        outfile = pysam.Samfile( buf, "wb0", template = infile )
+        outfile.write_many( infile.fetch() )
+        outfile.close()
+        self.assertEqual( [ x.qname for x in pysam.Samfile( io.BytesIO( buf.getvalue() ) ) ],
+                          [ x.qname for x in infile.fetch() ] )
+        infile.close()
+
+    def testEarlyClose( self ):
+        samfile = pysam.Samfile( open( self.filename, "rb" ) )
+        next( samfile )
+        samfile.close()
+
+    def testErrors( self ):
+        self.assertRaises( ValueError, pysam.Samfile, io.BytesIO( b"no bam data" ) )
+        self.assertRaises( AssertionError, pysam.Samfile, io.BytesIO(), "r" )
+
+        class Failing( object ):
+            def write( self, data ): raise ValueError( "failed" )
+
+        infile = pysam.Samfile( self.filename, "rb" )
+        outfile = pysam.Samfile( Failing(), "wb", template = infile )
+        outfile.write_many( infile.fetch() )
+        self.assertRaises( IOError, outfile.close )
+        infile.close()
+
 class TestUnmappedReads(unittest.TestCase):
 
     def testSAM(self):
@@ -1568,6 +1913,32 @@ class TestAlignedRead(unittest.TestCase):
         # aend points to one beyond last aligned base in ref
         self.assertEqual( a.positions[-1], a.aend - 1 )
 
+    def testBytes( self ):
+        a = self.buildRead()
+        a.tags = [ ("NM", 1), ("RG", "L1"), ("XB", [1, 2, 3]) ]
+        b = pysam.AlignedRead.from_bytes( a.to_bytes() )
+        self.checkFieldEqual( a, b )
+        self.assertEqual( a.tags, b.tags )
+        self.assertEqual( a.compare( b ), 0 )
+        self.assertEqual( pysam.AlignedRead.from_bytes( bytearray( a.to_bytes() ) ).compare( a ), 0 )
+        # the record is stored as in a BAM file
+        # block size, core, qname, cigar, seq, qual and tags
+        self.assertEqual( len( a.to_bytes() ), 4 + 32 + 11 + 20 + 20 + 40 + 4 + 6 + 11 )
+
+    def testBytesInvalid( self ):
+        buf = self.buildRead().to_bytes()
+        self.assertRaises( ValueError, pysam.AlignedRead.from_bytes, buf[:-1] )
+        self.assertRaises( ValueError, pysam.AlignedRead.from_bytes, buf + b"\0" )
+        self.assertRaises( ValueError, pysam.AlignedRead.from_bytes, b"" )
+
+    def testPickle( self ):
+        import pickle
+        a = self.buildRead()
+        for protocol in range( pickle.HIGHEST_PROTOCOL + 1 ):
+            b = pickle.loads( pickle.dumps( a, protocol ) )
+            self.checkFieldEqual( a, b )
+            self.assertEqual( a.compare( b ), 0 )
+
 class TestDeNovoConstruction(unittest.TestCase):
     '''check BAM/SAM file construction using ex6.sam
     
@@ -2055,6 +2426,66 @@ class TestSamfileUtilityFunctions( unittest.TestCase ):
                     self.assertEqual( read.pos, mate.mpos )
                     self.assertEqual( read.mpos, mate.pos )
 
+    def testFetchPairs( self ):
+        '''test single pass mate pairing against mate().'''
+
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb" )
+        for contig, start, end in ( ("chr1", 0, 1575), 
+                                    ("chr1", 500, 800),
+                                    ("chr2", 1000, 1200) ):
+            expected = set()
+            for read in samfile.fetch( contig, start, end ):
+                if not read.is_paired or read.mate_is_unmapped: continue
+                try:
+                    mate = samfile.mate( read )
+                except ValueError:
+                    continue
+                expected.add( read.qname )
+
+            found = set()
+            for read1, read2 in samfile.fetch_pairs( contig, start, end ):
+                self.assertEqual( read1.qname, read2.qname )
+                self.assertTrue( read1.is_read1 )
+                self.assertTrue( read2.is_read2 )
+                if not read1.mate_is_unmapped and not read2.mate_is_unmapped:
+                    self.assertEqual( read1.pos, read2.mpos )
+                    self.assertEqual( read1.mpos, read2.pos )
+                self.assertFalse( read1.qname in found )
+                found.add( read1.qname )
+
+            self.assertTrue( expected.issubset( found ) )
+
+        self.assertRaises( ValueError, list, samfile.fetch_pairs() )
+
+    def testFetchPairsSameName( self ):
+        '''reads of the same orientation and name are not dropped.'''
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join( tmpdir, "pairs.bam" )
+            outf = pysam.Samfile( filename, "wb", header = { "SQ" : [ { "SN" : "chr1", "LN" : 1000 } ] } )
+            for flag, pos, mpos in ( (65, 100, 200), (65, 150, 250), (129, 200, 100), (129, 250, 150) ):
+                read = pysam.AlignedRead()
+                read.qname = "pair"
+                read.seq = "ACGT" * 10
+                read.qual = "I" * 40
+                read.cigar = [ (0, 40) ]
+                read.flag = flag
+                read.tid = read.mrnm = 0
+                read.pos = pos
+                read.mpos = mpos
+                outf.write( read )
+            outf.close()
+            pysam.index( filename )
+            samfile = pysam.Samfile( filename, "rb" )
+            self.assertEqual( [ (x.pos, y.pos) for x, y in samfile.fetch_pairs( "chr1", 0, 1000 ) ],
+                              [ (100, 200), (150, 250) ] )
+            self.assertEqual( [ (x.pos, y.pos) for x, y in samfile.fetch_pairs( "chr1", 0, 190 ) ],
+                              [ (100, 200), (150, 250) ] )
+            samfile.close()
+        finally:
+            shutil.rmtree( tmpdir )
+
     def testIndexStats( self ):
         '''test if total number of mapped/unmapped reads is correct.'''
 
@@ -2063,6 +2494,128 @@ class TestSamfileUtilityFunctions( unittest.TestCase ):
         self.assertEqual( samfile.mapped, 3235 )
         self.assertEqual( samfile.unmapped, 35 )
 
+    def testIndexStatistics( self ):
+        '''test per reference statistics.'''
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb")
+        stats = samfile.index_statistics()
+        self.assertEqual( [ x[0] for x in stats[:-1] ], list(samfile.references) )
+        self.assertEqual( [ x[1] for x in stats[:-1] ], list(samfile.lengths) )
+        self.assertEqual( sum( [ x[2] for x in stats ] ), samfile.mapped )
+        self.assertEqual( sum( [ x[3] for x in stats ] ), samfile.unmapped )
+
+        # output of samtools idxstats
+        self.assertEqual( stats, [ ("chr1", 1575, 1446, 18),
+                                   ("chr2", 1584, 1789, 17),
+                                   ("*", 0, 0, 0) ] )
+
+    def testEstimate( self ):
+        '''test region cost estimation from the index.'''
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb")
+        nbytes, nreads = samfile.estimate( "chr1" )
+        self.assertTrue( nbytes > 0 )
+        self.assertEqual( nreads, 1446 + 18 )
+
+        nbytes2, nreads2 = samfile.estimate( "chr1", 100, 200 )
+        self.assertTrue( 0 < nbytes2 <= nbytes )
+        self.assertTrue( 0 < nreads2 <= nreads )
+        self.assertEqual( samfile.estimate( region = "chr1:101-200" ), (nbytes2, nreads2) )
+
+        # no reads beyond the end of the reference
+        self.assertEqual( samfile.estimate( "chr1", 20000, 30000 ), (0, 0) )
+        self.assertRaises( ValueError, samfile.estimate )
+
+class TestRegion( unittest.TestCase ):
+    '''test Region objects and the region parser.'''
+
+    def setUp( self ):
+        self.samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                     "rb")
+
+    def tearDown( self ):
+        self.samfile.close()
+
+    def testParse( self ):
+        r = pysam.Region( "chr1:1,001-2,000" )
+        self.assertEqual( (r.reference, r.start, r.end), ("chr1", 1000, 2000) )
+        r = pysam.Region( "chr1:100" )
+        self.assertEqual( (r.reference, r.start), ("chr1", 99) )
+        r = pysam.Region( "chr1" )
+        self.assertEqual( (r.reference, r.start), ("chr1", 0) )
+        self.assertEqual( str( r ), "chr1" )
+        r = pysam.Region( "chr1", 99, 200 )
+        self.assertEqual( str( r ), "chr1:100-200" )
+        r = pysam.Region( "HLA-A*01:01:01:01", 0, 100 )
+        self.assertEqual( r.reference, "HLA-A*01:01:01:01" )
+
+        self.assertRaises( ValueError, pysam.Region, "chr1:x-100" )
+        self.assertRaises( ValueError, pysam.Region, "chr1:200-100" )
+        self.assertRaises( ValueError, pysam.Region, "chr1:0-100" )
+        self.assertRaises( ValueError, pysam.Region, "chr1", -1, 100 )
+
+    def testParseRegions( self ):
+        regions = pysam.parse_regions( [ "chr1:101-200",
+                                         "# comment",
+                                         "track name=test",
+                                         "chr2\t100\t200\tname\n",
+                                         ("chr1", 100, 200) ] )
+        self.assertEqual( [ (x.reference, x.start, x.end) for x in regions ],
+                          [ ("chr1", 100, 200),
+                            ("chr2", 100, 200),
+                            ("chr1", 100, 200) ] )
+
+        regions = pysam.parse_regions( [ b"browser position chr1",
+                                         "chr1\t0\t1000\r\n",
+                                         "chr2\t5\t10",
+                                         "chr2:1,001",
+                                         "" ] )
+        self.assertEqual( [ (x.reference, x.start, x.end) for x in regions ],
+                          [ ("chr1", 0, 1000),
+                            ("chr2", 5, 10),
+                            ("chr2", 1000, 1 << 30) ] )
+        self.assertEqual( [ x.qname for x in self.samfile.fetch( regions[0] ) ],
+                          [ x.qname for x in self.samfile.fetch( "chr1", 0, 1000 ) ] )
+
+        for line in ( "chr1\t100", "chr1\t-1\t100", "chr1\t1x\t100", "chr1\t200\t100",
+                      "\t1\t100", "chr1:x" ):
+            self.assertRaises( ValueError, pysam.parse_regions, [ line ] )
+
+    def testFetch( self ):
+        for reference, start, end in ( ("chr1", 100, 200), ("chr2", 1000, 1200) ):
+            ref = [ x.qname for x in self.samfile.fetch( reference, start, end ) ]
+            region = pysam.Region( reference, start, end )
+            # use twice to check the cached tid
+            for x in range(2):
+                self.assertEqual( [ x.qname for x in self.samfile.fetch( region ) ], ref )
+                self.assertEqual( [ x.qname for x in self.samfile.fetch( region = region ) ], ref )
+            self.assertEqual( self.samfile.count( region = region ), len(ref) )
+            self.assertEqual( len( list( self.samfile.pileup( region = region ) ) ),
+                              len( list( self.samfile.pileup( reference, start, end ) ) ) )
+
+    def testTidCache( self ):
+        '''a region used with files with different reference order.'''
+        header = self.samfile.header
+        header["SQ"] = header["SQ"][::-1]
+        filename = "tmp_%i.bam" % id(self)
+        outfile = pysam.Samfile( filename, "wb", header = header )
+        outfile.close()
+        other = pysam.Samfile( filename, "rb" )
+        region = pysam.Region( "chr2", 100, 200 )
+        refcount = sys.getrefcount( self.samfile )
+        for x in range(2):
+            self.assertEqual( self.samfile._parseRegion( region )[1], 1 )
+            self.assertEqual( other._parseRegion( region )[1], 0 )
+        # the region does not keep the file alive
+        self.assertEqual( sys.getrefcount( self.samfile ), refcount )
+        other.close()
+        os.unlink( filename )
+
+    def testInvalid( self ):
+        self.assertRaises( ValueError, self.samfile.fetch, pysam.Region( "chrUn:1-100" ) )
+        self.assertRaises( ValueError, self.samfile.fetch, pysam.Region( "chr1" ), 100, 200 )
+        self.assertRaises( ValueError, self.samfile.fetch, region = "chr1:x-100" )
+
 class TestSamtoolsProxy( unittest.TestCase ):
     '''tests for sanity checking access to samtools functions.'''
 
@@ -2076,6 +2629,410 @@ class TestSamtoolsProxy( unittest.TestCase ):
     def testSort( self ):
         self.assertRaises( pysam.SamtoolsError, pysam.sort, "missing_file" )
 
+class TestBuildIndex( unittest.TestCase ):
+    '''test in-process index building.'''
+
+    def setUp( self ):
+        self.filename = "tmp_%i.bam" % id(self)
+        shutil.copyfile( os.path.join( DATADIR, "ex1.bam" ), self.filename )
+
+    def tearDown( self ):
+        for fn in (self.filename, self.filename + ".bai"):
+            if os.path.exists( fn ): os.unlink( fn )
+
+    def testBuildIndex( self ):
+        pysam.build_index( self.filename )
+        self.assertTrue( checkBinaryEqual( self.filename + ".bai",
+                                           os.path.join( DATADIR, "ex1.bam.bai" ) ) )
+
+    def testBuildIndexThreads( self ):
+        pysam.build_index( self.filename, threads = 4 )
+        self.assertTrue( checkBinaryEqual( self.filename + ".bai",
+                                           os.path.join( DATADIR, "ex1.bam.bai" ) ) )
+        self.assertEqual( sorted( [ x for x in os.listdir( "." ) if x.startswith( self.filename ) ] ),
+                          [ self.filename, self.filename + ".bai" ] )
+
+    def testSamfileBuildIndex( self ):
+        samfile = pysam.Samfile( self.filename, "rb" )
+        self.assertRaises( ValueError, samfile.fetch, "chr1" )
+        samfile.build_index( threads = 2 )
+        self.assertEqual( len( list( samfile.fetch( "chr1", 100, 200 ) ) ),
+                          len( list( pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" ).fetch( "chr1", 100, 200 ) ) ) )
+        samfile.close()
+
+    def testIndexWhileWriting( self ):
+        infile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        for use_write_many in (False, True):
+            outfile = pysam.Samfile( self.filename, "wb", template = infile, index = True )
+            if use_write_many:
+                outfile.write_many( infile.fetch() )
+            else:
+                for read in infile.fetch(): outfile.write( read )
+            outfile.close()
+            self.assertTrue( checkBinaryEqual( self.filename + ".bai",
+                                               os.path.join( DATADIR, "ex1.bam.bai" ) ) )
+            os.unlink( self.filename + ".bai" )
+        infile.close()
+
+    def testIndexWhileWritingUnsorted( self ):
+        infile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        reads = list( infile.fetch( "chr1", 100, 200 ) )
+        outfile = pysam.Samfile( self.filename, "wb", template = infile, index = True )
+        self.assertRaises( ValueError, outfile.write_many, reversed( reads ) )
+        outfile.close()
+        self.assertFalse( os.path.exists( self.filename + ".bai" ) )
+        self.assertRaises( AssertionError, pysam.Samfile, self.filename, "w", template = infile, index = True )
+        infile.close()
+
+    def testMissingFile( self ):
+        self.assertRaises( IOError, pysam.build_index, "missing_file" )
+
+    def testUnsorted( self ):
+        infile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        reads = list( infile.fetch( "chr1", 100, 200 ) )
+        outfile = pysam.Samfile( self.filename, "wb", template = infile )
+        for read in reversed( reads ): outfile.write( read )
+        outfile.close()
+        self.assertRaises( ValueError, pysam.build_index, self.filename )
+        self.assertFalse( os.path.exists( self.filename + ".bai" ) )
+
+class TestExtract( unittest.TestCase ):
+    '''test copying regions into a new file.'''
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join( self.tmpdir, "in.bam" )
+        self.output = os.path.join( self.tmpdir, "out.bam" )
+        # spread reads over many index windows and BGZF blocks
+        header = { "SQ" : [ { "SN" : "chr1", "LN" : 300000 }, { "SN" : "chr2", "LN" : 100000 } ] }
+        outf = pysam.Samfile( self.filename, "wb", header = header )
+        for tid, length in enumerate( (300000, 100000) ):
+            for x, pos in enumerate( range( 0, length - 1000, 17 ) ):
+                read = pysam.AlignedRead()
+                read.qname = "read_%i_%i" % (tid, x)
+                read.seq = "ACGT" * 10
+                read.qual = "I" * 40
+                read.tid = tid
+                if x % 50 == 0:
+                    read.flag = 4
+                elif x % 70 == 0:
+                    read.cigar = [ (0, 20), (3, 2000), (0, 20) ]
+                else:
+                    read.cigar = [ (0, 40) ]
+                read.pos = pos
+                outf.write( read )
+        outf.close()
+        pysam.index( self.filename )
+        self.samfile = pysam.Samfile( self.filename, "rb" )
+
+    def tearDown( self ):
+        self.samfile.close()
+        shutil.rmtree( self.tmpdir )
+
+    def checkRegions( self, regions ):
+        '''extract regions and compare to fetch.'''
+        copied = self.samfile.extract( regions, self.output )
+        key = lambda x: (x.tid, x.pos, x.qname)
+        expected = set()
+        for region in regions:
+            expected.update( [ key( x ) for x in self.samfile.fetch( region = region ) ] )
+        result = [ key( x ) for x in pysam.Samfile( self.output, "rb" ) ]
+        self.assertEqual( result, sorted( expected ) )
+        return copied
+
+    def testRegions( self ):
+        self.assertTrue( self.checkRegions( [ "chr1" ] ) > 0 )
+        self.assertTrue( self.checkRegions( [ "chr1:20000-250000", "chr2:500-90000" ] ) > 0 )
+        self.assertEqual( self.checkRegions( [ "chr1:100-200" ] ), 0 )
+        self.checkRegions( [ "chr1:16384-16385", "chr1:32769", "chr2:1-100" ] )
+        self.checkRegions( [ "chr2:99500-100000" ] )
+
+    def testOverlappingRegions( self ):
+        self.checkRegions( [ "chr1:20000-150000", "chr1:100000-200000", "chr1:200001-210000",
+                             "chr1:1000-1100" ] )
+
+    def testRegionObjects( self ):
+        self.samfile.extract( pysam.Region( "chr2", 1000, 50000 ), self.output )
+        self.assertEqual( sum( [ 1 for x in pysam.Samfile( self.output, "rb" ) ] ),
+                          self.samfile.count( "chr2", 1000, 50000 ) )
+        self.samfile.extract( "chr2:1001-50000", self.output, compresslevel = 1 )
+        self.assertEqual( pysam.Samfile( self.output, "rb" ).references, self.samfile.references )
+        self.assertEqual( sum( [ 1 for x in pysam.Samfile( self.output, "rb" ) ] ),
+                          self.samfile.count( "chr2", 1000, 50000 ) )
+
+    def testErrors( self ):
+        samfile = pysam.Samfile( os.path.join( DATADIR, "ex2.sam" ), "r" )
+        self.assertRaises( ValueError, samfile.extract, "chr1", self.output )
+        self.assertRaises( ValueError, self.samfile.extract, "chr3", self.output )
+
+class TestReplaceHeader( unittest.TestCase ):
+    '''test replacing the header of a BAM file.'''
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join( self.tmpdir, "in.bam" )
+        self.output = os.path.join( self.tmpdir, "out.bam" )
+        shutil.copy( os.path.join( DATADIR, "ex1.bam" ), self.filename )
+        shutil.copy( os.path.join( DATADIR, "ex1.bam.bai" ), self.filename + ".bai" )
+        samfile = pysam.Samfile( self.filename, "rb" )
+        self.header = samfile.header
+        self.reads = [ x.to_bytes() for x in samfile ]
+        self.counts = [ samfile.count( "chr1", x, x + 200 ) for x in range( 0, 1500, 100 ) ]
+        samfile.close()
+        self.newheader = dict( self.header )
+        self.newheader["SQ"] = [ dict( x ) for x in self.header["SQ"] ]
+        self.newheader["SQ"][0]["SN"] = "chrI"
+        self.newheader["CO"] = [ "comment %i" % x for x in range( 200 ) ]
+
+    def tearDown( self ):
+        shutil.rmtree( self.tmpdir )
+
+    def checkFile( self, filename ):
+        samfile = pysam.Samfile( filename, "rb" )
+        self.assertEqual( samfile.header, self.newheader )
+        self.assertEqual( samfile.references, ("chrI", "chr2") )
+        self.assertEqual( [ x.to_bytes() for x in samfile ], self.reads )
+        self.assertEqual( [ samfile.count( "chrI", x, x + 200 ) for x in range( 0, 1500, 100 ) ],
+                          self.counts )
+        samfile.close()
+
+    def testOutput( self ):
+        copied = pysam.replace_header( self.filename, self.newheader, self.output )
+        self.assertTrue( copied > 0 )
+        self.assertTrue( os.path.exists( self.output + ".bai" ) )
+        self.checkFile( self.output )
+        self.assertEqual( pysam.Samfile( self.filename, "rb" ).header, self.header )
+        self.assertEqual( sorted( os.listdir( self.tmpdir ) ),
+                          [ "in.bam", "in.bam.bai", "out.bam", "out.bam.bai" ] )
+
+    def testInPlace( self ):
+        self.assertEqual( pysam.Samfile( self.filename, "rb" ).header, self.header )
+        pysam.replace_header( self.filename, self.newheader, compresslevel = 1 )
+        self.checkFile( self.filename )
+        # and back again from a template
+        template = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        pysam.replace_header( self.filename, template )
+        template.close()
+        samfile = pysam.Samfile( self.filename, "rb" )
+        self.assertEqual( samfile.header, self.header )
+        self.assertEqual( [ x.to_bytes() for x in samfile ], self.reads )
+        self.assertEqual( [ samfile.count( "chr1", x, x + 200 ) for x in range( 0, 1500, 100 ) ],
+                          self.counts )
+
+    def testWithoutIndex( self ):
+        os.unlink( self.filename + ".bai" )
+        pysam.replace_header( self.filename, self.newheader, self.output )
+        self.assertFalse( os.path.exists( self.output + ".bai" ) )
+        samfile = pysam.Samfile( self.output, "rb" )
+        self.assertEqual( samfile.header, self.newheader )
+        self.assertEqual( [ x.to_bytes() for x in samfile ], self.reads )
+
+    def testErrors( self ):
+        header = dict( self.header )
+        header["SQ"] = self.header["SQ"][:1]
+        self.assertRaises( ValueError, pysam.replace_header, self.filename, header )
+        self.assertRaises( ValueError, pysam.replace_header, self.filename, self.header,
+                           compresslevel = 10 )
+        self.assertRaises( IOError, pysam.replace_header,
+                           os.path.join( self.tmpdir, "missing.bam" ), self.header )
+        self.assertEqual( pysam.Samfile( self.filename, "rb" ).header, self.header )
+
+class TestMarkDuplicates( unittest.TestCase ):
+    '''test duplicate marking against a simple implementation.'''
+
+    def setUp( self ):
+        self.filename = "tmp_%i.bam" % id(self)
+
+    def tearDown( self ):
+        if os.path.exists( self.filename ): os.unlink( self.filename )
+
+    def getDuplicates( self, reads ):
+        '''return the indices of duplicates in *reads*.'''
+
+        def pos5( read ):
+            if read.is_reverse:
+                pos = read.aend - 1
+                for op, l in reversed( read.cigar ):
+                    if op not in (4, 5): break
+                    pos += l
+            else:
+                pos = read.pos
+                for op, l in read.cigar:
+                    if op not in (4, 5): break
+                    pos -= l
+            return pos
+
+        fragments, pairs, paired_at, mates = collections.defaultdict( list ), collections.defaultdict( list ), set(), {}
+        for x, read in enumerate( reads ):
+            if read.is_unmapped or read.is_secondary: continue
+            score = sum( [ q - 33 for q in bytearray( read.qual ) if q - 33 >= 15 ] )
+            key = (read.tid, pos5( read ), read.is_reverse)
+            if read.is_paired and not read.mate_is_unmapped:
+                paired_at.add( key )
+                if read.qname in mates:
+                    mates[read.qname].append( x )
+                else:
+                    mates[read.qname] = [x]
+                    pairs[key + (read.rnext, read.pnext, read.mate_is_reverse)].append( (-score, x) )
+            else:
+                fragments[key].append( (-score, x) )
+
+        duplicates = set()
+        for key, group in fragments.items():
+            if key in paired_at: duplicates.update( [ x for score, x in group ] )
+            else: duplicates.update( [ x for score, x in sorted( group )[1:] ] )
+        for group in pairs.values():
+            for score, x in sorted( group )[1:]:
+                duplicates.update( mates[reads[x].qname] )
+        return duplicates
+
+    def testMark( self ):
+        reads = list( pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" ) )
+        expected = self.getDuplicates( reads )
+        for threads in (1, 3):
+            stats = pysam.mark_duplicates( os.path.join( DATADIR, "ex1.bam" ), self.filename, threads = threads )
+            result = list( pysam.Samfile( self.filename, "rb" ) )
+            self.assertEqual( [ x.qname for x in result ], [ x.qname for x in reads ] )
+            self.assertEqual( set( [ x for x, read in enumerate( result ) if read.is_duplicate ] ), expected )
+            self.assertEqual( stats["reads"], len( reads ) )
+            self.assertEqual( stats["unpaired_duplicates"] + stats["paired_duplicates"], len( expected ) )
+            self.assertAlmostEqual( stats["duplicate_fraction"],
+                                    float( len( expected ) ) / (len( reads ) - stats["unmapped"]) )
+
+    def testRemove( self ):
+        stats = pysam.mark_duplicates( os.path.join( DATADIR, "ex1.bam" ), self.filename, remove = True )
+        result = list( pysam.Samfile( self.filename, "rb" ) )
+        self.assertEqual( len( result ),
+                          stats["reads"] - stats["unpaired_duplicates"] - stats["paired_duplicates"] )
+        self.assertFalse( any( [ x.is_duplicate for x in result ] ) )
+
+    def testUnsorted( self ):
+        pysam.sort_records( os.path.join( DATADIR, "ex1.bam" ), self.filename, key = "queryname" )
+        self.assertRaises( ValueError, pysam.mark_duplicates, self.filename, self.filename + ".out" )
+        if os.path.exists( self.filename + ".out" ): os.unlink( self.filename + ".out" )
+
+class TestBytesFromBam( unittest.TestCase ):
+    '''round trip reads from a BAM file through to_bytes.'''
+
+    def testRoundTrip( self ):
+        reads = list( pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" ) )
+        for read in reads:
+            self.assertEqual( pysam.AlignedRead.from_bytes( read.to_bytes() ).compare( read ), 0 )
+        # records are laid out as in the uncompressed BAM file
+        data = gzip.open( os.path.join( DATADIR, "ex1.bam" ) ).read()
+        self.assertTrue( data.endswith( b"".join( [ x.to_bytes() for x in reads ] ) ) )
+
+class TestSplitWriter( unittest.TestCase ):
+    '''test splitting a BAM file into many files.'''
+
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.samfile = pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" )
+        self.pattern = os.path.join( self.tmpdir, "{key}.bam" )
+
+    def tearDown( self ):
+        self.samfile.close()
+        shutil.rmtree( self.tmpdir )
+
+    def checkSplit( self, keyfunc, filenames ):
+        '''check that files contain the reads of ex1.bam grouped by keyfunc.'''
+        expected = collections.defaultdict( list )
+        for read in pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" ):
+            key = keyfunc( read )
+            if key is not None: expected[key].append( (read.qname, read.pos, read.flag) )
+        self.assertEqual( set( filenames.keys() ), set( expected.keys() ) )
+        for key, filename in filenames.items():
+            infile = pysam.Samfile( filename, "rb" )
+            self.assertEqual( infile.references, self.samfile.references )
+            self.assertEqual( [ (x.qname, x.pos, x.flag) for x in infile ], expected[key] )
+            infile.close()
+
+    def testContig( self ):
+        with pysam.SplitWriter( self.samfile, key = "contig", path_pattern = self.pattern ) as outf:
+            outf.write_many( self.samfile )
+        self.checkSplit( lambda x: "unmapped" if x.tid < 0 else self.samfile.getrname( x.tid ),
+                         outf.filenames )
+        self.assertEqual( outf.filenames["chr1"], os.path.join( self.tmpdir, "chr1.bam" ) )
+
+    def testTag( self ):
+        '''many small flushes with a single open file.'''
+        outf = pysam.SplitWriter( self.samfile, key = "NM", path_pattern = self.pattern,
+                                  max_open = 1, threads = 2, buffer_size = 5000, compresslevel = 1 )
+        for read in self.samfile: outf.write( read )
+        outf.close()
+        self.checkSplit( lambda x: dict( x.tags ).get( "NM", "unassigned" ), outf.filenames )
+
+    def testCallable( self ):
+        outf = pysam.SplitWriter( self.samfile,
+                                  key = lambda x: None if x.is_unmapped else x.qname[-1],
+                                  path_pattern = self.pattern, max_open = 3, buffer_size = "20K" )
+        outf.write_many( self.samfile )
+        outf.close()
+        self.assertRaises( ValueError, outf.write, pysam.AlignedRead() )
+        self.checkSplit( lambda x: None if x.is_unmapped else x.qname[-1], outf.filenames )
+
+    def testSameFilename( self ):
+        '''keys with the same file name share the file.'''
+        outf = pysam.SplitWriter( self.samfile, key = lambda x: 1 if x.is_read1 else "1",
+                                  path_pattern = self.pattern, buffer_size = "20K" )
+        outf.write_many( self.samfile )
+        outf.close()
+        filename = os.path.join( self.tmpdir, "1.bam" )
+        self.assertEqual( outf.filenames, { 1 : filename, "1" : filename } )
+        self.checkSplit( lambda x: "1", { "1" : filename } )
+
+    def testInvalid( self ):
+        self.assertRaises( ValueError, pysam.SplitWriter, self.samfile, key = "invalid" )
+        self.assertRaises( ValueError, pysam.SplitWriter, self.samfile, key = 5 )
+        self.assertRaises( ValueError, pysam.SplitWriter, self.samfile, max_open = 0 )
+        self.assertRaises( ValueError, pysam.SplitWriter, self.samfile, compresslevel = 10 )
+
+class TestSortRecords( unittest.TestCase ):
+    '''test in-process sorting.'''
+
+    def setUp( self ):
+        self.filename = "tmp_%i.bam" % id(self)
+        self.sorted = "tmp_%i_sorted.bam" % id(self)
+
+    def tearDown( self ):
+        for fn in (self.filename, self.sorted):
+            if os.path.exists( fn ): os.unlink( fn )
+
+    def getKeys( self, filename ):
+        return [ (x.tid, x.pos) for x in pysam.Samfile( filename, "rb" ) ]
+
+    def testQueryname( self ):
+        pysam.sort( "-n", os.path.join( DATADIR, "ex1.bam" ), self.filename[:-4] )
+        ref = [ x.qname for x in pysam.Samfile( self.filename, "rb" ) ]
+        for memory, threads in ( ("768M", 1), (20000, 1), ("20K", 3) ):
+            self.assertEqual( pysam.sort_records( os.path.join( DATADIR, "ex1.bam" ), self.sorted,
+                                                  key = "queryname", memory = memory, threads = threads ),
+                              len( ref ) )
+            self.assertEqual( [ x.qname for x in pysam.Samfile( self.sorted, "rb" ) ], ref )
+            self.assertEqual( pysam.Samfile( self.sorted, "rb" ).header["HD"]["SO"], "queryname" )
+
+    def testCoordinate( self ):
+        pysam.sort_records( os.path.join( DATADIR, "ex1.bam" ), self.filename, key = "queryname" )
+        ref = self.getKeys( os.path.join( DATADIR, "ex1.bam" ) )
+        for memory, threads in ( ("768M", 2), (20000, 1), ("20K", 3) ):
+            pysam.sort_records( self.filename, self.sorted, memory = memory, threads = threads, compresslevel = 1 )
+            self.assertEqual( self.getKeys( self.sorted ), ref )
+        pysam.build_index( self.sorted )
+        self.assertEqual( pysam.Samfile( self.sorted, "rb" ).count( "chr1", 100, 200 ),
+                          pysam.Samfile( os.path.join( DATADIR, "ex1.bam" ), "rb" ).count( "chr1", 100, 200 ) )
+        os.unlink( self.sorted + ".bai" )
+
+    def testTag( self ):
+        pysam.sort_records( os.path.join( DATADIR, "ex1.bam" ), self.sorted, key = "NM", memory = "20K", threads = 2 )
+        values = [ dict( x.tags ).get( "NM", -1 ) for x in pysam.Samfile( self.sorted, "rb" ) ]
+        self.assertEqual( values, sorted( values ) )
+        self.assertEqual( len( values ), 3270 )
+
+    def testErrors( self ):
+        self.assertRaises( IOError, pysam.sort_records, "missing_file", self.sorted )
+        self.assertRaises( ValueError, pysam.sort_records, os.path.join( DATADIR, "ex1.bam" ), self.sorted, key = "position" )
+        self.assertRaises( ValueError, pysam.sort_records, os.path.join( DATADIR, "ex1.bam" ), self.sorted, memory = "lots" )
+
 class TestSamfileIndex( unittest.TestCase):
     
     def testIndex( self ):
@@ -2092,7 +3049,90 @@ class TestSamfileIndex( unittest.TestCase):
             found = list(index.find( qname ))
             self.assertEqual( len(found), counts )
             for x in found: self.assertEqual( x.qname, qname )
-            
+
+    def testIndexStream( self ):
+        data = open( os.path.join( DATADIR, "ex1.bam" ), "rb" ).read()
+        samfile = pysam.Samfile( io.BytesIO( data ), "rb" )
+        self.assertRaises( ValueError, pysam.IndexedReads, samfile )
+        index = pysam.IndexedReads( samfile, reopen = False )
+        self.assertRaises( ValueError, index.build )
+        samfile.close()
+
+    def testIndexThreads( self ):
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb")
+        index = pysam.IndexedReads( samfile )
+        index.build( threads = 4 )
+
+        reads = collections.defaultdict( int )
+        for read in samfile: reads[read.qname] += 1
+
+        for qname, counts in reads.items():
+            found = list(index.find( qname ))
+            self.assertEqual( len(found), counts )
+            for x in found: self.assertEqual( x.qname, qname )
+
+    def testFindBatch( self ):
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb")
+        index = pysam.IndexedReads( samfile )
+        index.build()
+
+        reads = collections.defaultdict( int )
+        for read in samfile: reads[read.qname] += 1
+        qnames = sorted( reads.keys() )[:50]
+
+        found = list( index.find( qnames + ["missing_read"] ) )
+        self.assertEqual( len(found), sum( [ reads[x] for x in qnames ] ) )
+        self.assertEqual( set( [ x.qname for x in found ] ), set( qnames ) )
+        self.assertRaises( KeyError, index.find, ["missing_read"] )
+        self.assertRaises( KeyError, index.find, ("missing_read", "other_missing_read") )
+        self.assertRaises( KeyError, index.find, ["missing_read", "other_missing_read"] )
+
+    def testIndexOnDisk( self ):
+        samfile = pysam.Samfile(os.path.join(DATADIR,"ex1.bam"),
+                                "rb")
+        index_filename = "tmp_%i.qni" % id(self)
+
+        reads = collections.defaultdict( int )
+        for read in samfile: reads[read.qname] += 1
+
+        try:
+            index = pysam.IndexedReads( samfile, on_disk = True, index_filename = index_filename )
+            index.build()
+            self.assertTrue( os.path.exists( index_filename ) )
+
+            # re-open existing index
+            index = pysam.IndexedReads( samfile, on_disk = True, index_filename = index_filename )
+            index.build()
+
+            for qname, counts in reads.items():
+                found = list(index.find( qname ))
+                self.assertEqual( len(found), counts )
+                for x in found: self.assertEqual( x.qname, qname )
+
+            self.assertRaises( KeyError, index.find, "missing_read" )
+        finally:
+            os.unlink( index_filename )
+
+    def testTruncatedFile( self ):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join( tmpdir, "ex1.bam" )
+        index_filename = os.path.join( tmpdir, "ex1.qni" )
+        data = open( os.path.join( DATADIR, "ex1.bam" ), "rb" ).read()
+        open( filename, "wb" ).write( data[:len(data) // 2] )
+        shutil.copy( os.path.join( DATADIR, "ex1.bam.bai" ), filename + ".bai" )
+        try:
+            samfile = pysam.Samfile( filename, "rb" )
+            for threads in (1, 4):
+                index = pysam.IndexedReads( samfile, on_disk = True,
+                                            index_filename = index_filename )
+                self.assertRaises( IOError, index.build, threads = threads )
+                self.assertFalse( os.path.exists( index_filename ) )
+            samfile.close()
+        finally:
+            shutil.rmtree( tmpdir )
+
 
 if __name__ == "__main__":
     # build data files
@@ -291,6 +291,21 @@ class TestIteration( unittest.TestCase ):
         # raise no error for invalid intervals
         self.tabix.fetch( "chr1", 100,100)
 
+    def testRegion( self ):
+        refcount = sys.getrefcount( self.tabix )
+        for contig in ("chr1", "chr2"):
+            for start in range( 0, 200000, 20000):
+                end = start + 2000
+                ref = self.getSubset( contig, start, end )
+                region = pysam.Region( contig, start, end )
+                # use twice to check the cached tid
+                for x in range(2):
+                    self.checkPairwise( list( self.tabix.fetch( region ) ), ref )
+                self.checkPairwise( list( self.tabix.fetch( region = "%s:%i-%i" % (contig, start + 1, end) ) ), ref )
+        self.assertRaises( KeyError, self.tabix.fetch, pysam.Region( "chrUn" ) )
+        # regions do not keep the file alive
+        self.assertEqual( sys.getrefcount( self.tabix ), refcount )
+
     def testGetContigs( self ):
         self.assertEqual( sorted(self.tabix.contigs), [b"chr1", b"chr2"] )
         # check that contigs is read-only